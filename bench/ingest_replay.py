@@ -0,0 +1,366 @@
+"""Replay collectd traffic through bucky's parser and the processor chain
+
+Usage:
+
+    python bench/ingest_replay.py generate CAPTURE [--hosts N] [--metrics M]
+    python bench/ingest_replay.py record CAPTURE [--port P] [--seconds S]
+    python bench/ingest_replay.py replay [CAPTURE] [--workers W] [--rate R]
+
+generate writes synthetic collectd binary packets for N hosts x M metrics
+(load, cpu, memory, interfaces, disks, ping and mist.python metrics, so that
+PingConverter and MistPythonConverter are exercised), while record captures
+real (unencrypted) collectd traffic from a UDP port. Captures are sequences
+of packets, each prefixed by its length.
+
+replay parses the packets with bucky's CollectDHandler, converts them with
+mist's converters, runs them through the processor chain of conf/bucky_conf.py
+(profiled per stage) and formats them for carbon, discarding the result
+unless --carbon is given. Without a capture, synthetic packets are generated
+in memory. Each worker process replays its share of the packets, at up to
+--rate samples per second if given, and reports its throughput, CPU time,
+RSS growth and the time spent in each stage. Since all stages share the
+worker's heap, the memory of a single stage can be measured by running with
+and without it (see --stages).
+
+Shared tables and the discovered metrics store are created in a temporary
+directory, and new metrics are not sent to core.
+
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import struct
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+from bucky.collectd import CollectDHandler
+from bucky.names import statname
+
+from mist.bucky_extras.carbon import PlaintextCarbonSink
+from mist.bucky_extras.collectd_converters import PingConverter
+from mist.bucky_extras.collectd_converters import MistPythonConverter
+from mist.bucky_extras.processors.timeprocessor import \
+    TimeConverterSharedMemory
+from mist.bucky_extras.processors.heartbeat import HeartbeatRecorder
+from mist.bucky_extras.processors.limiter import HostLimiter
+from mist.bucky_extras.processors.last_values import LastValueRecorder
+from mist.bucky_extras.processors.core_observer import NewMetricsObserver
+from mist.bucky_extras.processors.profiling import \
+    ProfiledCompositeProcessor
+
+
+STAGES = ('time', 'heartbeat', 'limiter', 'last_values', 'observer')
+MAX_PACKET = 1452  # collectd's default network buffer size
+GAUGE, DERIVE = 1, 2
+
+
+class Config(object):
+    """The collectd part of bucky's conf, see conf/bucky_conf.py"""
+
+    collectd_security_level = 0
+    collectd_auth_file = None
+    collectd_counter_eq_derive = True
+    collectd_use_entry_points = False
+
+    def __init__(self, types_dbs):
+        self.collectd_types = types_dbs
+        self.collectd_converters = {
+            'ping': PingConverter(),
+            'mist.python': MistPythonConverter(),
+        }
+
+
+def string_part(ptype, value):
+    return struct.pack("!HH", ptype, 5 + len(value)) + value + "\0"
+
+
+def values_part(values):
+    return struct.pack("!HHH", 0x0006, 6 + 9 * len(values), len(values)) + \
+        "".join(struct.pack("B", vtype) for vtype, _ in values) + \
+        "".join(struct.pack("<d" if vtype == GAUGE else "!q", value)
+                for vtype, value in values)
+
+
+def metric_parts(index, step):
+    """Return the parts of the index-th synthetic metric of a host."""
+    i = index // 8
+    kind = index % 8
+    if kind == 0:
+        spec = "load", "%d" % i, "load", "", [(GAUGE, 0.5)] * 3
+    elif kind == 1:
+        spec = "cpu", "%d" % i, "cpu", "idle", [(DERIVE, 100 * step)]
+    elif kind == 2:
+        spec = "cpu", "%d" % i, "cpu", "user", [(DERIVE, 10 * step)]
+    elif kind == 3:
+        spec = "memory", "", "memory", "used%d" % i, [(GAUGE, 1e9)]
+    elif kind == 4:
+        spec = ("interface", "eth%d" % i, "if_octets", "",
+                [(DERIVE, 1000 * step), (DERIVE, 500 * step)])
+    elif kind == 5:
+        spec = ("disk", "sda%d" % i, "disk_octets", "",
+                [(DERIVE, 4096 * step), (DERIVE, 8192 * step)])
+    elif kind == 6:
+        spec = "ping", "", "ping", "10.0.%d.%d" % (i // 250, i % 250), \
+            [(GAUGE, 1.5)]
+    else:
+        spec = "mist.python", "", "gauge", "custom%d" % i, [(GAUGE, 42.0)]
+    plugin, plugin_instance, stype, type_instance, values = spec
+    return (string_part(0x0002, plugin) +
+            string_part(0x0003, plugin_instance) +
+            string_part(0x0004, stype) +
+            string_part(0x0005, type_instance) +
+            values_part(values))
+
+
+def generate(hosts, metrics, intervals, step=10):
+    """Yield collectd packets of hosts x metrics, for each interval."""
+    start = int(time.time()) - intervals * step
+    for interval in xrange(intervals):
+        timestamp = start + interval * step
+        for host in xrange(hosts):
+            header = string_part(0x0000, "%032x" % host) + \
+                struct.pack("!HHQ", 0x0008, 12, timestamp << 30)
+            packet = header
+            for index in xrange(metrics):
+                parts = metric_parts(index, interval + 1)
+                if len(packet) + len(parts) > MAX_PACKET:
+                    yield packet
+                    packet = header
+                packet += parts
+            yield packet
+
+
+def write_capture(path, packets):
+    count = 0
+    with open(path, 'wb') as f:
+        for packet in packets:
+            f.write(struct.pack("!I", len(packet)) + packet)
+            count += 1
+    return count
+
+
+def read_capture(path):
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            yield f.read(struct.unpack("!I", header)[0])
+
+
+def record(port, seconds):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", port))
+    sock.settimeout(1)
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            yield sock.recv(65535)
+        except socket.timeout:
+            pass
+
+
+class NullSink(object):
+    """Format samples like bucky's carbon client, then discard them."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def send(self, host, name, value, timestamp):
+        self.bytes += len("%s %s %d\n" % (statname(host, name),
+                                          value, timestamp))
+
+    def flush(self):
+        pass
+
+
+class NullQueue(object):
+    """Stands in for the queue of new metrics sent to core."""
+
+    def put(self, item, block=False):
+        pass
+
+
+def build_chain(stages, tmpdir):
+    funcs = []
+    if 'time' in stages:
+        funcs.append(TimeConverterSharedMemory(
+            13, path=os.path.join(tmpdir, 'time_offsets.shm')))
+    if 'heartbeat' in stages:
+        funcs.append(HeartbeatRecorder(
+            path=os.path.join(tmpdir, 'heartbeat.shm')))
+    if 'limiter' in stages:
+        funcs.append(HostLimiter(max_metrics=10000, max_rate=1000))
+    if 'last_values' in stages:
+        funcs.append(LastValueRecorder(
+            path=os.path.join(tmpdir, 'last_values.shm'),
+            prefixes=('load.', 'cpu.', 'memory.')))
+    if 'observer' in stages:
+        observer = NewMetricsObserver(
+            path=os.path.join(tmpdir, 'discovered_metrics.conf'),
+            discovery=os.path.join(tmpdir, 'discovery.sock'))
+        observer.queue = NullQueue()
+        funcs.append(observer)
+    return funcs
+
+
+def rss_mb():
+    """Return the current resident set size of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024.0 / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def replay(worker, packets, args, tmpdir, results):
+    handler = CollectDHandler(Config(args.types_db))
+    funcs = build_chain(args.stages, tmpdir)
+    chain = ProfiledCompositeProcessor(funcs, None, interval=float('inf'),
+                                       sample_every=1)
+    if args.carbon:
+        host, port = args.carbon.rsplit(':', 1)
+        sink = PlaintextCarbonSink(host, int(port))
+    else:
+        sink = NullSink()
+    parse_seconds = sink_seconds = 0.0
+    samples = 0
+    rss_start = rss_mb()
+    cpu_start = sum(os.times()[:2])
+    started_at = time.time()
+    columns = [], [], [], []
+
+    def flush():
+        out = chain.process_batch(*columns)
+        started_at = time.time()
+        for sample in zip(*out):
+            sink.send(*sample)
+        sink.flush()
+        for column in columns:
+            del column[:]
+        return time.time() - started_at
+
+    for i, packet in enumerate(packets):
+        if i % args.workers != worker:
+            continue
+        t0 = time.time()
+        for host, name, val, timestamp in handler.parse(packet):
+            columns[0].append(host)
+            columns[1].append(name)
+            columns[2].append(val)
+            columns[3].append(timestamp)
+        parse_seconds += time.time() - t0
+        if len(columns[0]) >= args.batch:
+            samples += len(columns[0])
+            sink_seconds += flush()
+            if args.rate:
+                ahead = started_at + float(samples) / args.rate - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+    samples += len(columns[0])
+    sink_seconds += flush()
+
+    stages = [('parse', samples, 0, parse_seconds)]
+    for profile in chain.profiles:
+        stages.append((profile.name, profile.samples, profile.dropped,
+                       profile.seconds))
+    stages.append(('sink', 0, 0, sink_seconds))
+    results.put({
+        'worker': worker,
+        'samples': samples,
+        'seconds': time.time() - started_at,
+        'cpu': sum(os.times()[:2]) - cpu_start,
+        'rss_start': rss_start,
+        'rss_growth': rss_mb() - rss_start,
+        'stages': stages,
+    })
+
+
+def report(results):
+    total_rate = 0
+    for result in sorted(results, key=lambda result: result['worker']):
+        rate = result['samples'] / max(result['seconds'], 1e-9)
+        total_rate += rate
+        print "worker %d: %d samples in %.2fs, %.0f samples/s, %.2fs cpu, " \
+            "rss %.1f MB (+%.1f MB)" % (
+                result['worker'], result['samples'], result['seconds'], rate,
+                result['cpu'], result['rss_start'], result['rss_growth'])
+        for name, samples, dropped, seconds in result['stages']:
+            print "    %-32s %8.3fs %7.2f us/sample %s" % (
+                name, seconds, seconds * 1e6 / max(result['samples'], 1),
+                "(%d of %d dropped)" % (dropped, samples) if dropped else "")
+    print "total: %.0f samples/s" % total_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('generate', 'record', 'replay'))
+    parser.add_argument('capture', nargs='?')
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--metrics', type=int, default=100,
+                        help="metrics per host (default: %(default)s)")
+    parser.add_argument('--intervals', type=int, default=6,
+                        help="collection intervals (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=25826)
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--rate', type=int, default=0,
+                        help="max samples/s per worker (default: unlimited)")
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--stages', default=",".join(STAGES),
+                        help="processors to run (default: %(default)s)")
+    parser.add_argument('--carbon', default="",
+                        help="send to carbon at host:port instead")
+    parser.add_argument('--types-db', action='append',
+                        help="default: conf/types.db")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.stages = [stage for stage in args.stages.split(",") if stage]
+    if set(args.stages) - set(STAGES):
+        parser.error("unknown stages: %s" % (set(args.stages) - set(STAGES)))
+    args.types_db = args.types_db or ['conf/types.db']
+
+    if args.command in ('generate', 'record'):
+        if not args.capture:
+            parser.error("capture path is required")
+        if args.command == 'generate':
+            packets = generate(args.hosts, args.metrics, args.intervals)
+        else:
+            packets = record(args.port, args.seconds)
+        print "wrote %d packets" % write_capture(args.capture, packets)
+        return
+
+    if args.capture:
+        packets = list(read_capture(args.capture))
+    else:
+        packets = list(generate(args.hosts, args.metrics, args.intervals))
+    print "replaying %d packets (%d bytes) with %d workers" % (
+        len(packets), sum(len(packet) for packet in packets), args.workers)
+    tmpdir = tempfile.mkdtemp()
+    results = multiprocessing.Queue()
+    try:
+        workers = [
+            multiprocessing.Process(target=replay, args=(
+                worker, packets, args, tmpdir, results))
+            for worker in xrange(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        report([results.get() for _ in workers])
+        for worker in workers:
+            worker.join()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
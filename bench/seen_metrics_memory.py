@@ -0,0 +1,50 @@
+"""Memory and speed of NewMetricsObserver's set of seen metrics
+
+Usage: python bench/seen_metrics_memory.py [set|fpset] [entries]
+
+Run each variant in its own process, since the peak RSS is reported. Entries
+look like (machine uuid, collectd metric name), eg 20k hosts x 500 metrics
+for the default 10M entries.
+
+"""
+
+import sys
+import time
+import resource
+
+from mist.bucky_extras.fpset import FingerprintSet
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def keys(entries, metrics_per_host=500):
+    for i in xrange(entries):
+        host = "%032x" % (i // metrics_per_host)
+        yield host, "plugin%d.type-instance%d.value" % (i % 50, i % 500)
+
+
+def main():
+    kind = sys.argv[1] if len(sys.argv) > 1 else 'fpset'
+    entries = int(sys.argv[2]) if len(sys.argv) > 2 else 10 ** 7
+    base = rss_mb()
+    seen = FingerprintSet() if kind == 'fpset' else set()
+    start = time.time()
+    for key in keys(entries):
+        seen.add(key)
+    elapsed = time.time() - start
+    print "%s: %d entries, %.0f MB (%.1f bytes/entry), %.2f us/add" % (
+        kind, len(seen), rss_mb() - base,
+        (rss_mb() - base) * 1024 * 1024 / entries, elapsed * 1e6 / entries)
+
+    start = time.time()
+    lookups = min(entries, 10 ** 6)
+    for key in keys(lookups):
+        assert key in seen
+    elapsed = time.time() - start
+    print "%s: %.2f us/lookup" % (kind, elapsed * 1e6 / lookups)
+
+
+if __name__ == "__main__":
+    main()
@@ -93,15 +93,50 @@ name_strip_duplicates = True
 #    return host, name, val, time
 #processor = debug_proc
 
-from mist.bucky_extras.processors.timeprocessor import TimeConverterSingleThread
+from mist.bucky_extras.processors.timeprocessor import TimeConverterSharedMemory
+from mist.bucky_extras.processors.heartbeat import HeartbeatRecorder
+from mist.bucky_extras.processors.limiter import HostLimiter
+from mist.bucky_extras.processors.last_values import LastValueRecorder
 from mist.bucky_extras.processors.core_observer import NewMetricsObserver
 from mist.bucky_extras.processors.composite import gen_composite_processor
+from mist.bucky_extras.processors.batch import install_batch_processor
+
+# process samples in chunks, see mist.bucky_extras.processors.batch
+install_batch_processor()
 
 processor = gen_composite_processor(
-    TimeConverterSingleThread(13),
+    TimeConverterSharedMemory(13, path='conf/time_offsets.shm'),
+    HeartbeatRecorder(path='conf/heartbeat.shm'),
+    HostLimiter(max_metrics=10000, max_rate=1000),
+    LastValueRecorder(path='conf/last_values.shm',
+                      prefixes=('load.', 'cpu.', 'memory.')),
     NewMetricsObserver(path='conf/discovered_metrics.conf'),
 )
 
+# To profile each processor of the chain, pass profile_sink (eg a
+# PlaintextCarbonSink from mist.bucky_extras.carbon) and optionally
+# profile_interval to gen_composite_processor above. Stats are named after
+# profile_instance ("bucky" by default), set a distinct one per bucky instance.
+
+# Discovery is off by default: supervisord runs a single bucky instance, whose
+# processor chain lives in a single process, so there is only one metrics
+# store to load. To dispatch each new metric exactly once when running many
+# bucky instances on the same node, also supervise `mist-discovery
+# conf/discovery.sock conf/discovered_metrics.conf` and pass
+# discovery='conf/discovery.sock' to NewMetricsObserver above. Its path may
+# be kept pointing at the file mist-discovery writes: it's then only read, to
+# preload metrics already dispatched, so that they aren't sent to
+# mist-discovery again after a restart (see containers/monitor/bucky_conf.py).
+# While mist-discovery is down, new metrics are not dispatched, they are
+# retried the next time they are seen.
+
+# Compute total cpu, disk, interface and memory series at ingest time and
+# store them in graphite (set PREAGGREGATED_TOTALS = True in settings.py to
+# have mist.monitor query them). Append it to the processors above.
+#from mist.bucky_extras.processors.aggregator import TotalsAggregator
+#from mist.bucky_extras.carbon import PlaintextCarbonSink
+#TotalsAggregator(PlaintextCarbonSink(graphite_ip, 2003))
+
 
 #from mist.bucky_extras.clients.debug_client import DebugClient
 #from bucky.names import statname
@@ -115,3 +150,15 @@ processor = gen_composite_processor(
 #
 #custom_clients = [MyDebugClient]
 
+# To spool samples to disk while carbon is unreachable and replay them when it
+# recovers, use SpoolingCarbonClient (see its docstring for its settings).
+# Bucky always runs its stock carbon client alongside custom_clients, so point
+# graphite_ip/graphite_port to a carbon that discards data and the spool
+# client to the real one with spool_graphite_ip/spool_graphite_port, or every
+# sample is written twice (bucky refuses to start if both are the same).
+#spool_graphite_port = 2014  # graphite_port above
+#graphite_port = 2015  # a carbon that discards data
+#from mist.bucky_extras.clients.spool_client import SpoolingCarbonClient
+#spool_dir = "spool"
+#custom_clients = [SpoolingCarbonClient]
+
@@ -26,10 +26,21 @@ name_prefix = "bucky"
 name_postfix = None
 name_replace_char = '_'
 name_strip_duplicates = True
-from mist.bucky_extras.processors.timeprocessor import TimeConverterSingleThread
+from mist.bucky_extras.processors.timeprocessor import TimeConverterSharedMemory
+from mist.bucky_extras.processors.heartbeat import HeartbeatRecorder
+from mist.bucky_extras.processors.limiter import HostLimiter
+from mist.bucky_extras.processors.last_values import LastValueRecorder
 from mist.bucky_extras.processors.core_observer import NewMetricsObserver
 from mist.bucky_extras.processors.composite import gen_composite_processor
+from mist.bucky_extras.processors.batch import install_batch_processor
+install_batch_processor()
 processor = gen_composite_processor(
-    TimeConverterSingleThread(13),
-    NewMetricsObserver(path='/mist.monitor/conf/discovered_metrics.conf'),
+    TimeConverterSharedMemory(13, path='/mist.monitor/conf/time_offsets.shm'),
+    HeartbeatRecorder(path='/mist.monitor/conf/heartbeat.shm'),
+    HostLimiter(max_metrics=10000, max_rate=1000),
+    LastValueRecorder(path='/mist.monitor/conf/last_values.shm',
+                      prefixes=('load.', 'cpu.', 'memory.')),
+    # the store written by mist-discovery, only read here to preload metrics
+    NewMetricsObserver(path='/mist.monitor/conf/discovered_metrics.conf',
+                       discovery='/mist.monitor/conf/discovery.sock'),
 )
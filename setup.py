@@ -49,6 +49,8 @@ setup(
     entry_points={
         'console_scripts': [
             'mist-alert = mist.alert:main',
+            'mist-discovery = '
+            'mist.bucky_extras.processors.core_observer:main',
         ],
         'paste.app_factory': [
             'main = mist.monitor:main',
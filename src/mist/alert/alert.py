@@ -9,6 +9,9 @@ from mist.monitor.model import get_all_machines
 from mist.monitor.methods import remove_rule
 
 from mist.monitor.graphite import MultiHandler
+from mist.monitor.policy import deadline
+from mist.monitor.heartbeat import HeartbeatIndex
+from mist.monitor.metadata import get_cached_metadata
 
 from mist.monitor.helpers import tdelta_to_str
 
@@ -16,6 +19,7 @@ from mist.monitor.exceptions import ConditionNotFoundError
 from mist.monitor.exceptions import GraphiteError
 
 from mist.monitor import config
+from mist.monitor import heartbeat
 
 
 log = logging.getLogger(__name__)
@@ -158,10 +162,11 @@ def check_condition(condition, datapoints):
         log.info(msg)
 
 
-def check_machine(machine, rule_id=''):
+def check_machine(machine, rule_id='', skip_nodata=False):
     """Check all conditions for given machine with a single graphite query.
 
-    If rule is specified, on that rule will be checked.
+    If rule is specified, on that rule will be checked. If skip_nodata is
+    set, the nodata rule isn't checked.
 
     """
 
@@ -175,7 +180,7 @@ def check_machine(machine, rule_id=''):
         'network-tx': 'interface.total.if_octets.tx',
     }
 
-    handler = MultiHandler(machine.uuid)
+    handler = MultiHandler(machine.uuid, get_cached_metadata(machine.uuid))
 
     # check if machine activated
     if not machine.activated:
@@ -207,6 +212,8 @@ def check_machine(machine, rule_id=''):
             continue
         lbl = "%s [%s]" % (lbl, condition)
         target = old_targets.get(condition.metric, condition.metric)
+        if skip_nodata and target == "nodata":
+            continue
         ## if "%(head)s." not in target:
             ## target = "%(head)s." + target
         if condition.operator not in ('gt', 'lt'):
@@ -228,7 +235,8 @@ def check_machine(machine, rule_id=''):
         else:
             conditions[target].append(condition)
     if not conditions:
-        log.warning("%s no rules found", machine.uuid)
+        if not skip_nodata:
+            log.warning("%s no rules found", machine.uuid)
         return
 
     try:
@@ -237,6 +245,12 @@ def check_machine(machine, rule_id=''):
         log.warning("%s error fetching stats %r", machine.uuid, exc)
         return
 
+    # skip conditions whose targets failed, they'll be checked on next run
+    for target, error in handler.errors.items():
+        for cond in conditions.pop(target, []):
+            log.warning("%s/%s [%s] error fetching target: %s",
+                        machine.uuid, cond.rule_id, cond, error)
+
     # check all conditions
     for item in data:
         target = item['_requested_target']
@@ -265,14 +279,40 @@ def check_machine(machine, rule_id=''):
                                 machine.uuid, cond.rule_id, cond)
 
 
+def check_machine_with_deadline(machine, skip_nodata=False):
+    """Check machine, giving up on graphite after ALERT_CHECK_DEADLINE."""
+    with deadline(config.ALERT_CHECK_DEADLINE):
+        check_machine(machine, skip_nodata=skip_nodata)
+
+
 def main():
     pool = ThreadPool(config.ALERT_THREADS)
+    index = HeartbeatIndex()
     while True:
         t0 = time()
-        pool.map(check_machine, get_all_machines())
+        machines = list(get_all_machines())
+        # with heartbeats, only check nodata rules of machines that are or
+        # were just silent, see HeartbeatIndex.changed
+        if config.NODATA_FROM_HEARTBEAT and heartbeat.is_available(90):
+            index.update(machine.uuid for machine in machines)
+            nodata = index.changed(90)
+        else:
+            index.reset()
+            nodata = None
+
+        def check(machine):
+            check_machine_with_deadline(
+                machine, skip_nodata=nodata is not None and
+                machine.uuid not in nodata
+            )
+
+        pool.map(check, machines)
         t1 = time()
         dt = t1 - t0
         run_msg = "Run completed in %.1f seconds." % dt
+        if nodata is not None:
+            run_msg += " %d machines silent for over 90 seconds." % len(
+                index.last_silent)
         sleep_time = config.ALERT_PERIOD - dt
         if sleep_time > 0:
             log.info("%s Sleeping for %.1f seconds. ==========",
@@ -0,0 +1,213 @@
+"""Sinks used by processors to emit extra samples straight to carbon
+
+Bucky processors can only transform or drop the sample they are given. Those
+that need to emit additional samples (eg computed aggregates or internal
+metrics) write them to a sink, ie any object with a `send(host, name, value,
+timestamp)` method.
+
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import logging
+
+from bucky.names import statname
+
+
+log = logging.getLogger(__name__)
+
+
+class PlaintextCarbonSink(object):
+    """Send samples to carbon using the plaintext protocol.
+
+    Lines are buffered and sent when buffer_size lines have accumulated or
+    when flush() is called. The socket is non blocking, so the caller is
+    never blocked by carbon: data that can't be sent right away is kept, up to
+    max_pending bytes, and sent on the next write. If carbon is unreachable
+    or slow, data beyond that is dropped and counted in self.dropped, and
+    reconnection is attempted at most once every reconnect_delay seconds. A
+    connection that isn't established within timeout seconds is abandoned.
+
+    """
+
+    def __init__(self, ip="127.0.0.1", port=2003, buffer_size=500,
+                 reconnect_delay=5, timeout=2, max_pending=1 << 20):
+        self.ip = ip
+        self.port = port
+        self.buffer_size = buffer_size
+        self.reconnect_delay = reconnect_delay
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.sock = None
+        self.connected = False
+        self.last_connect = 0
+        self.buffer = []
+        self.pending = ""  # data written but not sent yet
+        self.dropped = 0  # bytes dropped so far
+
+    def connect(self):
+        self.close()
+        self.last_connect = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((self.ip, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            log.error("Failed to connect to carbon at %s:%s: %s",
+                      self.ip, self.port, os.strerror(err))
+            sock.close()
+            return False
+        self.sock = sock
+        self.connected = not err
+        return True
+
+    def _check_connected(self):
+        """Return True once the pending connection is established."""
+        if self.connected:
+            return True
+        _, writable, _ = select.select([], [self.sock], [], 0)
+        if writable:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                log.error("Failed to connect to carbon at %s:%s: %s",
+                          self.ip, self.port, os.strerror(err))
+                self.close()
+                return False
+            log.info("Connected to carbon at %s:%s", self.ip, self.port)
+            self.connected = True
+            return True
+        if time.time() - self.last_connect > self.timeout:
+            log.error("Timed out connecting to carbon at %s:%s",
+                      self.ip, self.port)
+            self.close()
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+            self.connected = False
+
+    def send(self, host, name, value, timestamp):
+        self.buffer.append("%s %s %d\n" % (statname(host, name),
+                                           value, timestamp))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Send buffered lines, return True unless data was dropped."""
+        if not self.buffer:
+            return True
+        data, self.buffer = "".join(self.buffer), []
+        return self.write(data)
+
+    def _drop(self, size):
+        if size:
+            self.dropped += size
+            log.warning("Dropping %d bytes (%d so far)", size, self.dropped)
+
+    def write(self, data):
+        """Send already formatted lines, return True unless data was dropped.
+
+        Data is sent as far as the socket allows without blocking, the rest
+        is kept to be sent on the next write.
+
+        """
+        self.pending += data
+        if self.sock is None and \
+                time.time() - self.last_connect >= self.reconnect_delay:
+            self.connect()
+        if self.sock is not None and self._check_connected():
+            try:
+                while self.pending:
+                    sent = self.sock.send(self.pending)
+                    self.pending = self.pending[sent:]
+            except socket.error as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.error("Error sending %d bytes to carbon: %s",
+                              len(self.pending), exc)
+                    self.close()
+        if self.sock is None:
+            # carbon is unreachable, drop everything
+            size, self.pending = len(self.pending), ""
+            self._drop(size)
+            return not size
+        if len(self.pending) > self.max_pending:
+            # keep whole lines at the end of what's pending
+            cut = self.pending.find("\n", len(self.pending) -
+                                    self.max_pending) + 1
+            self._drop(cut)
+            self.pending = self.pending[cut:]
+            return False
+        return True
+
+
+class BlockingCarbonSink(PlaintextCarbonSink):
+    """A PlaintextCarbonSink that waits until data is handed to carbon.
+
+    Connecting and sending block for up to timeout seconds, and write()
+    returns True only if all data was sent, so callers can keep (eg spool)
+    what wasn't. Meant for bucky clients, which run in their own process.
+
+    """
+
+    def connect(self):
+        self.close()
+        self.last_connect = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((self.ip, self.port))
+        except socket.error as exc:
+            log.error("Failed to connect to carbon at %s:%s: %s",
+                      self.ip, self.port, exc)
+            sock.close()
+            return False
+        log.info("Connected to carbon at %s:%s", self.ip, self.port)
+        self.sock = sock
+        self.connected = True
+        return True
+
+    def write(self, data):
+        if self.sock is None:
+            if time.time() - self.last_connect < self.reconnect_delay:
+                return False
+            if not self.connect():
+                return False
+        try:
+            self.sock.sendall(data)
+        except socket.error as exc:
+            log.error("Error sending %d bytes to carbon: %s", len(data), exc)
+            self.close()
+            return False
+        return True
+
+    def flush(self):
+        if not self.buffer:
+            return True
+        data, self.buffer = "".join(self.buffer), []
+        if not self.write(data):
+            self._drop(len(data))
+            return False
+        return True
+
+
+class TeeSink(object):
+    """Forward samples to many sinks."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def send(self, host, name, value, timestamp):
+        for sink in self.sinks:
+            sink.send(host, name, value, timestamp)
+
+    def flush(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'flush'):
+                sink.flush()
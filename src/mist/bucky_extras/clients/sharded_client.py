@@ -0,0 +1,44 @@
+import time
+import logging
+
+from bucky.client import Client
+
+from mist.monitor.sharding import HashRing
+from mist.bucky_extras.carbon import PlaintextCarbonSink
+
+
+log = logging.getLogger(__name__)
+
+
+class ShardedCarbonClient(Client):
+    """Send samples to many carbon backends, sharded by host (machine uuid)
+
+    Backends are configured in bucky's conf with a dict mapping backend names
+    to (ip, port) tuples of carbon's plaintext receiver:
+
+        graphite_shards = {"a": ("10.0.0.1", 2003), "b": ("10.0.0.2", 2003)}
+
+    Backend names must match the keys of GRAPHITE_BACKENDS in mist.monitor's
+    settings, since the same consistent hash ring is used to route reads.
+
+    Bucky always starts its stock carbon client as well, so graphite_ip and
+    graphite_port should then point to a local carbon that discards data.
+
+    """
+
+    flush_interval = 1  # seconds
+
+    def __init__(self, cfg, pipe):
+        super(ShardedCarbonClient, self).__init__(pipe)
+        shards = getattr(cfg, 'graphite_shards', {})
+        self.ring = HashRing(sorted(shards.keys()))
+        self.sinks = dict((name, PlaintextCarbonSink(ip, port))
+                          for name, (ip, port) in shards.items())
+        self.last_flush = time.time()
+
+    def send(self, host, name, value, tstamp):
+        self.sinks[self.ring.get_node(host)].send(host, name, value, tstamp)
+        if time.time() - self.last_flush > self.flush_interval:
+            for sink in self.sinks.values():
+                sink.flush()
+            self.last_flush = time.time()
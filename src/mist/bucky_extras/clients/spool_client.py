@@ -0,0 +1,134 @@
+import time
+import logging
+
+from bucky.client import Client, setproctitle
+from bucky.names import statname
+
+from mist.bucky_extras.carbon import BlockingCarbonSink
+from mist.bucky_extras.spool import Spool
+
+
+log = logging.getLogger(__name__)
+
+
+class SpoolingCarbonClient(Client):
+    """Send samples to carbon, spooling them to disk while it's unavailable
+
+    Samples are sent to carbon's plaintext receiver every flush_interval
+    seconds. If that fails, they're appended to a size capped spool on disk
+    instead (see mist.bucky_extras.spool). Once carbon accepts data again,
+    live samples keep being sent right away, while the spool is replayed in
+    the background at up to replay_rate bytes per second.
+
+    Configured in bucky's conf with:
+
+        spool_graphite_ip = "127.0.0.1"   # defaults to graphite_ip
+        spool_graphite_port = 2003
+        spool_dir = "/var/spool/bucky"
+        spool_max_bytes = 1024 ** 3
+        spool_replay_rate = 1024 ** 2
+
+    Every report_interval seconds the spool's depth in bytes and the replay
+    lag (age of the oldest spooled sample) are logged and sent to carbon as
+    spool.depth_bytes and spool.lag_seconds.
+
+    Bucky always starts its stock carbon client as well, so graphite_ip and
+    graphite_port must then point to a local carbon that discards data, or
+    every sample would be written twice. Starting fails if both clients
+    would write to the same carbon.
+
+    While carbon is unavailable and no samples arrive, its health is checked
+    by reconnecting every flush_interval seconds (throttled by the sink's
+    reconnect delay), so that the spool is replayed even while idle.
+
+    """
+
+    flush_interval = 1  # seconds
+    report_interval = 60
+
+    def __init__(self, cfg, pipe):
+        super(SpoolingCarbonClient, self).__init__(pipe)
+        address = (getattr(cfg, 'spool_graphite_ip', cfg.graphite_ip),
+                   getattr(cfg, 'spool_graphite_port', 2003))
+        if address == (cfg.graphite_ip, cfg.graphite_port):
+            raise ValueError(
+                "SpoolingCarbonClient and bucky's carbon client both write "
+                "to %s:%s, point graphite_ip and graphite_port to a carbon "
+                "that discards data" % address
+            )
+        self.sink = BlockingCarbonSink(*address)
+        self.spool = Spool(getattr(cfg, 'spool_dir', 'spool'),
+                           max_bytes=getattr(cfg, 'spool_max_bytes',
+                                             1024 ** 3))
+        self.replay_rate = getattr(cfg, 'spool_replay_rate', 1024 ** 2)
+        self.buffer = []
+        self.healthy = True
+        self.flushed_at = self.reported_at = time.time()
+
+    def run(self):
+        setproctitle("bucky: %s" % self.__class__.__name__)
+        while True:
+            if self.pipe.poll(self.flush_interval):
+                try:
+                    sample = self.pipe.recv()
+                except KeyboardInterrupt:
+                    continue
+                if sample is None:
+                    break
+                self.send(*sample)
+            self.tick()
+        self.flush()
+
+    def send(self, host, name, value, tstamp):
+        self.buffer.append("%s %s %d\n" % (statname(host, name),
+                                           value, tstamp))
+
+    def tick(self):
+        now = time.time()
+        if now - self.flushed_at >= self.flush_interval:
+            elapsed, self.flushed_at = now - self.flushed_at, now
+            if not self.buffer and not self.healthy:
+                # idle, check whether carbon is back
+                self.healthy = self.sink.write("")
+            self.flush()
+            if self.healthy:
+                self.replay(int(elapsed * self.replay_rate))
+        if now - self.reported_at >= self.report_interval:
+            self.reported_at = now
+            self.report(now)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data, self.buffer = "".join(self.buffer), []
+        self.healthy = self.sink.write(data)
+        if not self.healthy:
+            self.spool.append(data)
+
+    def replay(self, max_bytes):
+        while max_bytes > 0 and self.spool.depth():
+            data = self.spool.read(min(max_bytes, 1024 * 1024))
+            if not data:
+                break
+            if not self.sink.write(data):
+                self.healthy = False
+                break
+            self.spool.commit(len(data))
+            max_bytes -= len(data)
+
+    def lag(self, now):
+        """Return the age of the oldest spooled sample in seconds."""
+        line = self.spool.read(4096).split("\n", 1)[0]
+        try:
+            return now - int(line.split()[2])
+        except (IndexError, ValueError):
+            return 0
+
+    def report(self, now):
+        depth = self.spool.depth()
+        lag = self.lag(now) if depth else 0
+        if depth:
+            log.warning("Spool holds %d bytes, replay lags %d seconds",
+                        depth, lag)
+        self.send("", "spool.depth_bytes", depth, now)
+        self.send("", "spool.lag_seconds", lag, now)
@@ -0,0 +1,138 @@
+"""Memory compact set of string tuples
+
+FingerprintSet stores 64bit fingerprints of its members (see
+mist.monitor.shm_table.fingerprint) in a flat array used as an open
+addressing hash table with linear probing. It uses 8 bytes per slot and at
+most 1 / max_load slots per member (about 11-23 bytes per member with the
+default max_load), instead of the hundreds of bytes of a python set of
+string tuples.
+
+Members can't be retrieved or removed, only added and tested. Two different
+members may share the same fingerprint, in which case the second will be
+wrongly reported as present. With 64bit fingerprints and 10M members the
+probability of any such collision is about 3 in a million.
+
+"""
+
+import sys
+import array
+import struct
+
+from mist.monitor.shm_table import fingerprint
+
+
+HEADER = struct.Struct("<8sQQ")  # magic, slots, members
+MAGIC = "MISTFPS1"
+SLOT = struct.Struct("<Q")
+
+
+class FingerprintSet(object):
+
+    typecode = 'L'  # unsigned long, 64bit on all platforms we run on
+
+    def __init__(self, capacity=1 << 16, max_load=0.7):
+        """Create a set sized to hold capacity members without growing."""
+        self.max_load = max_load
+        self._mask = (1 << 8 * array.array(self.typecode).itemsize) - 1
+        self._len = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        slots = 1
+        while slots * self.max_load < capacity:
+            slots <<= 1
+        self._slots = array.array(self.typecode, [0]) * slots
+        self._limit = int(slots * self.max_load)
+
+    def _fingerprint(self, key):
+        return fingerprint(*key) & self._mask or 1
+
+    def _probe(self, fp):
+        """Return index of fp's slot or of the empty slot it would go to."""
+        slots = self._slots
+        last = len(slots) - 1
+        index = fp & last
+        while True:
+            found = slots[index]
+            if not found or found == fp:
+                return index
+            index = (index + 1) & last
+
+    def _insert(self, fp):
+        index = self._probe(fp)
+        if self._slots[index]:
+            return False
+        self._slots[index] = fp
+        self._len += 1
+        return True
+
+    def _grow(self):
+        # fill the bigger array before swapping, so that concurrent readers
+        # never see a partially filled one
+        bigger = FingerprintSet(len(self._slots), self.max_load)
+        for fp in self._slots:
+            if fp:
+                bigger._insert(fp)
+        self._slots, self._limit = bigger._slots, bigger._limit
+
+    def add(self, key):
+        """Add a tuple of strings to the set, eg (host, name)."""
+        if self._len >= self._limit:
+            self._grow()
+        self._insert(self._fingerprint(key))
+
+    def __contains__(self, key):
+        return bool(self._slots[self._probe(self._fingerprint(key))])
+
+    def __len__(self):
+        return self._len
+
+    def nbytes(self):
+        """Return the size in bytes of the underlying array."""
+        return len(self._slots) * self._slots.itemsize
+
+    def dump(self, f):
+        """Write the set to file object f, see MappedFingerprintSet."""
+        f.write(HEADER.pack(MAGIC, len(self._slots), self._len))
+        slots = self._slots
+        if sys.byteorder != 'little':
+            slots = array.array(self.typecode, slots)
+            slots.byteswap()
+        slots.tofile(f)
+
+
+class MappedFingerprintSet(FingerprintSet):
+    """Read only FingerprintSet, dumped in a buffer (eg an mmap)
+
+    Lookups are served straight from the buffer, so opening a set that was
+    dumped to a file and mapped in memory takes no time, whatever its size.
+
+    """
+
+    def __init__(self, buf, offset=0):
+        magic, slots, self._len = HEADER.unpack_from(buf, offset)
+        if magic != MAGIC:
+            raise ValueError("Not a dumped FingerprintSet")
+        self._buf = buf
+        self._offset = offset + HEADER.size
+        self._last = slots - 1
+        self._mask = (1 << 8 * SLOT.size) - 1
+
+    def _probe(self, fp):
+        """Return the slot's fingerprint where fp is, or would be, stored."""
+        index = fp & self._last
+        while True:
+            found = SLOT.unpack_from(self._buf,
+                                     self._offset + index * SLOT.size)[0]
+            if not found or found == fp:
+                return found
+            index = (index + 1) & self._last
+
+    def add(self, key):
+        raise TypeError("MappedFingerprintSet is read only")
+
+    def __contains__(self, key):
+        return bool(self._probe(self._fingerprint(key)))
+
+    def nbytes(self):
+        return (self._last + 1) * SLOT.size
@@ -0,0 +1,223 @@
+"""On disk store of the metrics discovered by bucky
+
+The store of path consists of two files:
+
+    <path>       Append log with a "<host> <name>" line per new metric and a
+                 "- <host>" line per removed machine. This is the format of
+                 the old discovered_metrics.conf, which is thus used as is.
+    <path>.snap  Compacted snapshot: a header, the unique "<host> <name>"
+                 lines sorted, and a dumped FingerprintSet of those lines.
+
+The snapshot is memory mapped, so opening the store only takes parsing the
+log. Membership tests use the snapshot's fingerprint set, and the metrics of
+a host are found by binary search in the sorted lines. compact() merges the
+log into a new snapshot, dropping duplicates and removed machines, and
+truncates the log. It can run while the store is in use, since the snapshot
+is replaced atomically.
+
+Lines are appended to the log under an exclusive lock of the file, so that
+remove_host() can be called from other processes (eg when the API removes a
+machine).
+
+"""
+
+import os
+import mmap
+import fcntl
+import heapq
+import struct
+import logging
+import threading
+
+from mist.bucky_extras.fpset import FingerprintSet, MappedFingerprintSet
+
+
+log = logging.getLogger(__name__)
+
+
+SNAP_HEADER = struct.Struct("<8sQ")  # magic, size of lines
+SNAP_MAGIC = "MISTDMS1"
+
+
+def append_lines(path, lines):
+    """Append lines to the log of path, holding its lock."""
+    with open(path, 'a') as f:
+        fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+        f.writelines(lines)
+
+
+def remove_host(path, host):
+    """Mark all metrics of host as removed in the store of path."""
+    append_lines(path, ["- %s\n" % host])
+
+
+def parse_log(f):
+    """Return ({host: set(names)}, removed hosts, lines) of log file f."""
+    metrics = {}
+    removed = set()
+    lines = 0
+    for line in f:
+        lines += 1
+        parts = line.split()
+        if len(parts) != 2:
+            log.error("Invalid line in '%s': '%s'", f.name, line.strip())
+        elif parts[0] == '-':
+            metrics.pop(parts[1], None)
+            removed.add(parts[1])
+        else:
+            metrics.setdefault(parts[0], set()).add(parts[1])
+    return metrics, removed, lines
+
+
+class MetricsStore(object):
+
+    def __init__(self, path, capacity=1 << 16):
+        self.path = path
+        self.snap_path = path + '.snap'
+        self.lock = threading.Lock()  # held while appending or compacting
+        self.set_lock = threading.Lock()  # held while adding to log_set
+        self._open_snapshot()
+        self._load_log(capacity)
+
+    def _open_snapshot(self):
+        self.snap = None
+        self.snap_set = None
+        self.snap_end = SNAP_HEADER.size
+        try:
+            with open(self.snap_path) as f:
+                self.snap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as exc:
+            if os.path.exists(self.snap_path):
+                log.error("Error opening '%s': %r", self.snap_path, exc)
+            return
+        magic, size = SNAP_HEADER.unpack_from(self.snap)
+        if magic != SNAP_MAGIC:
+            log.error("Invalid snapshot '%s', ignoring", self.snap_path)
+            self.snap = None
+            return
+        self.snap_end = SNAP_HEADER.size + size
+        # fingerprint set is aligned at 8 bytes after the lines
+        self.snap_set = MappedFingerprintSet(self.snap,
+                                             (self.snap_end + 7) // 8 * 8)
+
+    def _load_log(self, capacity):
+        self.log_metrics, self.removed, self.log_lines = {}, set(), 0
+        try:
+            with open(self.path) as f:
+                self.log_metrics, self.removed, self.log_lines = parse_log(f)
+        except IOError as exc:
+            log.warning("Error opening metrics file: %s", exc)
+        self.log_set = FingerprintSet(capacity)
+        for host, names in self.log_metrics.iteritems():
+            for name in names:
+                self.log_set.add((host, name))
+        log.info("Loaded %d metrics from snapshot and %d lines from log",
+                 len(self.snap_set or ()), self.log_lines)
+
+    def __contains__(self, key):
+        if key in self.log_set:
+            return True
+        return self.snap_set is not None and \
+            key[0] not in self.removed and key in self.snap_set
+
+    def add(self, key):
+        """Mark key as seen in memory only, see append()."""
+        with self.set_lock:
+            self.log_set.add(key)
+
+    def append(self, host, names):
+        """Persist new names of host."""
+        with self.lock:
+            append_lines(self.path, ["%s %s\n" % (host, name)
+                                     for name in names])
+            self.log_lines += len(names)
+            self.log_metrics.setdefault(host, set()).update(names)
+        with self.set_lock:
+            for name in names:
+                self.log_set.add((host, name))
+
+    def _iter_snapshot(self, offset=None):
+        """Iterate over lines of snapshot starting at offset."""
+        if self.snap is None:
+            return
+        offset = SNAP_HEADER.size if offset is None else offset
+        while offset < self.snap_end:
+            end = self.snap.find("\n", offset, self.snap_end)
+            yield self.snap[offset:end]
+            offset = end + 1
+
+    def _bisect(self, prefix):
+        """Return offset of first snapshot line not lower than prefix."""
+        lo, hi = SNAP_HEADER.size, self.snap_end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.snap.rfind("\n", SNAP_HEADER.size, mid) + 1
+            start = max(start, SNAP_HEADER.size)
+            end = self.snap.find("\n", start, self.snap_end)
+            if self.snap[start:end] < prefix:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def names(self, host):
+        """Return the set of known metric names of host."""
+        names = set(self.log_metrics.get(host, ()))
+        if self.snap is not None and host not in self.removed:
+            prefix = host + " "
+            for line in self._iter_snapshot(self._bisect(prefix)):
+                if not line.startswith(prefix):
+                    break
+                names.add(line[len(prefix):])
+        return names
+
+    def needs_compaction(self):
+        return self.log_lines > max(10000, len(self.snap_set or ()) // 4)
+
+    def compact(self):
+        """Merge log into a new snapshot and truncate log."""
+        with self.lock:
+            with open(self.path, 'a+') as logf:
+                # block appends from other processes until log is truncated,
+                # (closing any other file of the log would release the lock)
+                fcntl.lockf(logf.fileno(), fcntl.LOCK_EX)
+                # another process may have compacted since we mapped the
+                # snapshot, merge the log into the current one
+                self._open_snapshot()
+                logf.seek(0)
+                metrics, removed, lines = parse_log(logf)
+                count = self._write_snapshot(metrics, removed)
+                logf.truncate(0)
+            self._open_snapshot()
+            self.log_metrics, self.removed, self.log_lines = {}, set(), 0
+        log.info("Compacted %d log lines in snapshot of %d metrics",
+                 lines, count)
+
+    def _write_snapshot(self, metrics, removed):
+        log_lines = sorted("%s %s" % (host, name)
+                           for host, names in metrics.iteritems()
+                           for name in names)
+        snap_lines = (line for line in self._iter_snapshot()
+                      if line.split(" ", 1)[0] not in removed)
+        fpset = FingerprintSet(len(self.snap_set or ()) + len(log_lines))
+        tmp_path = self.snap_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(SNAP_HEADER.pack(SNAP_MAGIC, 0))
+            size = 0
+            previous = None
+            for line in heapq.merge(snap_lines, log_lines):
+                if line == previous:
+                    continue
+                previous = line
+                f.write(line + "\n")
+                size += len(line) + 1
+                fpset.add(tuple(line.split(" ", 1)))
+            f.write("\0" * ((SNAP_HEADER.size + size + 7) // 8 * 8 -
+                            SNAP_HEADER.size - size))
+            fpset.dump(f)
+            f.seek(0)
+            f.write(SNAP_HEADER.pack(SNAP_MAGIC, size))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snap_path)
+        return len(fpset)
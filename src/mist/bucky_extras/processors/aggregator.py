@@ -0,0 +1,109 @@
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class TotalsAggregator(object):
+    """Compute total cpu, disk, interface and memory series at ingest time
+
+    The handlers in mist.monitor.graphite compute these totals at query time
+    with sumSeries/asPercent over wildcards. This processor computes them once
+    per step from the incoming samples and emits them through a sink (see
+    mist.bucky_extras.carbon), so that they get stored as regular series:
+
+        cpu.total.nonidle
+        disk.total.disk_octets.{read,write}
+        interface.total.if_octets.{rx,tx}
+        memory.nonfree_percent
+
+    Samples of each host are grouped in buckets that follow the host's own
+    collection cycle: a bucket starts with the first sample of a cycle and
+    holds the samples of the next step seconds, even if they straddle a step
+    boundary. It is emitted, with its start rounded down to a multiple of
+    step, when the first sample of the next cycle arrives, so totals lag one
+    cycle behind the raw series. Buckets of hosts that stop sending are
+    emitted once nothing has arrived for them for grace seconds. Late samples
+    that belong to an already emitted bucket are not taken into account.
+
+    All samples are passed through untouched. This processor should be placed
+    after TimeConverter, so that timestamps have already been fixed.
+
+    """
+
+    plugins = ('cpu', 'disk', 'interface', 'memory')
+
+    def __init__(self, sink, step=10, grace=None):
+        self.sink = sink
+        self.step = step
+        self.grace = grace if grace is not None else 2 * step
+        # host -> (cycle start, {name: value}, wall time of last sample)
+        self._buckets = {}
+        self._flushed_at = time.time()
+
+    def __call__(self, host, name, val, timestamp):
+        now = time.time()
+        if name.split('.', 1)[0] in self.plugins:
+            current = self._buckets.get(host)
+            if current is None or timestamp >= current[0] + self.step:
+                if current is not None:
+                    self.emit(host, current[0], current[1])
+                current = (timestamp, {})
+            if timestamp > current[0] - self.step / 2.0:
+                current[1][name] = val
+                self._buckets[host] = (current[0], current[1], now)
+        if now - self._flushed_at >= 1:
+            self.flush_idle(now)
+        return host, name, val, timestamp
+
+    def flush_idle(self, now=None):
+        """Emit buckets of hosts that haven't sent anything for grace."""
+        now = now or time.time()
+        self._flushed_at = now
+        idle = [host for host, (_, _, arrived) in self._buckets.iteritems()
+                if arrived < now - self.grace]
+        for host in idle:
+            start, values, _ = self._buckets.pop(host)
+            self.emit(host, start, values)
+
+    def compute(self, values):
+        """Compute totals from a {name: value} dict of a single bucket."""
+        totals = {}
+        cpu = [0.0, 0.0]  # nonidle, all
+        memory = [0.0, 0.0]  # nonfree, all
+        for name, val in values.iteritems():
+            parts = name.split('.')
+            plugin = parts[0]
+            # the 'idle', 'free' and 'total' substring checks below mirror
+            # the graphite exclude() regexes used by the query time targets
+            if plugin == 'cpu' and len(parts) == 3 and parts[1] != 'total':
+                cpu[1] += val
+                if 'idle' not in parts[2]:
+                    cpu[0] += val
+            elif plugin == 'memory' and len(parts) == 2:
+                if parts[1].endswith('_percent'):
+                    continue
+                memory[1] += val
+                if 'free' not in parts[1]:
+                    memory[0] += val
+            elif plugin in ('disk', 'interface') and len(parts) == 4:
+                kind = 'disk_octets' if plugin == 'disk' else 'if_octets'
+                if parts[1] != 'total' and parts[2] == kind:
+                    total = "%s.total.%s.%s" % (plugin, kind, parts[3])
+                    totals[total] = totals.get(total, 0.0) + val
+        if cpu[1]:
+            totals['cpu.total.nonidle'] = 100.0 * cpu[0] / cpu[1]
+        if memory[1]:
+            totals['memory.nonfree_percent'] = 100.0 * memory[0] / memory[1]
+        return totals
+
+    def emit(self, host, timestamp, values):
+        timestamp = int(timestamp) // self.step * self.step
+        try:
+            for name, val in sorted(self.compute(values).items()):
+                self.sink.send(host, name, val, timestamp)
+            if hasattr(self.sink, 'flush'):
+                self.sink.flush()
+        except Exception as exc:
+            log.error("Error emitting totals for host '%s': %r", host, exc)
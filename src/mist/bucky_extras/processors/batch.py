@@ -0,0 +1,146 @@
+"""Batch processor protocol
+
+Bucky calls its processor once per sample, and gen_composite_processor then
+calls every stage once per sample, packing and unpacking 4-tuples along the
+way. Batch processors instead receive and return chunks of samples in
+columnar form:
+
+    hosts, names, vals, timestamps = stage.process_batch(hosts, names, vals,
+                                                         timestamps)
+
+where all four are lists of the same length. Dropping samples means
+returning shorter lists (see select()). Batch processors still work as
+per-sample processors, and per-sample processors are adapted to the batch
+protocol with PerSampleAdapter, so both kinds can be mixed in a composite
+processor.
+
+Bucky's own processor process hands samples one by one to the processor.
+Call install_batch_processor() in bucky's conf to replace it with
+BatchCustomProcessor, which drains the queue in chunks and uses
+process_batch() whenever the configured processor has it. Composite
+processors retry a failing stage one sample at a time themselves (see
+CompositeProcessor), a batch that still fails is retried one sample at a
+time through the whole processor.
+
+"""
+
+import logging
+from itertools import izip
+
+import bucky.processor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+log = logging.getLogger(__name__)
+
+
+def select(indexes, *columns):
+    """Return a tuple of columns keeping only the items at indexes."""
+    return tuple([column[i] for i in indexes] for column in columns)
+
+
+class BatchProcessor(object):
+    """Base class of processors that implement the batch protocol."""
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        raise NotImplementedError()
+
+    def __call__(self, host, name, val, timestamp):
+        hosts, names, vals, timestamps = self.process_batch(
+            [host], [name], [val], [timestamp]
+        )
+        if hosts:
+            return hosts[0], names[0], vals[0], timestamps[0]
+
+
+class PerSampleAdapter(BatchProcessor):
+    """Adapt a per-sample processor to the batch protocol."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        func = self.func
+        out = [], [], [], []
+        append_host, append_name, append_val, append_timestamp = \
+            [column.append for column in out]
+        for sample in izip(hosts, names, vals, timestamps):
+            sample = func(*sample)
+            if sample is not None:
+                host, name, val, timestamp = sample
+                append_host(host)
+                append_name(name)
+                append_val(val)
+                append_timestamp(timestamp)
+        return out
+
+    def __call__(self, host, name, val, timestamp):
+        return self.func(host, name, val, timestamp)
+
+
+def as_batch_processor(func):
+    """Return func if it implements the batch protocol, else adapt it."""
+    if hasattr(func, 'process_batch'):
+        return func
+    return PerSampleAdapter(func)
+
+
+class BatchCustomProcessor(bucky.processor.CustomProcessor):
+    """Bucky processor process that processes samples in chunks."""
+
+    batch_size = 500
+
+    def run(self):
+        bucky.processor.setproctitle("bucky: %s" % self.__class__.__name__)
+        batch = getattr(self.function, 'process_batch', None)
+        if hasattr(self.function, 'drop_on_error'):
+            self.function.drop_on_error = self.drop_on_error
+        while True:
+            try:
+                samples = [self.in_queue.get(True, 1)]
+            except queue.Empty:
+                continue
+            try:
+                while len(samples) < self.batch_size:
+                    samples.append(self.in_queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in samples
+            if stop:
+                samples = samples[:samples.index(None)]
+            if samples and batch is not None:
+                try:
+                    samples = zip(*batch(*map(list, zip(*samples))))
+                except Exception as exc:
+                    log.error("Error processing batch of %d samples, "
+                              "retrying one by one: %r", len(samples), exc)
+                    samples = self.process_samples(samples)
+            else:
+                samples = self.process_samples(samples)
+            for sample in samples:
+                self.out_queue.put(sample)
+            if stop:
+                break
+
+    def process_samples(self, samples):
+        processed = []
+        for sample in samples:
+            try:
+                sample = self.process(*sample)
+            except Exception as exc:
+                log.error("Error processing sample %s: %r", sample, exc)
+                if self.drop_on_error:
+                    sample = None
+            if sample is not None:
+                processed.append(sample)
+        return processed
+
+
+def install_batch_processor(batch_size=500):
+    """Make bucky use BatchCustomProcessor, call from bucky's conf."""
+    BatchCustomProcessor.batch_size = batch_size
+    bucky.processor.CustomProcessor = BatchCustomProcessor
@@ -1,11 +1,87 @@
-def gen_composite_processor(*funcs):
-    """Applies the each func on the metrics in a chain"""
+import logging
 
-    def composite_processor(host, name, val, timestamp):
+from mist.bucky_extras.processors.batch import BatchProcessor
+from mist.bucky_extras.processors.batch import as_batch_processor
+
+
+log = logging.getLogger(__name__)
+
+
+class CompositeProcessor(BatchProcessor):
+    """Applies each processor on the samples in a chain
+
+    Supports both the per-sample and the batch protocol (see
+    mist.bucky_extras.processors.batch), whatever the protocol of each
+    processor in the chain.
+
+    If a stage fails on a batch, only that stage is retried one sample at a
+    time on its input (see run_stage) and the rest of the chain goes on in
+    batch, so that stages that already ran on the batch don't see its samples
+    twice. Samples the stage still fails on are dropped if drop_on_error is
+    set (BatchCustomProcessor sets it from bucky's processor_drop_on_error),
+    else they skip that stage.
+
+    """
+
+    drop_on_error = False
+
+    def __init__(self, *funcs):
+        self.funcs = funcs
+        self.stages = [as_batch_processor(func) for func in funcs]
+
+    def __call__(self, host, name, val, timestamp):
         tmp = host, name, val, timestamp
-        for func in funcs:
+        for func in self.funcs:
             tmp = func(*tmp)
             if tmp is None:
                 break
         return tmp
-    return composite_processor
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        columns = hosts, names, vals, timestamps
+        for stage in self.stages:
+            if not columns[0]:
+                break
+            columns = self.run_stage(stage, columns)
+        return columns
+
+    def run_stage(self, stage, columns):
+        """Return stage's output, replaying samples one by one on error."""
+        try:
+            return stage.process_batch(*columns)
+        except Exception as exc:
+            log.error("Error processing batch of %d samples in %r, retrying "
+                      "one by one: %r", len(columns[0]), stage, exc)
+        out = [], [], [], []
+        for sample in zip(*columns):
+            try:
+                sample = stage(*sample)
+            except Exception as exc:
+                log.error("Error processing sample %s: %r", sample, exc)
+                if self.drop_on_error:
+                    continue
+            if sample is not None:
+                for column, item in zip(out, sample):
+                    column.append(item)
+        return out
+
+
+def gen_composite_processor(*funcs, **kwargs):
+    """Applies the each func on the metrics in a chain
+
+    If a profile_sink is given, per stage stats are sent to it every
+    profile_interval seconds, named after profile_instance (see
+    ProfiledCompositeProcessor).
+
+    """
+    sink = kwargs.pop('profile_sink', None)
+    interval = kwargs.pop('profile_interval', 60)
+    instance = kwargs.pop('profile_instance', "bucky")
+    if kwargs:
+        raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+    if sink is None:
+        return CompositeProcessor(*funcs)
+    from mist.bucky_extras.processors.profiling import \
+        ProfiledCompositeProcessor
+    return ProfiledCompositeProcessor(funcs, sink, interval=interval,
+                                      instance=instance)
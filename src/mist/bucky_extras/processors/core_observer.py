@@ -1,60 +1,190 @@
+import os
+import sys
 import time
 import json
+import errno
+import socket
 import Queue
 import logging
 import requests
+import requests.adapters
 import threading
 import multiprocessing
+from collections import deque
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 from bucky.names import statname
 
+from mist.bucky_extras.fpset import FingerprintSet
+from mist.bucky_extras.metrics_store import MetricsStore
+from mist.bucky_extras.processors.batch import BatchProcessor
 from mist.monitor import config as mon_config
 from mist.monitor.graphite import MultiHandler
 from mist.monitor.model import get_machine_from_uuid
+from mist.monitor.metadata import update_from_names
 
 
 log = logging.getLogger(__name__)
 
 
-class NewMetricsObserver(object):
-    def __init__(self, path=""):
-        self.metrics = set()
-        self.queue = multiprocessing.Queue()
+class NewMetricsObserver(BatchProcessor):
+    """Notify core of new metrics.
+
+    By default, new metrics are deduplicated and dispatched to core by a
+    thread of this process. If discovery is given, new metrics are instead
+    sent to the discovery service listening on that unix socket (see
+    DiscoveryService), which deduplicates metrics of all bucky processes of
+    the node, so that each metric is dispatched exactly once. Path may then
+    point to the metrics store written by the discovery service: it is only
+    read, to skip metrics already dispatched before a restart.
+
+    """
+
+    def __init__(self, path="", capacity=1 << 20, discovery=""):
+        # (host, name) of metrics already seen
         if path:
             # load metrics from file (to persist restart of bucky)
-            try:
-                f = open(path)
-            except IOError as exc:
-                log.warning("Error opening metrics file: %s", exc)
-            else:
-                for line in f:
-                    line = line.strip()
-                    parts = line.split()
-                    if len(parts) == 2:
-                        host, name = map(str.strip, parts)
-                        self.metrics.add((host, name))
-                    else:
-                        log.error("Invalid line in '%s': '%s'", path, line)
-                log.info("Loaded %d metrics from file", len(self.metrics))
-                f.close()
+            self.metrics = MetricsStore(path, capacity)
         else:
             log.warning("No path configured to persist discovered metrics")
-        self.dispatcher = NewMetricsDispatcher(self.queue, path=path, flush=1)
+            self.metrics = FingerprintSet(capacity)
+        if discovery:
+            self.queue = DiscoveryClient(discovery)
+            return
+        self.queue = multiprocessing.Queue()
+        self.dispatcher = NewMetricsDispatcher(
+            self.queue, store=self.metrics if path else None, flush=1
+        )
         self.dispatcher.start()
 
     def __call__(self, host, name, val, timestamp):
         if (host, name) not in self.metrics:
             try:
                 self.queue.put((host, name), block=False)
+            except DiscoveryUnavailable:
+                pass  # logged by DiscoveryClient
             except Queue.Full:
                 log.warning("Queue full while pushing new metric.")
             else:
                 self.metrics.add((host, name))
         return host, name, val, timestamp
 
+    def process_batch(self, hosts, names, vals, timestamps):
+        metrics = self.metrics
+        for key in izip(hosts, names):
+            if key not in metrics:
+                try:
+                    self.queue.put(key, block=False)
+                except DiscoveryUnavailable:
+                    pass  # logged by DiscoveryClient
+                except Queue.Full:
+                    log.warning("Queue full while pushing new metric.")
+                else:
+                    metrics.add(key)
+        return hosts, names, vals, timestamps
+
+
+class DiscoveryUnavailable(Queue.Full):
+    """Raised by DiscoveryClient.put, which already logged the failure."""
+
+
+class DiscoveryClient(object):
+    """Queue like interface sending new metrics to the discovery service.
+
+    Sends that fail, eg while mist-discovery is down or restarting, are
+    retried the next time the metric is seen. Since that happens for every
+    sample of unseen metrics, failures are logged at most once every
+    log_interval seconds, along with the number of sends dropped since.
+
+    """
+
+    log_interval = 60  # seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.dropped = 0  # sends failed since last logged
+        self.logged_at = 0
+
+    def put(self, (host, name), block=False):
+        try:
+            self.sock.sendto("%s %s" % (host, name), self.path)
+        except socket.error as exc:
+            self.dropped += 1
+            now = time.time()
+            if now - self.logged_at >= self.log_interval:
+                level = logging.WARNING if exc.errno in (
+                    errno.EAGAIN, errno.ENOBUFS) else logging.ERROR
+                log.log(level, "Error sending metrics to discovery service, "
+                        "%d sends dropped: %r", self.dropped, exc)
+                self.dropped = 0
+                self.logged_at = now
+            raise DiscoveryUnavailable()
+
+
+class DiscoveryService(object):
+    """Deduplicate new metrics of all bucky processes of a node
+
+    Listens for "<host> <name>" datagrams on a unix socket, and dispatches
+    metrics not seen before to core, appending them to the metrics store
+    (see NewMetricsDispatcher and MetricsStore). Run a single instance per node with
+    `mist-discovery <socket> <metrics file>` and configure all observers with
+    the same socket.
+
+    """
+
+    def __init__(self, path, metrics_path="", capacity=1 << 20):
+        self.path = path
+        if metrics_path:
+            self.metrics = MetricsStore(metrics_path, capacity)
+        else:
+            self.metrics = FingerprintSet(capacity)
+        self.queue = Queue.Queue()
+        self.dispatcher = NewMetricsDispatcher(
+            self.queue, store=self.metrics if metrics_path else None, flush=1
+        )
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+    def serve_forever(self):
+        self.dispatcher.start()
+        log.info("Listening for new metrics on '%s'", self.path)
+        while True:
+            self.handle(self.sock.recv(4096))
+
+    def handle(self, data):
+        """Queue metric of a "<host> <name>" datagram, unless already seen."""
+        parts = data.split()
+        if len(parts) != 2:
+            log.error("Invalid new metric: '%s'", data)
+            return
+        key = tuple(parts)
+        if key not in self.metrics:
+            self.metrics.add(key)
+            self.queue.put(key)
+
 
 class NewMetricsDispatcher(threading.Thread):
-    def __init__(self, queue, path="", flush=5):
+    """Notify core of new metrics, in batches of many hosts
+
+    New (host, name) pairs are read from the queue and kept as pending until
+    core accepts them. Every flush seconds, pending hosts are sent to core in
+    batches of NEW_METRICS_BATCH_SIZE hosts, in parallel per host requests
+    (or in a single request per batch to the experimental bulk endpoint, if
+    NEW_METRICS_BULK is set), all over a pool of keep-alive connections.
+    Batches that fail are retried with exponential backoff. Hosts rejected by
+    core, unauthorized ones included, and hosts without a collectd password
+    are dropped and counted. Metrics are appended to the metrics store once
+    core has accepted them, and the store is compacted as needed. Dropped
+    metrics are not, so they are dispatched again after a restart.
+
+    """
+
+    def __init__(self, queue, store=None, flush=5):
         super(NewMetricsDispatcher, self).__init__()
         self.queue = queue
         self.daemon = True
@@ -63,12 +193,22 @@ class NewMetricsDispatcher(threading.Thread):
             "cpu", "df", "md", "thermal", "disk", "entropy", "interface",
             "load", "memory", "processes", "swap", "users", "ping", "network",
         ])
-        self.fh = None
-        if path:
-            try:
-                self.fh = open(path, 'a')
-            except IOError as exc:
-                log.error("Error opening metrics file for writing!")
+        self.store = store
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=mon_config.NEW_METRICS_THREADS
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPool(mon_config.NEW_METRICS_THREADS)
+        self.passwords = {}  # uuid -> (collectd password, time fetched)
+        self.pending = {}  # host -> list of new names not yet sent to core
+        self.failures = 0  # consecutive failed batches
+        self.retry_at = 0
+        self.latencies = deque(maxlen=100)  # of recent batches
+        self.counters = {'received': 0, 'dispatched': 0, 'dropped': 0,
+                         'batches': 0, 'failed_batches': 0}
+        self.stats_logged_at = time.time()
 
     def run(self):
         while True:
@@ -77,33 +217,82 @@ class NewMetricsDispatcher(threading.Thread):
                 self.run_once()
             except Exception as exc:
                 log.error("Error in NewMetrisDispatcher: %r", exc)
+            if self.store is not None and self.store.needs_compaction():
+                try:
+                    self.store.compact()
+                except Exception as exc:
+                    log.error("Error compacting metrics store: %r", exc)
+            if time.time() - self.stats_logged_at > 60:
+                log.info("NewMetricsDispatcher stats: %s", self.get_stats())
+                self.stats_logged_at = time.time()
             elapsed = time.time() - start
             remaining = self.flush - elapsed
             if remaining > 0:
                 time.sleep(remaining)
 
+    def get_stats(self):
+        try:
+            queue_depth = self.queue.qsize()
+        except NotImplementedError:
+            queue_depth = None
+        latencies = sorted(self.latencies)
+        stats = dict(self.counters)
+        stats.update({
+            'queue_depth': queue_depth,
+            'pending_hosts': len(self.pending),
+            'pending_metrics': sum(map(len, self.pending.values())),
+            'latency_p50': latencies[len(latencies) / 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+        })
+        return stats
+
     def run_once(self):
-        """Read and parse entire queue and notify core."""
-        new_names = {}
-        counter = 0
+        """Read entire queue and notify core of all pending metrics."""
+        received = {}  # host -> names read from the queue in this run
         while True:
             try:
                 host, name = self.queue.get(block=False)
             except Queue.Empty:
                 break
-            if host not in new_names:
-                new_names[host] = []
-            new_names[host].append(name)
-            counter += 1
+            received.setdefault(host, []).append(name)
+            self.counters['received'] += 1
+        for host, names in received.iteritems():
+            # recorded once, not on every retry of the batch
+            try:
+                update_from_names(host, names)
+            except Exception as exc:
+                log.error("Error updating metadata of %s: %r", host, exc)
+            self.pending.setdefault(host, []).extend(names)
 
-        for host, names in new_names.items():
-            self.dispatch(host, names)
+        if not self.pending or time.time() < self.retry_at:
+            return
+        hosts = self.pending.keys()
+        size = mon_config.NEW_METRICS_BATCH_SIZE
+        for i in xrange(0, len(hosts), size):
+            if not self.dispatch_batch(hosts[i:i + size]):
+                self.failures += 1
+                backoff = min(self.flush * 2 ** self.failures, 300)
+                log.warning("Will retry %d pending hosts in %d seconds",
+                            len(self.pending), backoff)
+                self.retry_at = time.time() + backoff
+                return
+        self.failures = 0
 
-    def dispatch(self, host, names):
-        machine = get_machine_from_uuid(host)
+    def get_password(self, uuid):
+        """Return machine's collectd password, cached for a while."""
+        cached = self.passwords.get(uuid)
+        if cached and time.time() - cached[1] < \
+                mon_config.NEW_METRICS_PASSWORD_TTL:
+            return cached[0]
+        machine = get_machine_from_uuid(uuid)
         if not machine:
-            log.error("machine not found, wtf!")
+            self.passwords.pop(uuid, None)
             return
+        self.passwords[uuid] = (machine.collectd_password, time.time())
+        return machine.collectd_password
+
+    def get_payload(self, host, names, password):
+        """Return core's payload for host's new names or None."""
         multihandler = MultiHandler(host)
         metrics = []
         for name in names:
@@ -117,27 +306,96 @@ class NewMetricsDispatcher(threading.Thread):
         if not metrics:
             return
         log.info("New metrics for host %s, notifying core: %s", host, metrics)
-        payload = {
+        return {
             'uuid': host,
-            'collectd_password': machine.collectd_password,
+            'collectd_password': password,
             'metrics': metrics,
         }
+
+    def post(self, url, payload):
+        """POST payload to core, return True, False or None to retry."""
         try:
-            resp = requests.post(
-                "%s/new_metrics" % mon_config.CORE_URI,
-                data=json.dumps(payload),
-                verify=mon_config.SSL_VERIFY
-            )
+            resp = self.session.post(url, data=json.dumps(payload),
+                                     verify=mon_config.SSL_VERIFY)
         except Exception as exc:
             log.error("Error notifying core: %r", exc)
             return
+        if resp.status_code in (401, 403):
+            # retrying with the same password won't help
+            log.error("Unauthorized by core, will refetch passwords")
+            for item in payload.get('machines', [payload]):
+                self.passwords.pop(item['uuid'], None)
+            return False
+        if resp.status_code >= 500:
+            log.error("Bad response from core: %s", resp.text)
+            return
         if not resp.ok:
+            # retrying won't help
             log.error("Bad response from core: %s", resp.text)
+            return False
+        return True
+
+    def dispatch_batch(self, hosts):
+        """Notify core of pending metrics of hosts, return False to retry."""
+        started_at = time.time()
+        payloads = []
+        hosts = list(hosts)
+        for host in list(hosts):
+            password = self.get_password(host)
+            if not password:
+                log.error("No collectd password for machine %s, dropping %d "
+                          "new metrics", host, len(self.pending[host]))
+                self.drop(host)
+                hosts.remove(host)
+                continue
+            payload = self.get_payload(host, self.pending[host], password)
+            if payload is not None:
+                payloads.append(payload)
+        results = {}  # uuid -> True, False to drop or None to retry
+        if payloads and mon_config.NEW_METRICS_BULK:
+            ok = self.post("%s/new_metrics/bulk" % mon_config.CORE_URI,
+                           {'machines': payloads})
+            results = dict((payload['uuid'], ok) for payload in payloads)
+        elif payloads:
+            url = "%s/new_metrics" % mon_config.CORE_URI
+            oks = self.pool.map(lambda payload: self.post(url, payload),
+                                payloads)
+            results = dict((payload['uuid'], ok)
+                           for payload, ok in zip(payloads, oks))
+        done = []
+        for host in hosts:
+            ok = results.get(host, True)
+            if ok:
+                self.save(host, self.pending.pop(host))
+                done.append(host)
+            elif ok is False:
+                self.drop(host)
+                done.append(host)
+        self.counters['batches'] += 1
+        self.latencies.append(time.time() - started_at)
+        if len(done) < len(hosts):
+            self.counters['failed_batches'] += 1
+            return False
+        return True
+
+    def drop(self, host):
+        self.counters['dropped'] += len(self.pending.pop(host))
+
+    def save(self, host, names):
+        self.counters['dispatched'] += len(names)
         # also save to file in disk
-        if self.fh is not None:
+        if self.store is not None:
             try:
-                for name in names:
-                    self.fh.write("%s %s\n" % (host, name))
-                self.fh.flush()
+                self.store.append(host, names)
             except IOError as exc:
                 log.error("Error writing to metrics file: %s", exc)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)-15s][%(levelname)s] %(module)s - %(message)s'
+    )
+    if len(sys.argv) not in (2, 3):
+        sys.exit("Usage: mist-discovery <socket> [<metrics file>]")
+    DiscoveryService(*sys.argv[1:]).serve_forever()
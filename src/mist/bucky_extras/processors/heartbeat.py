@@ -0,0 +1,77 @@
+import os
+import time
+import logging
+
+from mist.monitor.shm_table import SharedTable, fingerprint
+from mist.monitor.shm_table import EXPIRE_SLOTS
+from mist.monitor.heartbeat import STARTED_KEY
+from mist.bucky_extras.processors.batch import BatchProcessor
+
+
+log = logging.getLogger(__name__)
+
+
+class HeartbeatRecorder(BatchProcessor):
+    """Record the last time each host sent a sample
+
+    Last seen timestamps are stored in a SharedTable keyed by the host's
+    fingerprint, and are read by mist.monitor (see mist.monitor.heartbeat)
+    to evaluate nodata rules without querying graphite. The table is written
+    at most once per second per host. Hosts not seen for max_age seconds are
+    dropped from the table, a chunk of it every second, and are then reported
+    as never seen, which is still nodata.
+
+    """
+
+    def __init__(self, path='conf/heartbeat.shm', slots=1 << 16,
+                 max_age=7 * 24 * 3600):
+        self.path = path
+        self.slots = slots
+        self.max_age = max_age
+        self._table = None
+        self._pid = None
+        self._written = {}  # host -> last second written to the table
+        self._expired_at = 0
+
+    @property
+    def table(self):
+        if self._table is None or self._pid != os.getpid():
+            self._table = SharedTable(self.path, "d", self.slots)
+            self._pid = os.getpid()
+            self._written = {}
+            if not self._table.get(STARTED_KEY, (0, ))[0]:
+                self._table.set(STARTED_KEY, time.time())
+        return self._table
+
+    def expire(self, now):
+        """Drop hosts not seen for max_age, a chunk of the table per second."""
+        if self.max_age and now - self._expired_at >= 1:
+            self._expired_at = now
+            cutoff = now - self.max_age
+            if self.table.expire(
+                    lambda key, values: (key != STARTED_KEY and
+                                         values[0] < cutoff),
+                    EXPIRE_SLOTS):
+                # forget dropped hosts
+                self._written = dict((host, second) for host, second
+                                     in self._written.iteritems()
+                                     if second >= cutoff)
+
+    def beat(self, host, now):
+        second = int(now)
+        if self._written.get(host) != second:
+            self._written[host] = second
+            self.table.set(fingerprint(host), now)
+
+    def __call__(self, host, name, val, timestamp):
+        now = time.time()
+        self.expire(now)
+        self.beat(host, now)
+        return host, name, val, timestamp
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        now = time.time()
+        self.expire(now)
+        for host in set(hosts):
+            self.beat(host, now)
+        return hosts, names, vals, timestamps
@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+from itertools import izip
+
+from mist.monitor.shm_table import SharedTable, fingerprint
+from mist.monitor.shm_table import EXPIRE_SLOTS
+from mist.bucky_extras.processors.batch import BatchProcessor
+
+
+log = logging.getLogger(__name__)
+
+
+class LastValueRecorder(BatchProcessor):
+    """Keep the latest value and timestamp of each metric in shared memory
+
+    Values are stored in a SharedTable (see mist.monitor.shm_table) keyed by
+    the fingerprint of (host, name), from which mist.monitor serves current
+    values without querying graphite (see methods.get_last_values). Only
+    metrics whose names start with one of prefixes are recorded, or all if
+    prefixes is None. Place it after TimeConverter, so that timestamps have
+    already been fixed.
+
+    It can also be used as a sink (eg teed with the carbon sink of
+    TotalsAggregator), so that computed series are recorded as well.
+
+    Metrics not updated for max_age seconds are dropped from the table, a
+    chunk of it every second. While the table is full, new metrics are
+    refused (see SharedTable) and remembered, so that they don't have to be
+    looked up again for every sample until some space is freed.
+
+    """
+
+    def __init__(self, path='conf/last_values.shm', slots=1 << 20,
+                 prefixes=None, max_age=24 * 3600):
+        self.path = path
+        self.slots = slots
+        self.prefixes = tuple(prefixes) if prefixes is not None else None
+        self.max_age = max_age
+        self._table = None
+        self._pid = None
+        self._refused = set()  # fingerprints that didn't fit in the table
+        self._expired_at = 0
+
+    @property
+    def table(self):
+        if self._table is None or self._pid != os.getpid():
+            self._table = SharedTable(self.path, "dd", self.slots)
+            self._pid = os.getpid()
+            self._refused = set()
+        return self._table
+
+    def expire(self, now):
+        """Drop metrics older than max_age, a chunk of the table per second."""
+        if self.max_age and now - self._expired_at >= 1:
+            self._expired_at = now
+            cutoff = now - self.max_age
+            if self.table.expire(lambda key, values: values[1] < cutoff,
+                                 EXPIRE_SLOTS):
+                self._refused.clear()  # they may fit now
+
+    def send(self, host, name, val, timestamp):
+        if self.prefixes is None or name.startswith(self.prefixes):
+            key = fingerprint(host, name)
+            if key not in self._refused and \
+                    not self.table.set(key, val, timestamp):
+                self._refused.add(key)
+
+    def __call__(self, host, name, val, timestamp):
+        self.expire(time.time())
+        self.send(host, name, val, timestamp)
+        return host, name, val, timestamp
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        self.expire(time.time())
+        send = self.send
+        for sample in izip(hosts, names, vals, timestamps):
+            send(*sample)
+        return hosts, names, vals, timestamps
@@ -0,0 +1,137 @@
+import time
+import logging
+
+from mist.bucky_extras.fpset import FingerprintSet
+from mist.bucky_extras.processors.batch import BatchProcessor, select
+
+
+log = logging.getLogger(__name__)
+
+
+class HostLimiter(BatchProcessor):
+    """Drop samples of hosts with too many distinct metrics or samples
+
+    Each host may send at most max_metrics distinct metric names and
+    max_rate samples per second, averaged over burst seconds. Samples over
+    these limits are dropped, so that a misconfigured host can't create
+    endless whisper files or flood NewMetricsDispatcher. Place it before
+    NewMetricsObserver in the chain.
+
+    Distinct names are tracked in a FingerprintSet that is reset every window
+    seconds, so that names no longer sent stop counting against the host's
+    limit, while names still sent register again as soon as they're seen.
+    Rates are enforced with a token bucket per host. Buckets that have
+    refilled are dropped every report_interval seconds, as a new bucket
+    starts full anyway, so that only hosts sending lately are tracked.
+
+    Rejected samples are counted per host and logged every report_interval
+    seconds. If a sink is given (see mist.bucky_extras.carbon), they're also
+    sent to it as limiter.<host>.rejected_{metrics,rate} internal metrics.
+
+    """
+
+    def __init__(self, max_metrics=10000, max_rate=1000, burst=10,
+                 window=24 * 60 * 60, sink=None, report_interval=60):
+        self.max_metrics = max_metrics
+        self.max_rate = max_rate
+        self.burst = burst
+        self.window = window
+        self.sink = sink
+        self.report_interval = report_interval
+        self.seen = FingerprintSet()  # (host, name) seen in this window
+        self.counts = {}  # host -> distinct names seen in this window
+        self.buckets = {}  # host -> [tokens, time of last refill]
+        self.rejected = {}  # host -> [over max_metrics, over max_rate]
+        self.rotated_at = self.reported_at = time.time()
+
+    def rotate(self, now):
+        self.seen = FingerprintSet()
+        self.counts = {}
+        self.rotated_at = now
+        self.prune(now)
+
+    def prune(self, now):
+        """Drop token buckets that have refilled to full since last used."""
+        full = self.max_rate * self.burst
+        for host, (tokens, refilled_at) in self.buckets.items():
+            if tokens + (now - refilled_at) * self.max_rate >= full:
+                del self.buckets[host]
+
+    def allow(self, host, name, now):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = [self.max_rate * self.burst, now]
+        elif bucket[1] != now:
+            bucket[0] = min(bucket[0] + (now - bucket[1]) * self.max_rate,
+                            self.max_rate * self.burst)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.reject(host, 1)
+            return False
+        key = (host, name)
+        if key not in self.seen:
+            count = self.counts.get(host, 0)
+            if count >= self.max_metrics:
+                self.reject(host, 0)
+                return False
+            self.seen.add(key)
+            self.counts[host] = count + 1
+            if count + 1 == self.max_metrics:
+                log.warning("Host '%s' reached %d distinct metrics",
+                            host, self.max_metrics)
+        bucket[0] -= 1
+        return True
+
+    def reject(self, host, reason):
+        if host not in self.rejected:
+            self.rejected[host] = [0, 0]
+        self.rejected[host][reason] += 1
+
+    def __call__(self, host, name, val, timestamp):
+        now = time.time()
+        self.maintain(now)
+        if self.allow(host, name, now):
+            return host, name, val, timestamp
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        now = time.time()
+        self.maintain(now)
+        allow = self.allow
+        keep = [i for i, host in enumerate(hosts)
+                if allow(host, names[i], now)]
+        if len(keep) == len(hosts):
+            return hosts, names, vals, timestamps
+        return select(keep, hosts, names, vals, timestamps)
+
+    def maintain(self, now):
+        if now - self.rotated_at > self.window:
+            self.rotate(now)
+        if now - self.reported_at > self.report_interval:
+            self.report(now)
+            self.prune(now)
+
+    def get_stats(self):
+        """Return {host: {'rejected_metrics': n, 'rejected_rate': n}}."""
+        return dict((host, {'rejected_metrics': metrics,
+                            'rejected_rate': rate})
+                    for host, (metrics, rate) in self.rejected.iteritems())
+
+    def report(self, now):
+        self.reported_at = now
+        stats, self.rejected = self.get_stats(), {}
+        for host, counters in sorted(stats.items()):
+            log.warning("Host '%s' over limits, dropped %d samples of new "
+                        "metrics and %d samples over rate", host,
+                        counters['rejected_metrics'],
+                        counters['rejected_rate'])
+        if self.sink is None:
+            return
+        try:
+            for host, counters in stats.iteritems():
+                for name, value in counters.iteritems():
+                    self.sink.send("", "limiter.%s.%s" % (host, name),
+                                   value, int(now))
+            if hasattr(self.sink, 'flush'):
+                self.sink.flush()
+        except Exception as exc:
+            log.error("Error reporting rejected samples: %r", exc)
@@ -0,0 +1,127 @@
+"""Per stage profiling of composite processors
+
+ProfiledCompositeProcessor records, for each processor in the chain, the
+number of calls, of samples processed and dropped, the cumulative time spent
+and a histogram of call latencies, sampled once every sample_every calls.
+
+Every interval seconds, the stats collected since the last report are sent
+to a sink (see mist.bucky_extras.carbon) as internal metrics named
+
+    processors.<instance>.<index>_<stage>.{calls,samples,dropped,time_us}
+    processors.<instance>.<index>_<stage>.latency.le_<N>us
+
+where instance is the configured name of the bucky instance (set a distinct
+one per instance running on the node), so names survive restarts. Use it
+through gen_composite_processor(..., profile_sink=sink,
+profile_instance="bucky").
+
+"""
+
+import time
+import bisect
+import logging
+
+from mist.bucky_extras.processors.composite import CompositeProcessor
+
+
+log = logging.getLogger(__name__)
+
+
+class StageProfile(object):
+
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)  # in us
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.samples = 0
+        self.dropped = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def record(self, seconds, samples, kept, sampled=False):
+        self.calls += 1
+        self.samples += samples
+        self.dropped += samples - kept
+        self.seconds += seconds
+        if sampled:
+            index = bisect.bisect_left(self.buckets, seconds * 1e6)
+            self.histogram[index] += 1
+
+    def metrics(self):
+        """Return (name, value) pairs of the stats since last reset."""
+        metrics = [('calls', self.calls), ('samples', self.samples),
+                   ('dropped', self.dropped),
+                   ('time_us', int(self.seconds * 1e6))]
+        for bucket, count in zip(self.buckets + ('inf', ),
+                                 self.histogram):
+            metrics.append(('latency.le_%sus' % bucket, count))
+        return metrics
+
+
+class ProfiledCompositeProcessor(CompositeProcessor):
+
+    def __init__(self, funcs, sink, interval=60, sample_every=64, host="",
+                 instance="bucky"):
+        super(ProfiledCompositeProcessor, self).__init__(*funcs)
+        self.sink = sink
+        self.instance = instance
+        self.interval = interval
+        self.sample_every = sample_every
+        self.host = host
+        self.profiles = [
+            StageProfile("%d_%s" % (i, getattr(func, '__name__',
+                                               func.__class__.__name__)))
+            for i, func in enumerate(funcs)
+        ]
+        self.counter = 0
+        self.reported_at = time.time()
+
+    def __call__(self, host, name, val, timestamp):
+        self.counter += 1
+        sampled = not self.counter % self.sample_every
+        tmp = host, name, val, timestamp
+        for func, profile in zip(self.funcs, self.profiles):
+            started_at = time.time()
+            tmp = func(*tmp)
+            profile.record(time.time() - started_at, 1, tmp is not None,
+                           sampled)
+            if tmp is None:
+                break
+        self.maybe_report()
+        return tmp
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        self.counter += 1
+        sampled = not self.counter % self.sample_every
+        columns = hosts, names, vals, timestamps
+        for stage, profile in zip(self.stages, self.profiles):
+            if not columns[0]:
+                break
+            samples = len(columns[0])
+            started_at = time.time()
+            columns = self.run_stage(stage, columns)
+            profile.record(time.time() - started_at, samples,
+                           len(columns[0]), sampled)
+        self.maybe_report()
+        return columns
+
+    def maybe_report(self):
+        now = time.time()
+        if now - self.reported_at < self.interval:
+            return
+        self.reported_at = now
+        prefix = "processors.%s" % self.instance
+        try:
+            for profile in self.profiles:
+                for name, value in profile.metrics():
+                    self.sink.send(self.host, "%s.%s.%s" % (
+                        prefix, profile.name, name), value, int(now))
+                profile.reset()
+            if hasattr(self.sink, 'flush'):
+                self.sink.flush()
+        except Exception as exc:
+            log.error("Error reporting processor profiles: %r", exc)
@@ -1,11 +1,17 @@
+import os
 import logging
 from time import time
+from itertools import izip
+
+from mist.monitor.shm_table import SharedTable, fingerprint
+from mist.monitor.shm_table import EXPIRE_SLOTS
+from mist.bucky_extras.processors.batch import BatchProcessor, select
 
 
 log = logging.getLogger(__name__)
 
 
-class TimeDiff(object):
+class TimeDiff(BatchProcessor):
     """Drop all samples with timestamp far away in the past or future."""
 
     def __init__(self, past=None, future=None):
@@ -22,8 +28,18 @@ class TimeDiff(object):
             return None
         return host, name, val, timestamp
 
+    def process_batch(self, hosts, names, vals, timestamps):
+        now = time()
+        future = self.future if self.future is not None else float('inf')
+        past = -self.past if self.past is not None else float('-inf')
+        keep = [i for i, timestamp in enumerate(timestamps)
+                if past <= round(timestamp - now) <= future]
+        if len(keep) == len(timestamps):
+            return hosts, names, vals, timestamps
+        return select(keep, hosts, names, vals, timestamps)
+
 
-class TimeConverter(object):
+class TimeConverter(BatchProcessor):
     """Fix timestamps on samples
 
     Observe the apparent time offset per host and fixes timestamps accordingly.
@@ -73,6 +89,25 @@ class TimeConverter(object):
         timestamp -= known_offset
         return host, name, val, timestamp
 
+    def process_batch(self, hosts, names, vals, timestamps):
+        now = time()
+        known_offsets = {}  # offsets of hosts seen in this batch
+        fixed = []
+        for host, timestamp in izip(hosts, timestamps):
+            offset = int(round(timestamp - now))
+            known_offset = known_offsets.get(host)
+            if known_offset is None:
+                known_offset = self.get_offset(host)
+            if offset > known_offset or \
+                    known_offset - offset > self.max_delay:
+                self.set_offset(host, offset)
+                log.info("Host '%s': offset changed from %d to %d.",
+                         host, known_offset, offset)
+                known_offset = offset
+            known_offsets[host] = known_offset
+            fixed.append(timestamp - known_offset)
+        return hosts, names, vals, fixed
+
     def get_offset(self, host):
         raise NotImplementedError
 
@@ -93,3 +128,66 @@ class TimeConverterSingleThread(TimeConverter):
     def set_offset(self, host, offset):
         self._offset_map[host] = offset
 
+
+class TimeConverterSharedMemory(TimeConverter):
+    """Stores the cached offsets in a SharedTable backed by a file.
+
+    All processes using the same path share the same offsets, so bucky's
+    workers agree on each host's offset, and offsets are kept across restarts.
+    The table is opened lazily, so that each process maps it after forking.
+
+    Along with its offset, the time each host was last seen is stored (at
+    most once per touch_interval), and hosts not seen for max_age seconds are
+    dropped from the table, a chunk of it every second, so that machines that
+    come and go don't fill it up.
+
+    """
+
+    touch_interval = 3600  # seconds
+
+    def __init__(self, max_delay, path='conf/time_offsets.shm', slots=1 << 16,
+                 max_age=7 * 24 * 3600):
+        super(TimeConverterSharedMemory, self).__init__(max_delay)
+        self.path = path
+        self.slots = slots
+        self.max_age = max_age
+        self._table = None
+        self._pid = None
+        self._expired_at = 0
+
+    @property
+    def table(self):
+        if self._table is None or self._pid != os.getpid():
+            self._table = SharedTable(self.path, "ii", self.slots)
+            self._pid = os.getpid()
+        return self._table
+
+    def get_offset(self, host):
+        key = fingerprint(host)
+        offset, seen = self.table.get(key, (0, 0))
+        if seen:
+            now = int(time())
+            if now - seen >= self.touch_interval:
+                self.table.set(key, offset, now)
+        return offset
+
+    def set_offset(self, host, offset):
+        self.table.set(fingerprint(host), offset, int(time()))
+
+    def expire(self, now):
+        """Drop hosts not seen for max_age, a chunk of the table per second."""
+        if self.max_age and now - self._expired_at >= 1:
+            self._expired_at = now
+            cutoff = now - self.max_age
+            self.table.expire(lambda key, values: values[1] < cutoff,
+                              EXPIRE_SLOTS)
+
+    def __call__(self, host, name, val, timestamp):
+        self.expire(time())
+        return super(TimeConverterSharedMemory, self).__call__(
+            host, name, val, timestamp)
+
+    def process_batch(self, hosts, names, vals, timestamps):
+        self.expire(time())
+        return super(TimeConverterSharedMemory, self).process_batch(
+            hosts, names, vals, timestamps)
@@ -0,0 +1,111 @@
+"""Size capped, segment based spool of carbon plaintext lines
+
+Data is appended to numbered segment files in a directory, starting a new
+segment once the current one exceeds segment_bytes. Data is read back in
+order from the oldest segment, and segments are deleted once fully read.
+If the spool grows over max_bytes, the oldest segments are dropped.
+
+The read position is persisted in the directory, so that spooled data
+survives restarts and is only replayed once (as long as commit() is called
+after the data read has been handled).
+
+"""
+
+import os
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Spool(object):
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(filename.split('.')[0])
+                               for filename in os.listdir(directory)
+                               if filename.endswith('.spool'))
+        self.sizes = dict((seq, os.path.getsize(self.segment_path(seq)))
+                          for seq in self.segments)
+        self.fh = None
+        self.read_seq, self.read_offset = self.load_position()
+        if self.segments and self.read_seq not in self.sizes:
+            self.read_seq, self.read_offset = self.segments[0], 0
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, "%012d.spool" % seq)
+
+    def load_position(self):
+        try:
+            with open(os.path.join(self.directory, 'position')) as f:
+                seq, offset = map(int, f.read().split())
+                return seq, offset
+        except (IOError, ValueError):
+            return 0, 0
+
+    def save_position(self):
+        path = os.path.join(self.directory, 'position')
+        with open(path + '.tmp', 'w') as f:
+            f.write("%d %d\n" % (self.read_seq, self.read_offset))
+        os.rename(path + '.tmp', path)
+
+    def depth(self):
+        """Return the number of bytes not yet read."""
+        return sum(self.sizes.values()) - self.read_offset if self.segments \
+            else 0
+
+    def append(self, data):
+        if self.fh is None or self.sizes[self.segments[-1]] > \
+                self.segment_bytes:
+            if self.fh is not None:
+                self.fh.close()
+            seq = self.segments[-1] + 1 if self.segments else 1
+            self.segments.append(seq)
+            self.sizes[seq] = 0
+            self.fh = open(self.segment_path(seq), 'a')
+            if len(self.segments) == 1:
+                self.read_seq, self.read_offset = seq, 0
+        self.fh.write(data)
+        self.fh.flush()
+        self.sizes[self.segments[-1]] += len(data)
+        while len(self.segments) > 1 and \
+                sum(self.sizes.values()) > self.max_bytes:
+            seq = self.segments[0]
+            log.error("Spool over %d bytes, dropping %d bytes",
+                      self.max_bytes, self.sizes[seq] - self.read_offset)
+            self.remove_segment()
+
+    def remove_segment(self):
+        seq = self.segments.pop(0)
+        del self.sizes[seq]
+        os.unlink(self.segment_path(seq))
+        self.read_seq = self.segments[0] if self.segments else seq + 1
+        self.read_offset = 0
+
+    def read(self, max_bytes):
+        """Return up to max_bytes of whole lines from the read position."""
+        if not self.segments:
+            return ""
+        with open(self.segment_path(self.read_seq)) as f:
+            f.seek(self.read_offset)
+            data = f.read(max_bytes)
+        end = data.rfind("\n") + 1
+        if not end and len(data) == max_bytes:
+            log.error("Line longer than %d bytes in spool", max_bytes)
+        return data[:end]
+
+    def commit(self, nbytes):
+        """Mark nbytes from the read position as handled."""
+        self.read_offset += nbytes
+        if self.read_offset >= self.sizes[self.read_seq]:
+            if len(self.segments) == 1 and self.fh is not None:
+                # everything read, next append starts a new segment
+                self.fh.close()
+                self.fh = None
+            self.remove_segment()
+        self.save_position()
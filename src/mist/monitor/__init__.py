@@ -13,16 +13,21 @@ def main(global_config, **settings):
 
     config = Configurator(root_factory=Root, settings=settings)
     config.scan()
+    config.add_tween('mist.monitor.policy.deadline_tween_factory')
 
     config.add_route('machines', '/machines')
     config.add_route('machine', '/machines/{machine}')
     config.add_route('stats', '/machines/{machine}/stats')
+    config.add_route('bulk_stats', '/stats')
     config.add_route('load', '/load')
     config.add_route('cores', '/cores')
+    config.add_route('last_values', '/last_values')
     config.add_route('find_metrics', '/machines/{machine}/metrics')
     ## config.add_route('rules', '/machines/{machine}/rules')
     config.add_route('rule', '/machines/{machine}/rules/{rule}')
+    config.add_route('bulk_rules', '/rules')
     config.add_route('reset', '/reset')
+    config.add_route('graphite_status', '/status/graphite')
 
 
     app = config.make_wsgi_app()
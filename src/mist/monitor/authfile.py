@@ -0,0 +1,158 @@
+"""Incremental, debounced maintenance of collectd's auth file
+
+bucky authenticates collectd traffic with the uuid/password entries of
+AUTH_FILE_PATH and reloads the whole file whenever it's modified. Instead of
+rebuilding the file from the db on every added or removed machine, changes
+are queued and applied by a background thread of each process, at most once
+every AUTH_FILE_WRITE_INTERVAL seconds. Each write applies all changes queued
+since the last one to the current contents of the file, under a lock shared
+by all processes, so a new machine is authorized within about that interval
+regardless of how many machines are added at once.
+
+"""
+
+import os
+import time
+import errno
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+from mist.monitor import config
+
+
+log = logging.getLogger(__name__)
+
+try:
+    import fcntl
+    CAN_LOCK = True
+except ImportError:
+    log.error("Can't import fcntl module, won't lock collectd.passwd")
+    CAN_LOCK = False
+
+
+@contextmanager
+def locked(path):
+    """Exclude other processes from rewriting the auth file in path."""
+    with open(path + '.lock', 'a') as f:
+        if CAN_LOCK:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def read_entries(path):
+    """Return a dict of the uuid/password entries in the auth file.
+
+    A missing file has no entries, any other error is raised, so that the
+    file is never rewritten from a partial view of it.
+
+    """
+    entries = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if ':' in line:
+                    uuid, password = line.split(':', 1)
+                    entries[uuid.strip()] = password.strip()
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        log.warning("Auth file '%s' doesn't exist yet", path)
+    return entries
+
+
+def write_entries(path, entries):
+    """Atomically replace the auth file with the given entries."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:  # write new auth file to temporary file
+        f.writelines(["%s: %s\n" % (uuid, entries[uuid])
+                      for uuid in sorted(entries)])
+    os.rename(tmp_path, path)  # move tmp file to authfile location
+    os.utime(path, None)  # touch authfile to notify bucky that it changed
+
+
+class AuthFileWriter(object):
+
+    def __init__(self, path, interval=2):
+        self.path = path
+        self.interval = interval
+        self.pending = {}  # uuid -> password, or None to remove it
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.written_at = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set(self, uuid, password):
+        with self.lock:
+            self.pending[uuid] = password
+        self.event.set()
+
+    def remove(self, uuid):
+        self.set(uuid, None)
+
+    def update(self, entries):
+        """Queue many uuid/password changes at once."""
+        with self.lock:
+            self.pending.update(entries)
+        self.event.set()
+
+    def discard(self):
+        """Drop pending changes, eg if the file was rebuilt from the db."""
+        with self.lock:
+            self.pending.clear()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            delay = self.written_at + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.flush()
+            except Exception as exc:
+                log.error("Error updating auth file '%s': %r", self.path, exc)
+                time.sleep(self.interval)
+
+    def flush(self):
+        """Apply pending changes to the auth file."""
+        with self.lock:
+            self.event.clear()
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        self.written_at = time.time()
+        try:
+            with locked(self.path):
+                entries = read_entries(self.path)
+                for uuid, password in pending.iteritems():
+                    if password is None:
+                        entries.pop(uuid, None)
+                    else:
+                        entries[uuid] = password
+                write_entries(self.path, entries)
+        except:
+            # retry with changes queued in the meantime taking precedence
+            with self.lock:
+                pending.update(self.pending)
+                self.pending = pending
+            self.event.set()
+            raise
+        log.info("Applied %d changes to auth file '%s'",
+                 len(pending), self.path)
+
+
+_writers = {}  # pid -> AuthFileWriter, started lazily after forking
+
+
+def get_writer():
+    writer = _writers.get(os.getpid())
+    if writer is None:
+        writer = AuthFileWriter(config.AUTH_FILE_PATH,
+                                config.AUTH_FILE_WRITE_INTERVAL)
+        _writers.clear()
+        _writers[os.getpid()] = writer
+        atexit.register(writer.flush)
+    return writer
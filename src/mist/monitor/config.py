@@ -22,6 +22,12 @@ CORE_URI = settings.get("CORE_URI",
 GRAPHITE_URI = settings.get("GRAPHITE_URI",
                             os.environ.get("GRAPHITE_URI",
                                            "http://localhost"))
+# Optionally, series can be sharded by machine uuid across many graphite
+# backends, given as a dict mapping backend names to uris. Backend names are
+# used as keys in the consistent hash ring, so they must match the ones used
+# by bucky's ShardedCarbonClient and must not be renamed. If not set, all
+# requests go to GRAPHITE_URI.
+GRAPHITE_BACKENDS = settings.get("GRAPHITE_BACKENDS", {})
 MONGO_URI = settings.get("MONGO_URI",
                          os.environ.get("MONGO_URI", "localhost:27022"))
 MEMCACHED_URI = settings.get("MEMCACHED_URI", [os.environ.get("MEMCACHED_URI", "localhost:11211")])
@@ -30,6 +36,30 @@ AUTH_FILE_PATH = settings.get(
     "AUTH_FILE_PATH",
     os.environ.get("AUTH_FILE_PATH", os.getcwd() + "/conf/collectd.passwd")
 )
+# Added and removed machines are written to the auth file in batches, at most
+# once every AUTH_FILE_WRITE_INTERVAL seconds per process.
+AUTH_FILE_WRITE_INTERVAL = settings.get("AUTH_FILE_WRITE_INTERVAL", 2)
+# Metrics discovered by bucky (see NewMetricsObserver), pruned when machines
+# are removed.
+DISCOVERED_METRICS_PATH = settings.get(
+    "DISCOVERED_METRICS_PATH",
+    os.environ.get("DISCOVERED_METRICS_PATH",
+                   os.getcwd() + "/conf/discovered_metrics.conf")
+)
+# Latest values of metrics, maintained by bucky's LastValueRecorder.
+LAST_VALUES_PATH = settings.get(
+    "LAST_VALUES_PATH",
+    os.environ.get("LAST_VALUES_PATH",
+                   os.getcwd() + "/conf/last_values.shm")
+)
+# Last time each machine sent a sample, maintained by bucky's
+# HeartbeatRecorder. If available, nodata rules are evaluated from it instead
+# of querying graphite.
+HEARTBEAT_PATH = settings.get(
+    "HEARTBEAT_PATH",
+    os.environ.get("HEARTBEAT_PATH", os.getcwd() + "/conf/heartbeat.shm")
+)
+NODATA_FROM_HEARTBEAT = settings.get("NODATA_FROM_HEARTBEAT", True)
 
 # Defines timings of notifications sent to core from mist.alert when a rule
 # is triggered. (When untriggered we always send a single notification right
@@ -72,6 +102,53 @@ RETENTIONS = settings.get(
 )
 
 
+# Fleet wide queries (/load, /cores) splice machine uuids into graphite
+# targets. Uuids are split in chunks of at most GRAPHITE_CHUNK_SIZE uuids per
+# graphite request and up to GRAPHITE_CHUNK_THREADS requests run in parallel.
+GRAPHITE_CHUNK_SIZE = settings.get("GRAPHITE_CHUNK_SIZE", 200)
+GRAPHITE_CHUNK_THREADS = settings.get("GRAPHITE_CHUNK_THREADS", 16)
+
+
+# Machine metadata (number of cores, disks, interfaces, plugins) is cached and
+# lazily refreshed from graphite when it gets older than this (in seconds).
+METADATA_MAX_AGE = settings.get("METADATA_MAX_AGE", 60 * 60)
+
+
+# If the TotalsAggregator bucky processor is used, total cpu, disk, interface
+# and memory series are computed at ingest time and stored in graphite. Set
+# this to True to query those stored series instead of computing the totals
+# at query time. Keep in mind that stored totals only exist for the period
+# since the aggregator got enabled.
+PREAGGREGATED_TOTALS = settings.get("PREAGGREGATED_TOTALS", False)
+
+
+# Requests to graphite time out after GRAPHITE_TIMEOUT seconds, or earlier if
+# the deadline of the HTTP request (REQUEST_DEADLINE, keep it lower than
+# uwsgi's harakiri) or of the alert check (ALERT_CHECK_DEADLINE) comes first.
+# After GRAPHITE_BREAKER_THRESHOLD consecutive failures, requests to a graphite
+# backend fail fast for GRAPHITE_BREAKER_RESET seconds. If GRAPHITE_HEDGE_AFTER
+# is set, a duplicate request is sent if the first one hasn't completed after
+# that many seconds.
+GRAPHITE_TIMEOUT = settings.get("GRAPHITE_TIMEOUT", 30)
+REQUEST_DEADLINE = settings.get("REQUEST_DEADLINE", 100)
+ALERT_CHECK_DEADLINE = settings.get("ALERT_CHECK_DEADLINE", 30)
+GRAPHITE_BREAKER_THRESHOLD = settings.get("GRAPHITE_BREAKER_THRESHOLD", 5)
+GRAPHITE_BREAKER_RESET = settings.get("GRAPHITE_BREAKER_RESET", 30)
+GRAPHITE_HEDGE_AFTER = settings.get("GRAPHITE_HEDGE_AFTER", None)
+
+
+# New metrics discovered by bucky are sent to core in batches of up to
+# NEW_METRICS_BATCH_SIZE machines, using up to NEW_METRICS_THREADS parallel
+# requests. Collectd passwords of machines are cached for
+# NEW_METRICS_PASSWORD_TTL seconds. NEW_METRICS_BULK is experimental: it sends
+# a single request per batch to a /new_metrics/bulk endpoint, which core does
+# not provide yet, so leave it off unless your core does.
+NEW_METRICS_BATCH_SIZE = settings.get("NEW_METRICS_BATCH_SIZE", 100)
+NEW_METRICS_THREADS = settings.get("NEW_METRICS_THREADS", 8)
+NEW_METRICS_BULK = settings.get("NEW_METRICS_BULK", False)
+NEW_METRICS_PASSWORD_TTL = settings.get("NEW_METRICS_PASSWORD_TTL", 10 * 60)
+
+
 # Reset key is used to reset monitor's data. It needs to be set to a non empty
 # string and sent along with a reset http request from core. Under normal
 # circumstances it should be left blank for security reasons.
@@ -88,6 +88,11 @@ class GraphiteError(InternalServerError):
     msg = "Error communicating with graphite"
 
 
+class GraphiteUnreachableError(GraphiteError):
+    msg = "Graphite is unreachable"
+    http_code = 503  # a transient condition, clients may retry later
+
+
 # SERVICE UNAVAILABLE (translated as 503 in views)
 class ServiceUnavailableError(MistError):
     msg = "Service unavailable"
@@ -9,7 +9,11 @@ from multiprocessing.pool import ThreadPool
 
 
 from mist.monitor import config
+from mist.monitor import policy
+from mist.monitor import sharding
+from mist.monitor import heartbeat
 from mist.monitor.exceptions import GraphiteError
+from mist.monitor.exceptions import GraphiteUnreachableError
 
 
 log = logging.getLogger(__name__)
@@ -40,13 +44,53 @@ def exclude(series_list, regex):
     return "exclude(%s,'%s')" % (series_list, regex)
 
 
+def node_list(names):
+    """Return a path node matching exactly the given names."""
+    if len(names) == 1:
+        return names[0]
+    return "{%s}" % ",".join(names)
+
+
 def alias(series_list, name):
     return "alias(%s,'%s')" % (series_list, name)
 
 
+def align_datapoints(data):
+    """Trim the datapoints of all series to their common start/stop."""
+    starts = set()
+    stops = set()
+    for item in data:
+        if item['datapoints']:
+            starts.add(item['datapoints'][0][1])
+            stops.add(item['datapoints'][-1][1])
+    start = max(starts) if len(starts) > 1 else 0
+    stop = min(stops) if len(stops) > 1 else 0
+    if start or stop:
+        log.debug("%s %s %s %s", starts, start, stops, stop)
+        for item in data:
+            if start:
+                for i in range(len(item['datapoints'])):
+                    if item['datapoints'][i][1] >= start:
+                        if i:
+                            item['datapoints'] = item['datapoints'][i:]
+                        break
+            if stop:
+                for i in range(len(item['datapoints'])):
+                    if item['datapoints'][-(i+1)][1] <= stop:
+                        if i:
+                            item['datapoints'] = item['datapoints'][:-i]
+                        break
+    return data
+
+
 class GenericHandler(object):
+    # MachineMetadata of the machine, if known, lets handlers expand targets
+    # to its known cpus, disks and interfaces instead of wildcards
+    metadata = None
+
     def __init__(self, uuid):
         self.uuid = uuid
+        self.graphite_uri = sharding.get_backend_uri(uuid)
 
     def head(self):
         return "bucky.%s" % self.uuid
@@ -85,18 +129,14 @@ class GenericHandler(object):
         params += [('from', start or None),
                    ('until', stop or None),
                    ('format', resp_format or None)]
-        return requests.Request('GET', "%s/render" % config.GRAPHITE_URI,
+        return requests.Request('GET', "%s/render" % self.graphite_uri,
                                 params=params).prepare().url
 
     def graphite_request(self, url):
         """Issue a request to graphite."""
 
-        try:
-            log.info("Querying graphite uri: '%s'.", url)
-            resp = requests.get(url)
-        except Exception as exc:
-            log.error("Error sending request to graphite: %r", exc)
-            raise GraphiteError(repr(exc))
+        log.info("Querying graphite uri: '%s'.", url)
+        resp = policy.request('GET', url)
 
         if not resp.ok:
             # try to parse error message from graphite's HTML error response
@@ -160,7 +200,7 @@ class GenericHandler(object):
         }
 
     def _find_metrics(self, query):
-        url = "%s/metrics?query=%s" % (config.GRAPHITE_URI, query)
+        url = "%s/metrics?query=%s" % (self.graphite_uri, query)
         resp = self.graphite_request(url)
         return resp.json()
 
@@ -281,15 +321,18 @@ class DiskHandler(CustomHandler):
         return metric
 
     def find_metrics(self, plugin=""):
-        metrics = super(DiskHandler, self).find_metrics()
+        metrics = []
         kinds = set()
         directions = set()
-        for metric in metrics:
+        for metric in super(DiskHandler, self).find_metrics():
             parts = self.parse_target(metric['alias'])
             if parts is not None:
                 disk, kind, direction = parts
+                if disk == "total":
+                    continue  # stored total, will be added below
                 kinds.add(kind)
                 directions.add(direction)
+            metrics.append(metric)
         for kind in kinds:
             for direction in directions:
                 target = "%(head)s." + "disk.total.%s.%s" % (kind, direction)
@@ -301,10 +344,18 @@ class DiskHandler(CustomHandler):
         parts = self.parse_target(target)
         if parts is not None:
             disk, kind, direction = parts
-            if disk == "total":
-                target = sum_series(
-                    "%(head)s." + "disk.*.%s.%s" % (kind, direction)
-                )
+            stored = config.PREAGGREGATED_TOTALS and kind == "disk_octets"
+            if disk == "total" and not stored:
+                disks = self.metadata and self.metadata.disks
+                if disks:
+                    target = sum_series("%(head)s." + "disk.%s.%s.%s" % (
+                        node_list(disks), kind, direction))
+                else:
+                    # leave out totals stored by TotalsAggregator
+                    target = sum_series(exclude(
+                        "%(head)s." + "disk.*.%s.%s" % (kind, direction),
+                        "disk.total"
+                    ))
         return target, alias
 
 
@@ -351,15 +402,18 @@ class InterfaceHandler(CustomHandler):
         return metric
 
     def find_metrics(self, plugin=""):
-        metrics = super(InterfaceHandler, self).find_metrics()
+        metrics = []
         kinds = set()
         directions = set()
-        for metric in metrics:
+        for metric in super(InterfaceHandler, self).find_metrics():
             parts = self.parse_target(metric['alias'])
             if parts is not None:
                 iface, kind, direction = parts
+                if iface == "total":
+                    continue  # stored total, will be added below
                 kinds.add(kind)
                 directions.add(direction)
+            metrics.append(metric)
         for kind in kinds:
             for direction in directions:
                 target = "interface.total.%s.%s" % (kind, direction)
@@ -371,15 +425,25 @@ class InterfaceHandler(CustomHandler):
         parts = self.parse_target(target)
         if parts is not None:
             iface, kind, direction = parts
-            if iface == "total":
-                target = sum_series(
-                    "%(head)s." + "interface.*.%s.%s" % (kind, direction)
-                )
+            stored = config.PREAGGREGATED_TOTALS and kind == "if_octets"
+            if iface == "total" and not stored:
+                ifaces = self.metadata and self.metadata.interfaces
+                if ifaces:
+                    target = sum_series("%(head)s." + "interface.%s.%s.%s" % (
+                        node_list(ifaces), kind, direction))
+                else:
+                    # leave out totals stored by TotalsAggregator
+                    target = sum_series(exclude(
+                        "%(head)s." + "interface.*.%s.%s" % (kind, direction),
+                        "interface.total"
+                    ))
         return target, alias
 
 
 class CpuHandler(CustomHandler):
     plugin = "cpu"
+    # all per core series, leaving out totals stored by TotalsAggregator
+    all_series = exclude("%(head)s.cpu.*.*", "cpu.total")
 
     def parse_target(self, target):
         parts = super(CpuHandler, self).parse_target(target)
@@ -413,13 +477,16 @@ class CpuHandler(CustomHandler):
         return metric
 
     def find_metrics(self, plugin=""):
-        metrics = super(CpuHandler, self).find_metrics()
+        metrics = []
         kinds = set()
-        for metric in metrics:
+        for metric in super(CpuHandler, self).find_metrics():
             parts = self.parse_target(metric['alias'])
             if parts is not None:
                 core, kind = parts
+                if core == "total":
+                    continue  # stored total, will be added below
                 kinds.add(kind)
+            metrics.append(metric)
         kinds.add("nonidle")
         for kind in kinds:
             target = "%(head)s.cpu.total." + kind
@@ -431,24 +498,42 @@ class CpuHandler(CustomHandler):
         parts = self.parse_target(target)
         if parts is not None:
             core, kind = parts
+            all_series = self.all_series
+            cpus = self.metadata and self.metadata.cpus
+            if cpus:
+                all_series = "%(head)s.cpu." + node_list(cpus) + ".*"
             if core == "total":
                 if kind == "*":
-                    target = r'aliasSub(asPercent(sumSeriesWithWildcards(exclude(%(head)s.cpu.*.*,"idle"),3),sumSeries(%(head)s.cpu.*.*)), "^.*\.cpu\.([a-z]*),.*", "%(head)s.cpu.total.\1")'
+                    target = (
+                        r'aliasSub(asPercent(sumSeriesWithWildcards(exclude(' +
+                        all_series +
+                        r',"idle"),3),sumSeries(' + all_series +
+                        r')), "^.*\.cpu\.([a-z]*),.*", '
+                        r'"%(head)s.cpu.total.\1")'
+                    )
                     alias = target
+                elif kind == "nonidle" and config.PREAGGREGATED_TOTALS:
+                    pass  # stored by TotalsAggregator
                 else:
-                    if kind != "nonidle":
-                        base_target = "%(head)s.cpu.*." + kind
+                    if kind == "nonidle":
+                        base_target = exclude(all_series, "idle")
+                    elif cpus:
+                        base_target = "%(head)s.cpu." + node_list(cpus) + \
+                            "." + kind
                     else:
-                        base_target = exclude("%(head)s.cpu.*.*", "idle")
+                        base_target = exclude("%(head)s.cpu.*." + kind,
+                                              "cpu.total")
                     target = as_percent(
                         sum_series(base_target),
-                        sum_series("%(head)s.cpu.*.*")
+                        sum_series(all_series)
                     )
         return target, alias
 
 
 class MemoryHandler(CustomHandler):
     plugin = "memory"
+    # all memory series, leaving out totals stored by TotalsAggregator
+    all_series = exclude("%(head)s.memory.*", "_percent")
 
     def parse_target(self, target):
         parts = super(MemoryHandler, self).parse_target(target)
@@ -485,7 +570,12 @@ class MemoryHandler(CustomHandler):
         return metric
 
     def find_metrics(self, plugin=""):
-        metrics = super(MemoryHandler, self).find_metrics()
+        metrics = []
+        for metric in super(MemoryHandler, self).find_metrics():
+            parts = self.parse_target(metric['alias'])
+            if parts is not None and parts[1]:
+                continue  # stored total, will be added below
+            metrics.append(metric)
         metrics.append(self.decorate_target("%(head)s.memory.nonfree"))
         kinds = set()
         for metric in metrics:
@@ -503,18 +593,20 @@ class MemoryHandler(CustomHandler):
         parts = self.parse_target(target)
         if parts is not None:
             kind, percent = parts
-            if percent:
+            if percent and kind == "nonfree" and config.PREAGGREGATED_TOTALS:
+                pass  # stored by TotalsAggregator
+            elif percent:
                 if kind != "nonfree":
                     base_target = "%(head)s.memory." + kind
                 else:
                     base_target = sum_series(
-                        exclude("%(head)s.memory.*", 'free')
+                        exclude(self.all_series, 'free')
                     )
                 target = as_percent(
-                    base_target, sum_series("%(head)s.memory.*")
+                    base_target, sum_series(self.all_series)
                 )
             elif kind == 'nonfree':
-                target = sum_series(exclude("%(head)s.memory.*", 'free'))
+                target = sum_series(exclude(self.all_series, 'free'))
         return target, alias
 
 
@@ -548,8 +640,9 @@ class PingHandler(CustomHandler):
 
 
 class MultiHandler(GenericHandler):
-    def __init__(self, uuid):
+    def __init__(self, uuid, metadata=None):
         super(MultiHandler, self).__init__(uuid)
+        self.metadata = metadata
         self.handlers = {
             'generic': GenericHandler,
             'interface': InterfaceHandler,
@@ -561,6 +654,10 @@ class MultiHandler(GenericHandler):
             'nodata': NoDataHandler,
         }
         self.vtargets = []
+        # maps requested targets that failed in the last get_data to errors,
+        # and to the exceptions raised for them
+        self.errors = {}
+        self.exceptions = {}
 
     def get_handler(self, target=""):
         plugin = "generic"
@@ -572,12 +669,20 @@ class MultiHandler(GenericHandler):
                 if parts[1] in self.handlers:
                     plugin = parts[1]
         log.debug("get_handler plugin: %s", plugin)
-        return self.handlers[plugin](self.uuid)
+        handler = self.handlers[plugin](self.uuid)
+        handler.metadata = self.metadata
+        return handler
 
-    def find_metrics(self, plugin=""):
+    def find_metrics(self, plugin="", plugins=None):
+        """Find metrics of all (or the specified) plugins.
+
+        The top level plugins are listed from graphite, unless they are
+        explicitly provided (eg from the machine's metadata).
+
+        """
         if plugin:
             plugins = [plugin]
-        else:
+        elif plugins is None:
             query = "%s.*" % self.head()
             top_level_metrics = self._find_metrics(query)
             plugins = [metric['id'].split(".")[-1]
@@ -589,6 +694,30 @@ class MultiHandler(GenericHandler):
         return metrics
 
     def get_data(self, targets, start="", stop="", interval_str=""):
+        """Fetch data for many targets, grouped per handler in chunks.
+
+        If a chunk fails, it is retried by bisection until the offending
+        targets are found, so that a single bad target doesn't take down the
+        others. Data of good targets is returned and errors of failed ones
+        are stored in self.errors, keyed by requested target. If graphite is
+        unreachable and no data at all could be fetched, an exception is
+        raised instead.
+
+        """
+        data = list(self.iter_data(targets, start, stop, interval_str,
+                                   ordered=True))
+        return align_datapoints(data)
+
+    def iter_data(self, targets, start="", stop="", interval_str="",
+                  ordered=False):
+        """Like get_data, but yield series as soon as their chunk arrives.
+
+        Series aren't aligned to a common start/stop, and self.errors is
+        only complete once the iterator is exhausted. Unless ordered is set,
+        series of a chunk are yielded as soon as it arrives, regardless of
+        the order of targets.
+
+        """
         if isinstance(targets, basestring):
             targets = [targets]
         current_handlers = {}
@@ -605,45 +734,49 @@ class MultiHandler(GenericHandler):
                 run_args.append((handler.get_data, targets[:max_targets]))
                 targets = targets[max_targets:]
 
+        errors = self.errors = {}
+        exceptions = self.exceptions = {}
+        unreachable = []
+        deadline = policy.get_deadline()
+
         def _run((func, targets)):
             try:
-                return func(targets, start=start, stop=stop,
-                            interval_str=interval_str)
-            except Exception as exc:
+                with policy.deadline(at=deadline):
+                    return func(targets, start=start, stop=stop,
+                                interval_str=interval_str)
+            except GraphiteUnreachableError as exc:
+                # no point in bisecting, every request would fail the same
                 log.warning("Multihandler got response: %r", exc)
+                unreachable.append(exc)
+                for target in targets:
+                    errors[target] = str(exc)
+                    exceptions[target] = exc
                 return []
-
+            except Exception as exc:
+                if len(targets) == 1:
+                    log.warning("Multihandler target '%s' failed: %r",
+                                targets[0], exc)
+                    errors[targets[0]] = str(exc)
+                    exceptions[targets[0]] = exc
+                    return []
+                half = len(targets) // 2
+                return (_run((func, targets[:half])) +
+                        _run((func, targets[half:])))
+
+        found = False
         pool = ThreadPool(10)
-        parts = pool.map(_run, run_args)
-        data = reduce(lambda x, y: x + y, parts)
-        pool.terminate()
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for part in imap(_run, run_args):
+                for item in part:
+                    found = True
+                    yield item
+        finally:
+            pool.terminate()
         log.info("Multihandler get_data completed in: %.2f secs",
                  time.time() - started_at)
-
-        # align start/stop
-        starts = set()
-        stops = set()
-        for item in data:
-            starts.add(item['datapoints'][0][1])
-            stops.add(item['datapoints'][-1][1])
-        start = max(starts) if len(starts) > 1 else 0
-        stop = min(stops) if len(stops) > 1 else 0
-        if start or stop:
-            log.debug("%s %s %s %s", starts, start, stops, stop)
-            for item in data:
-                if start:
-                    for i in range(len(item['datapoints'])):
-                        if item['datapoints'][i][1] >= start:
-                            if i:
-                                item['datapoints'] = item['datapoints'][i:]
-                            break
-                if stop:
-                    for i in range(len(item['datapoints'])):
-                        if item['datapoints'][-(i+1)][1] <= stop:
-                            if i:
-                                item['datapoints'] = item['datapoints'][:-i]
-                            break
-        return data
+        if unreachable and not found:
+            raise unreachable[0]
 
     def decorate_target(self, target):
         return self.get_handler(target).decorate_target(target)
@@ -651,6 +784,7 @@ class MultiHandler(GenericHandler):
 
 class NoDataHandler(MultiHandler, CustomHandler):
     plugin = "nodata"
+    heartbeat_max_window = 600  # seconds
 
     def parse_target(self, target):
         parts = super(NoDataHandler, self).parse_target(target)
@@ -673,7 +807,38 @@ class NoDataHandler(MultiHandler, CustomHandler):
     def find_metrics(self, plugin=""):
         return [self.decorate_target("%(head)s.nodata")]
 
+    def get_data_from_heartbeat(self, start):
+        """Evaluate nodata from the time bucky last received a sample.
+
+        Only relative start times up to heartbeat_max_window are handled,
+        since the heartbeat table can't tell how much data was received in
+        the past. Returns None if nodata can't be evaluated this way.
+
+        """
+        match = re.match(r'^-(\d+)(s|sec|min|h)?$', start or "-90sec")
+        if not match:
+            return
+        window = int(match.group(1)) * {None: 1, 's': 1, 'sec': 1,
+                                        'min': 60, 'h': 3600}[match.group(2)]
+        now = time.time()
+        if window > self.heartbeat_max_window or \
+                not heartbeat.is_available(window, now):
+            return
+        last_seen = heartbeat.get_last_seen(self.uuid)
+        if last_seen is None:
+            # never seen, treated as nodata just like missing whisper files
+            return []
+        metric = self.find_metrics()[0]
+        metric['datapoints'] = [(1 if last_seen < now - window else 0,
+                                 int(now))]
+        metric['_requested_target'] = "nodata"
+        return [metric]
+
     def get_data(self, targets, start="", stop="", interval_str=""):
+        if config.NODATA_FROM_HEARTBEAT and not stop:
+            data = self.get_data_from_heartbeat(start)
+            if data is not None:
+                return data
         real_targets = [
             "%(head)s.load.shortterm",
             "%(head)s.load.midterm",
@@ -682,6 +847,13 @@ class NoDataHandler(MultiHandler, CustomHandler):
         data = super(NoDataHandler, self).get_data(
             real_targets, start=start, stop=stop, interval_str=interval_str
         )
+        if self.exceptions and not data:
+            # don't report missing data if we failed to fetch it, and raise
+            # the original exception so that it can still be classified
+            exceptions = self.exceptions.values()
+            unreachable = [exc for exc in exceptions
+                           if isinstance(exc, GraphiteUnreachableError)]
+            raise (unreachable or exceptions)[0]
         points = {}
         for item in data:
             for value, timestamp in item['datapoints']:
@@ -0,0 +1,127 @@
+"""Last seen timestamps of hosts, recorded at ingestion
+
+bucky's HeartbeatRecorder processor (see mist.bucky_extras.processors) keeps
+the time each host last sent a sample in a SharedTable. This lets nodata
+rules be evaluated with a single shared memory lookup, instead of rendering
+several series from graphite for every machine on every alert run.
+
+"""
+
+import os
+import time
+import heapq
+import logging
+
+from mist.monitor import config
+from mist.monitor.shm_table import SharedTable, fingerprint
+
+
+log = logging.getLogger(__name__)
+
+
+# Time the table was first used by bucky, stored under the fingerprint of an
+# empty host name. Hosts can't be reported silent for longer than that.
+STARTED_KEY = fingerprint("")
+
+_tables = {}  # pid -> SharedTable, opened lazily after forking
+
+
+def get_table():
+    """Return the heartbeat table, or None if bucky hasn't created it."""
+    table = _tables.get(os.getpid())
+    if table is None:
+        try:
+            table = SharedTable(config.HEARTBEAT_PATH, "d", create=False)
+        except (IOError, OSError) as exc:
+            log.debug("Heartbeat table unavailable: %s", exc)
+            return
+        _tables.clear()
+        _tables[os.getpid()] = table
+    return table
+
+
+def is_available(window, now=None):
+    """Check if heartbeats can tell whether hosts were silent for window.
+
+    That's the case if the table exists and bucky has been recording to it
+    for at least window seconds, otherwise a host may seem silent only
+    because its samples arrived before the recorder was deployed.
+
+    """
+    table = get_table()
+    if table is None:
+        return False
+    started = table.get(STARTED_KEY, (0, ))[0]
+    return bool(started) and started <= (now or time.time()) - window
+
+
+def get_last_seen(uuid):
+    """Return the time bucky last received a sample from uuid or None."""
+    table = get_table()
+    if table is None:
+        return
+    last_seen = table.get(fingerprint(uuid), (0, ))[0]
+    return last_seen or None
+
+
+class HeartbeatIndex(object):
+    """Find hosts that have been silent for more than a threshold
+
+    Hosts are kept in a min heap ordered by the last seen time known to the
+    index. Since heartbeats only move forward, an entry that hasn't expired
+    can't belong to a silent host, so only expired entries are re-read from
+    the table and pushed back with their current time. A call to silent()
+    therefore costs in proportion to the silent hosts plus the hosts that
+    were refreshed since, rather than to the total number of hosts.
+
+    changed() builds on it to tell which hosts need their nodata rules
+    checked, so mist.alert only evaluates those of silent hosts.
+
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.hosts = set()
+        self.last_silent = None  # hosts silent on the last call to changed()
+
+    def update(self, uuids):
+        """Set the hosts to track."""
+        uuids = set(uuids)
+        if uuids - self.hosts or len(uuids) != len(self.hosts):
+            self.hosts = uuids
+            self.heap = [(get_last_seen(uuid) or 0, uuid) for uuid in uuids]
+            heapq.heapify(self.heap)
+
+    def silent(self, threshold, now=None):
+        """Return the hosts not seen in the last threshold seconds."""
+        deadline = (now or time.time()) - threshold
+        silent, refreshed = [], []
+        while self.heap and self.heap[0][0] < deadline:
+            _, uuid = heapq.heappop(self.heap)
+            last_seen = get_last_seen(uuid) or 0
+            if last_seen < deadline:
+                silent.append(uuid)
+            refreshed.append((last_seen, uuid))
+        for item in refreshed:
+            heapq.heappush(self.heap, item)
+        return silent
+
+    def changed(self, threshold, now=None):
+        """Return the hosts whose nodata state may have changed.
+
+        Those are the hosts silent for threshold seconds, plus the ones that
+        were silent on the previous call, which may have recovered. The first
+        call after reset() returns all hosts.
+
+        """
+        silent = set(self.silent(threshold, now))
+        if self.last_silent is None:
+            hosts = set(self.hosts)
+        else:
+            hosts = silent | (self.last_silent & self.hosts)
+        self.last_silent = silent
+        return hosts
+
+    def reset(self):
+        """Make the next call to changed() return all hosts."""
+        self.last_silent = None
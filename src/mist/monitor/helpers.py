@@ -1,3 +1,5 @@
+import json
+import struct
 from random import getrandbits
 
 
@@ -29,3 +31,58 @@ def tdelta_to_str(secs):
     for num, label in reversed(parts):
         texts.append("%d%s" % (num, label))
     return "".join(texts)
+
+
+def to_matrix(series_list):
+    """Convert series of [value, timestamp] datapoints to a columnar matrix.
+
+    Returns a dict with a single timestamp axis (start, step, count) and a
+    list of series, each with the metadata of the original series and a
+    dense 'values' column with None for missing datapoints. The step is the
+    smallest interval between timestamps, so series should be aligned (eg by
+    graphite.align_datapoints) and share the same resolution, otherwise
+    datapoints that don't fall on the axis are dropped.
+
+    """
+    timestamps = sorted(set(timestamp for item in series_list
+                            for _, timestamp in item['datapoints']))
+    start = timestamps[0] if timestamps else 0
+    step = min([b - a for a, b in zip(timestamps, timestamps[1:])] or [0])
+    count = (timestamps[-1] - start) // step + 1 if step else len(timestamps)
+    matrix = {'start': start, 'step': step, 'count': count, 'series': []}
+    for item in series_list:
+        values = [None] * count
+        for value, timestamp in item['datapoints']:
+            index, offset = divmod(timestamp - start, step or 1)
+            if not offset:
+                values[index] = value
+        series = dict((key, value) for key, value in item.items()
+                      if key != 'datapoints')
+        series['values'] = values
+        matrix['series'].append(series)
+    return matrix
+
+
+def pack_matrix(matrix):
+    """Encode a matrix returned by to_matrix in a compact binary format.
+
+    The result is a little endian uint32 with the length of a json header,
+    the json header (the matrix without the values of the series), and then
+    the values of each series in order, as count little endian float64s
+    with NaN for missing datapoints.
+
+    """
+    header = dict(matrix, series=[
+        dict((key, value) for key, value in series.items()
+             if key != 'values')
+        for series in matrix['series']
+    ])
+    header = json.dumps(header)
+    values = struct.Struct("<%dd" % matrix['count'])
+    nan = float('nan')
+    return "".join(
+        [struct.pack("<I", len(header)), header] +
+        [values.pack(*[nan if value is None else value
+                       for value in series['values']])
+         for series in matrix['series']]
+    )
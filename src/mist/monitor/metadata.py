@@ -0,0 +1,271 @@
+"""Materialized per machine metadata
+
+Things like the number of cores of a machine or the names of its disks and
+interfaces practically never change, so instead of computing them from the
+time series on every request we keep a MachineMetadata record per machine.
+Records are updated from ingestion (when new metrics get discovered) and are
+lazily refreshed from graphite's metric index when they get too old. Graphite
+handlers also use them to expand cpu, disk and interface totals to the known
+cores, disks and interfaces instead of wildcards (see get_cached_metadata).
+
+"""
+
+import logging
+from time import time
+from multiprocessing.pool import ThreadPool
+
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import OperationFailure
+
+from mist.monitor import config
+from mist.monitor import graphite
+from mist.monitor import policy
+from mist.monitor import sharding
+
+from mist.monitor.model import MachineMetadata
+
+
+log = logging.getLogger(__name__)
+
+
+FIELDS = ('plugins', 'cpus', 'disks', 'interfaces')
+
+# graphite find queries of a refresh, relative to the head of the machines
+QUERIES = {
+    'plugins': "*",
+    'cpus': "cpu.*",
+    'disks': "disk.*",
+    'interfaces': "interface.*",
+}
+
+_indexed = set()  # mongo uris whose metadata collection has been indexed
+
+
+def _get_coll(base):
+    """Return the metadata collection, with a unique index on uuid.
+
+    Records are written both from ingestion and from the API, with atomic
+    updates keyed on the uuid, so the index keeps concurrent upserts from
+    creating duplicate records.
+
+    """
+    coll = base._get_mongo_coll()
+    if base._mongo_uri not in _indexed:
+        try:
+            coll.ensure_index('uuid', unique=True)
+        except OperationFailure as exc:
+            log.error("Error indexing machine metadata: %r", exc)
+        _indexed.add(base._mongo_uri)
+    return coll
+
+
+def _upsert(coll, uuid, update):
+    """Atomically update the record of uuid, creating it if needed."""
+    try:
+        coll.update({'uuid': uuid}, update, upsert=True)
+    except DuplicateKeyError:
+        # created concurrently, it now exists
+        coll.update({'uuid': uuid}, update)
+
+
+def _forget(base, uuids):
+    """Drop cached copies of records that were updated in mongo."""
+    base._memcache.delete_multi([base._memcache_key(uuid) for uuid in uuids])
+
+
+def _node_names(handler, query):
+    """Return {uuid: set of node names} matched by a graphite find query."""
+    names = {}
+    for item in handler._find_metrics(query):
+        parts = item['id'].split('.')
+        names.setdefault(parts[1], set()).add(parts[-1])
+    return names
+
+
+def _find_fields(uuids):
+    """Return {uuid: {field: sorted names}} from graphite's metric index.
+
+    A find query per field is issued per chunk of uuids stored in the same
+    graphite backend, by using a graphite brace list as the machine part of
+    the metric path. All queries run in parallel.
+
+    """
+    size = config.GRAPHITE_CHUNK_SIZE
+    jobs = []
+    for uri, group in sharding.group_by_backend(uuids).items():
+        for i in xrange(0, len(group), size):
+            jobs += [(uri, group[i:i + size], field) for field in FIELDS]
+    if not jobs:
+        return {}
+    deadline = policy.get_deadline()
+
+    def _run((uri, chunk, field)):
+        handler = graphite.GenericHandler("{%s}" % ",".join(chunk))
+        handler.graphite_uri = uri
+        with policy.deadline(at=deadline):
+            return field, _node_names(handler, "%s.%s" % (handler.head(),
+                                                          QUERIES[field]))
+
+    found = dict((uuid, dict((field, set()) for field in FIELDS))
+                 for uuid in uuids)
+    pool = ThreadPool(min(len(jobs), config.GRAPHITE_CHUNK_THREADS))
+    try:
+        for field, names in pool.imap_unordered(_run, jobs):
+            for uuid, nodes in names.iteritems():
+                if uuid in found:
+                    found[uuid][field] = nodes
+    finally:
+        pool.terminate()
+    for fields in found.itervalues():
+        fields['cpus'] = [cpu for cpu in fields['cpus'] if cpu.isdigit()]
+        fields['disks'].discard("total")
+        fields['interfaces'].discard("total")
+        for field in FIELDS:
+            fields[field] = sorted(fields[field])
+    return found
+
+
+def refresh_metadata(uuids, cached=None):
+    """Refresh metadata of many machines from graphite's metric index.
+
+    Machines whose metadata didn't change, which is the common case, are
+    marked as refreshed with a single update, new records are inserted at
+    once and only records that changed are updated one by one, bumping their
+    version. Returns a dict mapping uuids to MachineMetadata instances.
+
+    """
+    cached = dict(cached or {})
+    base = MachineMetadata()
+    coll = _get_coll(base)
+    missing = [uuid for uuid in uuids if uuid not in cached]
+    if missing:
+        for item in coll.find({'uuid': {'$in': missing}}):
+            cached[item['uuid']] = MachineMetadata(item, base._mongo_client,
+                                                   base._memcache)
+    now = time()
+    ret = {}
+    unchanged, new, changed = [], [], []
+    for uuid, fields in _find_fields(uuids).iteritems():
+        metadata = cached.get(uuid)
+        if metadata is not None and all(
+                sorted(getattr(metadata, field)) == fields[field]
+                for field in FIELDS):
+            unchanged.append(uuid)
+        else:
+            if metadata is None:
+                metadata = MachineMetadata(None, base._mongo_client,
+                                           base._memcache)
+                metadata.uuid = uuid
+                new.append(uuid)
+            else:
+                changed.append(uuid)
+            for field in FIELDS:
+                setattr(metadata, field, fields[field])
+            metadata.version += 1
+            metadata.changed_at = now
+            log.info("Metadata of %s changed, version %d", uuid,
+                     metadata.version)
+        metadata.refreshed_at = now
+        ret[uuid] = metadata
+    if unchanged:
+        coll.update({'uuid': {'$in': unchanged}},
+                    {'$set': {'refreshed_at': now}}, multi=True)
+    if new:
+        try:
+            coll.insert([dict(ret[uuid]._dict) for uuid in new],
+                        continue_on_error=True)
+        except DuplicateKeyError:
+            # some were created concurrently from ingestion
+            changed += new
+    for uuid in changed:
+        update = dict((field, list(getattr(ret[uuid], field)))
+                      for field in FIELDS)
+        update.update(changed_at=now, refreshed_at=now)
+        _upsert(coll, uuid, {'$set': update, '$inc': {'version': 1}})
+    _forget(base, unchanged + new + changed)
+    return ret
+
+
+def get_metadata_many(uuids, max_age=None):
+    """Return a dict mapping uuids to their MachineMetadata.
+
+    Metadata are read from mongo in a single query and those that are missing
+    or older than max_age seconds are refreshed from graphite.
+
+    """
+    if max_age is None:
+        max_age = config.METADATA_MAX_AGE
+    uuids = sorted(set(uuids))
+    base = MachineMetadata()
+    ret = {}
+    for item in _get_coll(base).find({'uuid': {'$in': uuids}}):
+        ret[item['uuid']] = MachineMetadata(item, base._mongo_client,
+                                            base._memcache)
+    stale = [uuid for uuid in uuids
+             if uuid not in ret or time() - ret[uuid].refreshed_at > max_age]
+    if stale:
+        ret.update(refresh_metadata(stale, cached=ret))
+    return ret
+
+
+def get_metadata(uuid, max_age=None):
+    """Return MachineMetadata of a machine, refreshing it if necessary."""
+    return get_metadata_many([uuid], max_age=max_age)[uuid]
+
+
+def get_cached_metadata(uuid):
+    """Return MachineMetadata of a machine if it was ever refreshed, or None.
+
+    Unlike get_metadata, graphite is never queried and errors are only
+    logged, since metadata is an optimization for callers. Records that were
+    only created from ingestion are partial, so they're not returned.
+
+    """
+    metadata = MachineMetadata()
+    try:
+        metadata.get_from_uuid(uuid)
+    except Exception as exc:
+        log.warning("Error reading metadata of %s: %r", uuid, exc)
+        return
+    if metadata.refreshed_at:
+        return metadata
+
+
+def update_from_names(uuid, names):
+    """Merge newly discovered metric names into the metadata of a machine.
+
+    This is meant to be called from ingestion and only ever adds things, with
+    an atomic update, so that it doesn't race with refreshes. Removed disks,
+    interfaces etc are dropped by the next lazy refresh. Records created here
+    are partial and aren't marked as refreshed, so they get fully refreshed
+    the first time they're read.
+
+    """
+    if not names:
+        return
+    metadata = MachineMetadata()
+    metadata.get_from_uuid(uuid)
+    fields = dict((field, set()) for field in FIELDS)
+    for name in names:
+        parts = name.split('.')
+        fields['plugins'].add(parts[0])
+        if len(parts) < 3:
+            continue
+        if parts[0] == 'cpu' and parts[1].isdigit():
+            fields['cpus'].add(parts[1])
+        elif parts[0] == 'disk' and parts[1] != 'total':
+            fields['disks'].add(parts[1])
+        elif parts[0] == 'interface' and parts[1] != 'total':
+            fields['interfaces'].add(parts[1])
+    update = {'$set': {'changed_at': time()}, '$inc': {'metrics_version': 1}}
+    added = {}
+    for field in FIELDS:
+        values = sorted(fields[field] - set(getattr(metadata, field)))
+        if values:
+            added[field] = {'$each': values}
+    if added:
+        update['$addToSet'] = added
+        update['$inc']['version'] = 1
+        log.info("Metadata of %s changed: %s", uuid, added.keys())
+    _upsert(_get_coll(metadata), uuid, update)
+    _forget(metadata, [uuid])
@@ -1,24 +1,30 @@
 import os
 import re
+import json
+import hashlib
 import logging
 from subprocess import call
 from time import time
+from multiprocessing.pool import ThreadPool
 
-import requests
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import OperationFailure
 
-log = logging.getLogger(__name__)
 
-try:
-    import fcntl
-    CAN_LOCK = True
-except ImportError:
-    log.error("Can't import fcntl module, won't lock collectd.passwd")
-    CAN_LOCK = False
+log = logging.getLogger(__name__)
 
 from mist.monitor import config
+from mist.monitor import policy
 from mist.monitor import graphite
+from mist.monitor import sharding
+from mist.monitor import metadata
+from mist.monitor import heartbeat
+from mist.monitor import authfile
 
 from mist.monitor.helpers import get_rand_token
+from mist.monitor.shm_table import SharedTable, fingerprint
+from mist.bucky_extras.metrics_store import remove_host as \
+    remove_discovered_metrics
 
 from mist.monitor.model import Machine, Condition, Rule
 from mist.monitor.model import get_machine_from_uuid
@@ -31,24 +37,27 @@ from mist.monitor.exceptions import RuleNotFoundError
 from mist.monitor.exceptions import MachineExistsError
 from mist.monitor.exceptions import BadRequestError
 from mist.monitor.exceptions import GraphiteError
+from mist.monitor.exceptions import GraphiteUnreachableError
+from mist.monitor.exceptions import ServiceUnavailableError
 
 
 def update_collectd_conf():
     """Update collectd.passwd and collectd.conf.local file.
 
     Reconstructs collectd.passwd adding a uuid/password entry for every machine.
+    Added and removed machines are applied incrementally instead (see
+    mist.monitor.authfile), so this is only needed when resetting.
 
     """
 
     path = config.AUTH_FILE_PATH
-    tmp_path = path + '.tmp'
-    with open(tmp_path, 'w') as f:  # write new auth file to temporary file
-        if CAN_LOCK:  # disallow concurrent rewrites of authfile
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-        f.writelines(["%s: %s\n" % (machine.uuid, machine.collectd_password)
-                      for machine in get_all_machines()])
-    os.rename(tmp_path, path)  # move tmp file to authfile location
-    os.utime(path, None)  # touch authfile to notify bucky that it changed
+    with authfile.locked(path):  # disallow concurrent rewrites of authfile
+        # changes queued in this process are superseded by the rebuild
+        authfile.get_writer().discard()
+        authfile.write_entries(path, dict(
+            (machine.uuid, machine.collectd_password)
+            for machine in get_all_machines()
+        ))
 
 
 def add_machine(uuid, password, update_collectd=True):
@@ -75,7 +84,7 @@ def add_machine(uuid, password, update_collectd=True):
 
     # add uuid/passwd in collectd.passwd
     if update_collectd:
-        update_collectd_conf()
+        authfile.get_writer().set(uuid, password)
 
     # add no-data rule
     add_rule(machine.uuid, 'nodata', 'nodata', 'gt', 0)
@@ -99,21 +108,24 @@ def remove_machine(uuid):
 
     machine.delete()
 
-    # reconstruct collectd passwords file to remove uuid/passwd
-    update_collectd_conf()
+    # remove uuid/passwd from collectd passwords file
+    authfile.get_writer().remove(uuid)
 
+    # prune discovered metrics of machine on next compaction
+    try:
+        remove_discovered_metrics(config.DISCOVERED_METRICS_PATH, uuid)
+    except IOError as exc:
+        log.error("Error pruning discovered metrics of '%s': %s", uuid, exc)
 
-def add_rule(uuid, rule_id, metric, operator, value,
-             aggregate="all", reminder_list=None, reminder_offset=0,
-             active_after=30):
-    """Add or update a rule."""
+
+def _new_condition(uuid, rule_id, metric, operator, value,
+                   aggregate="all", reminder_list=None, reminder_offset=0,
+                   active_after=30):
+    """Return a new, unsaved Condition instance for a rule."""
 
     if aggregate not in ('all', 'any', 'avg'):
         raise BadRequestError("Param 'aggregate' must be in "
                               "('all', 'any', 'avg').")
-    machine = get_machine_from_uuid(uuid)
-    if not machine:
-        raise MachineNotFoundError(uuid)
 
     # create new condition
     condition = Condition()
@@ -136,6 +148,21 @@ def add_rule(uuid, rule_id, metric, operator, value,
 
     # TODO: verify target is valid
 
+    return condition
+
+
+def add_rule(uuid, rule_id, metric, operator, value,
+             aggregate="all", reminder_list=None, reminder_offset=0,
+             active_after=30):
+    """Add or update a rule."""
+
+    condition = _new_condition(uuid, rule_id, metric, operator, value,
+                               aggregate, reminder_list, reminder_offset,
+                               active_after)
+    machine = get_machine_from_uuid(uuid)
+    if not machine:
+        raise MachineNotFoundError(uuid)
+
     condition.create()
 
     with machine.lock_n_load():
@@ -172,66 +199,578 @@ def remove_rule(uuid, rule_id):
         machine.save()
 
 
-def get_stats(uuid, metrics, start="", stop="", interval_str=""):
+BULK_INSERT_SIZE = 1000  # documents per mongo insert
 
-    old_targets = {
-        'cpu': 'cpu.total.nonidle',
-        'load': 'load.shorterm',
-        'ram': 'memory.nonfree_percent',
-        'disk-read': 'disk.total.disk_octets.read',
-        'disk-write': 'disk.total.disk_octets.write',
-        'network-rx': 'interface.total.if_octets.rx',
-        'network-tx': 'interface.total.if_octets.tx',
-    }
-    targets = [old_targets.get(metric, metric) for metric in metrics]
-    handler = graphite.MultiHandler(uuid)
+_indexed = set()  # mongo uris whose machines collection has been indexed
+
+
+def _parse_rule(uuid, rule_id, rule_dict):
+    """Return a new Condition from a rule dict as sent by core."""
+    for key in ("metric", "operator"):
+        if not rule_dict.get(key):
+            raise RequiredParameterMissingError("%s of rule '%s' of '%s'" %
+                                                (key, rule_id, uuid))
+    try:
+        value = float(rule_dict.get("value"))
+    except (ValueError, TypeError):
+        raise BadRequestError("Invalid value %r of rule '%s' of '%s'" %
+                              (rule_dict.get("value"), rule_id, uuid))
+    return _new_condition(uuid, rule_id, rule_dict["metric"],
+                          rule_dict["operator"], value,
+                          aggregate=rule_dict.get("aggregate") or "all",
+                          reminder_list=rule_dict.get("reminder_list"),
+                          reminder_offset=rule_dict.get("reminder_offset", 0))
+
+
+def _get_machines_coll(machine):
+    """Return the machines collection, with a unique index on uuid.
+
+    Machines may be added concurrently, by bulk requests that check which
+    uuids are missing without a lock, so the index keeps them from inserting
+    duplicate machines.
+
+    """
+    coll = machine._get_mongo_coll()
+    if machine._mongo_uri not in _indexed:
+        try:
+            coll.ensure_index('uuid', unique=True)
+        except OperationFailure as exc:
+            log.error("Error indexing machines: %r", exc)
+        _indexed.add(machine._mongo_uri)
+    return coll
+
+
+def _insert_many(coll, docs, continue_on_error=False):
+    """Insert docs in batches, return False if some were duplicates.
+
+    Duplicates raise DuplicateKeyError, unless continue_on_error is set, in
+    which case all other docs are inserted.
+
+    """
+    ok = True
+    for i in xrange(0, len(docs), BULK_INSERT_SIZE):
+        try:
+            coll.insert(docs[i:i + BULK_INSERT_SIZE],
+                        continue_on_error=continue_on_error)
+        except DuplicateKeyError:
+            if not continue_on_error:
+                raise
+            ok = False
+    return ok
+
+
+def _set_conditions(machine, conditions):
+    """Point rules of machine to new conditions, return replaced cond_ids."""
+    replaced = []
+    for rule_id, condition in conditions.iteritems():
+        if rule_id not in machine.rules:
+            machine.rules[rule_id] = Rule()
+        rule = machine.rules[rule_id]
+        if rule.warning:
+            replaced.append(rule.warning)
+        rule.warning = condition.cond_id
+    return replaced
+
+
+def _provision(rules, passwords=None):
+    """Apply many rules and optionally add machines, using batched writes.
+
+    rules is a dict of uuids mapping to dicts of rule_ids mapping to rule
+    dicts. If passwords is given, it's a dict of uuids mapping to collectd
+    passwords of machines to be added or updated, otherwise all machines must
+    already exist.
+
+    All rules are validated before anything is written. New conditions and
+    new machines are written with a few batched inserts, every existing
+    machine is locked, updated and saved once and all replaced conditions are
+    removed with a single query. Machines that were added concurrently, after
+    checking which ones exist, are updated like existing ones. If writing
+    fails, new conditions that no machine points to are removed again.
+
+    """
+
+    conditions = {}
+    for uuid, rule_dicts in rules.iteritems():
+        if not uuid:
+            raise RequiredParameterMissingError("uuid")
+        conditions[uuid] = dict(
+            (rule_id, _parse_rule(uuid, rule_id, rule_dict))
+            for rule_id, rule_dict in rule_dicts.iteritems()
+        )
+    uuids = set(conditions) | set(passwords or {})
+
+    # share a single mongo and memcache connection for everything
+    machines = Machine()
+    machines_coll = _get_machines_coll(machines)
+    cache = machines._memcache
+    conditions_coll = Condition(mongo_client=machines._mongo_client,
+                                memcache_client=cache)._get_mongo_coll()
+
+    existing = set(
+        machine_dict['uuid'] for machine_dict in machines_coll.find(
+            {'uuid': {'$in': list(uuids)}}, {'uuid': True, '_id': False}
+        )
+    )
+    missing = uuids - existing
+    if missing and passwords is None:
+        raise MachineNotFoundError(", ".join(sorted(missing)))
+
+    inserted = [condition.cond_id for uuid in conditions
+                for condition in conditions[uuid].values()]
+    used = set()  # cond_ids of inserted conditions saved in machines
+    replaced = []
+    try:
+        _insert_many(conditions_coll, [
+            condition._dict for uuid in conditions
+            for condition in conditions[uuid].values()
+        ])
+
+        now = time()
+        new_machines = {}
+        for uuid in missing:
+            machine = Machine()
+            machine.uuid = uuid
+            machine.collectd_password = passwords[uuid]
+            machine.enabled_time = now
+            _set_conditions(machine, conditions.get(uuid, {}))
+            new_machines[uuid] = machine._dict
+        if not _insert_many(machines_coll, new_machines.values(),
+                            continue_on_error=True):
+            # added concurrently, update them instead
+            for machine_dict in machines_coll.find(
+                    {'uuid': {'$in': list(missing)}},
+                    {'uuid': True, '_id': True}):
+                uuid = machine_dict['uuid']
+                if machine_dict['_id'] != new_machines[uuid].get('_id'):
+                    del new_machines[uuid]
+                    existing.add(uuid)
+        for uuid in new_machines:
+            used.update(condition.cond_id
+                        for condition in conditions.get(uuid, {}).values())
+
+        for uuid in existing:
+            machine = Machine(mongo_client=machines._mongo_client,
+                              memcache_client=cache)
+            machine.get_from_uuid(uuid)
+            with machine.lock_n_load():
+                if passwords is not None:
+                    machine.collectd_password = passwords[uuid]
+                    machine.enabled_time = now
+                old = _set_conditions(machine, conditions.get(uuid, {}))
+                machine.save()
+            replaced.extend(old)
+            used.update(condition.cond_id
+                        for condition in conditions.get(uuid, {}).values())
+    except Exception:
+        unused = [cond_id for cond_id in inserted if cond_id not in used]
+        log.error("Provisioning failed, removing %d new conditions.",
+                  len(unused))
+        conditions_coll.remove({'cond_id': {'$in': unused}})
+        raise
+    finally:
+        if replaced:
+            conditions_coll.remove({'cond_id': {'$in': replaced}})
+            condition = Condition(memcache_client=cache)
+            cache.delete_multi([condition._memcache_key(cond_id)
+                                for cond_id in replaced])
+    log.info("Provisioned %d machines (%d new), %d rules.", len(uuids),
+             len(new_machines), sum(map(len, conditions.values())))
+
+
+def add_machines(data, update_collectd=True):
+    """Add or update many machines along with their rules at once.
+
+    data is expected to be a dict of uuids mapping to machine dicts, in the
+    same format as for reset_hard. A no-data rule is added to every machine,
+    like add_machine does, and all new passwords are written to collectd's
+    auth file in a single update.
+
+    """
+
+    passwords = {}
+    rules = {}
+    for uuid, machine_dict in data.iteritems():
+        if not machine_dict.get('collectd_password'):
+            raise RequiredParameterMissingError("password of '%s'" % uuid)
+        passwords[uuid] = machine_dict['collectd_password']
+        rules[uuid] = {'nodata': {'metric': 'nodata', 'operator': 'gt',
+                                  'value': 0}}
+        rules[uuid].update(machine_dict.get('rules') or {})
+
+    _provision(rules, passwords)
+
+    # add uuid/passwd entries in collectd.passwd
+    if update_collectd:
+        authfile.get_writer().update(passwords)
+
+
+def add_rules(data):
+    """Add or update many rules of many existing machines at once.
+
+    data is expected to be a dict of uuids mapping to dicts of rule_ids
+    mapping to rule dicts, like the rules of a machine dict of reset_hard.
+
+    """
+
+    _provision(data)
+
+
+OLD_TARGETS = {
+    'cpu': 'cpu.total.nonidle',
+    'load': 'load.shorterm',
+    'ram': 'memory.nonfree_percent',
+    'disk-read': 'disk.total.disk_octets.read',
+    'disk-write': 'disk.total.disk_octets.write',
+    'network-rx': 'interface.total.if_octets.rx',
+    'network-tx': 'interface.total.if_octets.tx',
+}
+
+
+def get_stats(uuid, metrics, start="", stop="", interval_str=""):
+    targets = [OLD_TARGETS.get(metric, metric) for metric in metrics]
+    handler = graphite.MultiHandler(uuid, metadata.get_cached_metadata(uuid))
     data = handler.get_data(targets, start, stop, interval_str=interval_str)
     for item in data:
         if item['alias'].rfind("%(head)s.") == 0:
             item['alias'] = item['alias'][9:]
+    # report targets that failed along with the good ones
+    for target, error in handler.errors.items():
+        data.append({'_requested_target': target, 'alias': target,
+                     'datapoints': [], 'error': error})
     return data
 
 
-def get_multi(target, start="", stop="", interval_str=""):
+def iter_stats(uuid, metrics, start="", stop="", interval_str=""):
+    """Yield the series returned by get_stats as soon as they're fetched.
+
+    Unlike get_stats, series aren't aligned to a common start/stop.
+
+    """
+    targets = [OLD_TARGETS.get(metric, metric) for metric in metrics]
+    handler = graphite.MultiHandler(uuid, metadata.get_cached_metadata(uuid))
+    for item in handler.iter_data(targets, start, stop,
+                                  interval_str=interval_str):
+        if item['alias'].rfind("%(head)s.") == 0:
+            item['alias'] = item['alias'][9:]
+        yield item
+    for target, error in handler.errors.items():
+        yield {'_requested_target': target, 'alias': target,
+               'datapoints': [], 'error': error}
+
+
+def plan_bulk_stats(uuids, targets):
+    """Split the queries of many machines' stats into graphite requests.
+
+    Targets that resolve to plain series paths (after the handlers' target
+    and alias mapping) are queried for many machines at once, by splicing
+    chunks of uuids as a brace list in the head of the target. Targets that
+    resolve to graphite functions (eg sums of series) or are computed by
+    their handler (eg nodata) would mix up machines if combined, so they are
+    fetched per machine.
+
+    Returns (grouped, single), where grouped is a list of (graphite uri,
+    uuids, target, real target, handler) and single maps uuids to their
+    targets that need to be fetched per machine.
+
+    """
+    size = config.GRAPHITE_CHUNK_SIZE
+    groups = sharding.group_by_backend(set(uuids))
+    grouped = []
+    single = {}
+    if not groups:
+        return grouped, single
+    handler = graphite.MultiHandler(uuids[0])
+    for target in targets:
+        sub = handler.get_handler(target)
+        real_target, alias = sub.target_alias(target)
+        if type(sub).get_data.im_func is \
+                graphite.GenericHandler.get_data.im_func and \
+                real_target == alias and \
+                '(' not in real_target.replace("%(head)s", ""):
+            for uri, group in groups.items():
+                group.sort()
+                grouped += [(uri, group[i:i + size], target, real_target, sub)
+                            for i in xrange(0, len(group), size)]
+        else:
+            for uuid in uuids:
+                single.setdefault(uuid, []).append(target)
+    return grouped, single
+
+
+def iter_bulk_stats(uuids, metrics, start="", stop="", interval_str=""):
+    """Yield (uuid, series) of many machines' stats as they're fetched.
+
+    Equivalent targets of all machines are fetched with combined graphite
+    requests (see plan_bulk_stats), which run in parallel along with the
+    requests of targets that have to be fetched per machine. Series aren't
+    aligned to a common start/stop.
+
+    """
+    targets = [OLD_TARGETS.get(metric, metric) for metric in metrics]
+    grouped, single = plan_bulk_stats(uuids, targets)
+    deadline = policy.get_deadline()
+
+    def _run_grouped((uri, chunk, target, real_target, handler)):
+        head = "bucky.{%s}" % ','.join(chunk)
+        try:
+            with policy.deadline(at=deadline):
+                data = get_multi(real_target % {'head': head}, start, stop,
+                                 interval_str, graphite_uri=uri)
+        except Exception as exc:
+            log.warning("Bulk stats target '%s' failed: %r", target, exc)
+            return [(uuid, {'_requested_target': target, 'alias': target,
+                            'datapoints': [], 'error': str(exc)})
+                    for uuid in chunk]
+        items = []
+        for item in data:
+            parts = item['target'].split('.')
+            if len(parts) < 3 or parts[0] != 'bucky':
+                log.warning("Bulk stats got unexpected series '%s'",
+                            item['target'])
+                continue
+            uuid = parts[1]
+            item.update(handler.decorate_target(
+                "%(head)s." + '.'.join(parts[2:])))
+            item['_requested_target'] = target \
+                if item['alias'] == real_target else None
+            items.append((uuid, item))
+        return items
+
+    def _run_single((uuid, targets)):
+        with policy.deadline(at=deadline):
+            try:
+                data = get_stats(uuid, targets, start, stop, interval_str)
+            except GraphiteError as exc:
+                log.warning("Bulk stats of '%s' failed: %r", uuid, exc)
+                data = [{'_requested_target': target, 'alias': target,
+                         'datapoints': [], 'error': str(exc)}
+                        for target in targets]
+        return [(uuid, item) for item in data]
+
+    jobs = [(_run_grouped, args) for args in grouped]
+    jobs += [(_run_single, args) for args in single.items()]
+    if not jobs:
+        return
+    pool = ThreadPool(min(len(jobs), config.GRAPHITE_CHUNK_THREADS))
+    try:
+        for items in pool.imap_unordered(lambda (func, args): func(args),
+                                         jobs):
+            for uuid, item in items:
+                if item['alias'].rfind("%(head)s.") == 0:
+                    item['alias'] = item['alias'][9:]
+                yield uuid, item
+    finally:
+        pool.terminate()
+
+
+def get_bulk_stats(uuids, metrics, start="", stop="", interval_str=""):
+    """Return stats of many machines, as returned by get_stats, by uuid."""
+    result = dict((uuid, []) for uuid in uuids)
+    for uuid, item in iter_bulk_stats(uuids, metrics, start, stop,
+                                      interval_str):
+        result.setdefault(uuid, []).append(item)
+    for data in result.values():
+        graphite.align_datapoints(data)
+    return result
+
+
+def get_stats_etag(uuid, metrics, start="", stop="", interval_str="",
+                   variant=""):
+    """Return (etag, last modified timestamp) of the result of get_stats.
+
+    These are derived from the requested range, quantized to the storage
+    interval (or the requested step if coarser), and from the last time bucky
+    received data from the machine (see mist.monitor.heartbeat), so graphite
+    isn't queried. Returns (None, None) if heartbeats aren't available. Last
+    modified is None unless the range ended before the latest data, since
+    otherwise the range keeps sliding even if no new data arrive. variant
+    distinguishes different representations of the same stats.
+
+    """
+    last_seen = heartbeat.get_last_seen(uuid)
+    if last_seen is None:
+        return None, None
+    quantum = min(config.RETENTIONS.values())
+    match = re.match(r'^([0-9]+)(sec|min)$', interval_str or "")
+    if match:
+        seconds = int(match.group(1)) * (60 if match.group(2) == 'min' else 1)
+        quantum = max(quantum, seconds)
+    key = [uuid, sorted(metrics), start or "", stop or "", interval_str or "",
+           variant]
+    if re.match(r'^[0-9]+$', str(stop or "")) and \
+            int(stop) < last_seen - quantum:
+        # range ended before the latest data, it won't change anymore
+        last_modified = int(stop)
+    else:
+        last_modified = None
+        key += [int(time()) // quantum, int(last_seen) // quantum]
+    return hashlib.md5(json.dumps(key)).hexdigest(), last_modified
+
+
+def get_metrics_etag(uuid):
+    """Return (etag, last modified timestamp, metadata) for find_metrics.
+
+    The etag is derived from the versions of the machine's metadata, which
+    are bumped when new metrics are discovered, so graphite isn't queried.
+
+    """
+    meta = metadata.get_metadata(uuid)
+    etag = "%s-%d-%d" % (uuid, meta.version, meta.metrics_version)
+    return etag, int(meta.changed_at) or None, meta
+
+
+def get_multi(target, start="", stop="", interval_str="", graphite_uri=""):
     if interval_str:
         target = graphite.summarize(target, interval_str)
     params = [('target', target),
               ('from', start or None),
               ('until', stop or None),
               ('format', 'json')]
-    resp = requests.get('%s/render' % config.GRAPHITE_URI, params=params)
+    # use POST so that long targets don't end up in the url
+    resp = policy.request('POST',
+                          '%s/render' % (graphite_uri or config.GRAPHITE_URI),
+                          data=params)
     if not resp.ok:
         log.error(resp.text)
         raise GraphiteError(str(resp))
     return resp.json()
 
 
-def get_load(uuids, start="", stop="", interval_str=""):
-    data = get_multi('bucky.{%s}.load.shortterm' % (','.join(uuids), ),
-                     start, stop, interval_str)
-    ret = {}
-    for item in data:
+def iter_multi(target_fmt, uuids, start="", stop="", interval_str=""):
+    """Query graphite for many uuids in parallel chunks, yield series.
+
+    target_fmt is a target with a single '{%s}' placeholder where the uuids of
+    each chunk will be spliced as a graphite brace list. Uuids are grouped by
+    the graphite backend that stores them, so chunks of all backends are
+    fetched in parallel. Series are yielded as soon as the chunk they belong
+    to has been fetched.
+
+    As in MultiHandler.iter_data, a chunk that fails is retried by bisection
+    until the offending uuids are found, and for each of them a series with
+    no datapoints and an 'error' key is yielded. If graphite is unreachable
+    and no series at all could be fetched, an exception is raised instead.
+
+    """
+    size = config.GRAPHITE_CHUNK_SIZE
+    chunks = []
+    for uri, group in sharding.group_by_backend(set(uuids)).items():
+        group.sort()
+        chunks += [(uri, group[i:i + size])
+                   for i in xrange(0, len(group), size)]
+    if not chunks:
+        return
+
+    deadline = policy.get_deadline()
+    unreachable = []
+
+    def _failed(chunk, exc):
+        return [{'target': target_fmt.replace('{%s}', '%s') % uuid,
+                 'datapoints': [], 'error': str(exc)} for uuid in chunk]
+
+    def _run((uri, chunk)):
+        try:
+            with policy.deadline(at=deadline):
+                return get_multi(target_fmt % ','.join(chunk),
+                                 start, stop, interval_str, graphite_uri=uri)
+        except GraphiteUnreachableError as exc:
+            # no point in bisecting, every request would fail the same
+            log.warning("Chunk of %d uuids failed: %r", len(chunk), exc)
+            unreachable.append(exc)
+            return _failed(chunk, exc)
+        except Exception as exc:
+            if len(chunk) == 1:
+                log.warning("Query of '%s' failed: %r", chunk[0], exc)
+                return _failed(chunk, exc)
+            half = len(chunk) // 2
+            return _run((uri, chunk[:half])) + _run((uri, chunk[half:]))
+
+    found = False
+    failed = []  # errors are held back until some series is found
+    pool = ThreadPool(min(len(chunks), config.GRAPHITE_CHUNK_THREADS))
+    try:
+        for data in pool.imap_unordered(_run, chunks):
+            for item in data:
+                if not found:
+                    if 'error' in item:
+                        failed.append(item)
+                        continue
+                    found = True
+                    for error in failed:
+                        yield error
+                yield item
+    finally:
+        pool.terminate()
+    if unreachable and not found:
+        raise unreachable[0]
+    for item in failed:
+        yield item
+
+
+def iter_load(uuids, start="", stop="", interval_str=""):
+    """Yield (uuid, series) tuples of shortterm load for many machines."""
+    for item in iter_multi('bucky.{%s}.load.shortterm', uuids,
+                           start, stop, interval_str):
         uuid = item['target'].split('.')[1]
         item['name'] = uuid
-        ret[uuid] = item
-    return ret
+        yield uuid, item
+
+
+def get_load(uuids, start="", stop="", interval_str=""):
+    return dict(iter_load(uuids, start, stop, interval_str))
+
+
+def iter_cores(uuids, start="", stop="", interval_str=""):
+    """Yield (uuid, series) tuples of number of cores for many machines.
+
+    Core counts are read from the materialized machine metadata instead of
+    counting cpu series in graphite, so the returned series consist of a
+    single datapoint and start, stop and interval_str are ignored.
+
+    """
+    for uuid, meta in metadata.get_metadata_many(uuids).iteritems():
+        if meta.cpus:
+            timestamp = int(meta.refreshed_at or time())
+            yield uuid, {'target': uuid, 'name': uuid,
+                         'datapoints': [[len(meta.cpus), timestamp]]}
 
 
 def get_cores(uuids, start="", stop="", interval_str=""):
-    target = 'groupByNode(bucky.{%s}.cpu.*.system,1,"countSeries")' % (
-        ','.join(uuids), )
-    data = get_multi(target, start, stop, interval_str)
-    ret = {}
-    for item in data:
-        uuid = item['target']
-        item['name'] = uuid
-        ret[uuid] = item
-    return ret
+    return dict(iter_cores(uuids, start, stop, interval_str))
 
 
-def find_metrics(uuid):
+_last_values = {}  # pid -> SharedTable, opened lazily after forking
+
+
+def get_last_values(uuids, metrics):
+    """Return latest [value, timestamp] of metrics for many machines.
+
+    Values are read from the shared table maintained by bucky's
+    LastValueRecorder processor, so graphite isn't queried at all. Metrics
+    are named as in bucky, eg 'load.shortterm', and are None if missing.
+
+    """
+    table = _last_values.get(os.getpid())
+    if table is None:
+        try:
+            table = SharedTable(config.LAST_VALUES_PATH, "dd", create=False)
+        except (IOError, OSError) as exc:
+            log.error("Error opening last values table: %s", exc)
+            raise ServiceUnavailableError("Last values aren't available")
+        _last_values.clear()
+        _last_values[os.getpid()] = table
+    result = {}
+    for uuid in uuids:
+        values = result[uuid] = {}
+        for metric in metrics:
+            value = table.get(fingerprint(uuid, metric))
+            values[metric] = list(value) if value and value[1] else None
+    return result
+
+
+def find_metrics(uuid, meta=None):
     handler = graphite.MultiHandler(uuid)
-    metrics = handler.find_metrics()
+    plugins = (meta or metadata.get_metadata(uuid)).plugins
+    metrics = handler.find_metrics(plugins=plugins)
     for item in metrics:
         if item['alias'].rfind("%(head)s.") == 0:
             item['alias'] = item['alias'][9:]
@@ -261,20 +800,7 @@ def reset_hard(data):
     Machine()._memcache.flush_all()
 
     # recreate machines and rules
-    for uuid, machine_dict in data.iteritems():
-        add_machine(uuid, machine_dict['collectd_password'],
-                    update_collectd=False)
-        for rule_id, rule_dict in machine_dict.get('rules', {}).iteritems():
-            add_rule(
-                uuid=uuid,
-                rule_id=rule_id,
-                metric=rule_dict['metric'],
-                operator=rule_dict['operator'],
-                value=rule_dict['value'],
-                aggregate=rule_dict.get('aggregate'),
-                reminder_list=rule_dict.get('reminder_list'),
-                reminder_offset=rule_dict.get('reminder_offset', 0),
-            )
+    add_machines(data, update_collectd=False)
 
     # update collectd's conf and reload it
     update_collectd_conf()
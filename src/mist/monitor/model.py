@@ -22,6 +22,10 @@ class _IntList(FieldsList):
     _item_type = IntField
 
 
+class _StrList(FieldsList):
+    _item_type = StrField
+
+
 class Condition(OODictMongoMemcache):
 
     cond_id = StrField()
@@ -154,6 +158,47 @@ class Machine(OODictMongoMemcacheLock):
         return msg
 
 
+class MachineMetadata(OODictMongoMemcache):
+    """Materialized metadata of a machine, as discovered from its metrics.
+
+    Keeps things that practically never change, like the number of cores or
+    the names of disks and interfaces, so that they don't have to be computed
+    from the time series on every request. Version is increased every time
+    the metadata changes, metrics_version every time new metrics are
+    discovered, and changed_at records when either last happened.
+
+    """
+
+    uuid = StrField()
+
+    cpus = make_field(_StrList)()
+    disks = make_field(_StrList)()
+    interfaces = make_field(_StrList)()
+    plugins = make_field(_StrList)()
+
+    version = IntField()
+    metrics_version = IntField()
+    changed_at = FloatField()  # timestamp
+    refreshed_at = FloatField()  # timestamp
+
+    def __init__(self, _dict=None, mongo_client=None, memcache_client=None):
+        """Properly initialize OODictMongoMemcache for machine metadata."""
+        super(MachineMetadata, self).__init__(
+            memcache_host=config.MEMCACHED_URI,
+            mongo_uri=config.MONGO_URI,
+            mongo_db='mist',
+            mongo_coll='machine_metadata',
+            mongo_id='uuid',
+            mongo_client=mongo_client,
+            memcache_client=memcache_client,
+            _dict=_dict
+        )
+
+    def get_from_uuid(self, uuid):
+        """Populate self from db with metadata for the specified uuid."""
+        self.get_from_field('uuid', uuid)
+
+
 def get_machine_from_uuid(uuid):
     """Helper function that returns a Machine instance of this uuid."""
     machine = Machine()
@@ -167,3 +212,26 @@ def get_all_machines(mongo_uri=None):
     cache = MemcacheClient(config.MEMCACHED_URI)
     machines_cursor = conn['mist'].machines.find()
     return (Machine(machine_dict, conn, cache) for machine_dict in machines_cursor)
+
+
+def iter_machine_rules(after="", limit=0, mongo_uri=None):
+    """Yield (uuid, rule ids) of all machines with monitoring, by uuid.
+
+    Only the uuid and rules fields of machines are read from mongo, using a
+    projection, and documents are consumed as the cursor fetches them. If
+    after is given, only machines with greater uuids are returned, so the last
+    uuid of a page can be used as a cursor to get the next one.
+
+    """
+    conn = MongoClient(mongo_uri or config.MONGO_URI)
+    query = {'uuid': {'$gt': after}} if after else {}
+    cursor = conn['mist'].machines.find(
+        query, {'uuid': True, 'rules': True, '_id': False}
+    ).sort('uuid', 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    for machine_dict in cursor:
+        # rule ids are keys of a FieldsDict, so dots are escaped in mongo
+        rule_ids = [rule_id.replace('^', '.')
+                    for rule_id in machine_dict.get('rules') or {}]
+        yield machine_dict['uuid'], rule_ids
@@ -0,0 +1,249 @@
+"""Deadlines, circuit breaking and hedging for requests to graphite
+
+All requests to graphite should be issued through request(), which:
+
+- Applies a timeout, which is the smallest of GRAPHITE_TIMEOUT and the time
+  left until the current deadline. Deadlines are set per thread using the
+  deadline() context manager (eg for the duration of an HTTP request or of
+  an alert check) and need to be explicitly passed on to worker threads.
+- Fails fast while the circuit breaker of the backend is open, ie after
+  GRAPHITE_BREAKER_THRESHOLD consecutive failures and for
+  GRAPHITE_BREAKER_RESET seconds, after which a single trial request is
+  allowed through.
+- Optionally issues a duplicate (hedged) request if the first one hasn't
+  completed after GRAPHITE_HEDGE_AFTER seconds, returning whichever
+  completes first.
+- Keeps latency stats per backend, see get_stats().
+
+"""
+
+import time
+import Queue
+import logging
+import urlparse
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+
+from mist.monitor import config
+from mist.monitor.exceptions import GraphiteUnreachableError
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_deadline():
+    """Return the deadline (as a timestamp) of the current thread or None."""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline(timeout=None, at=None):
+    """Set a deadline for graphite requests issued in the with block.
+
+    Either a timeout in seconds or an absolute timestamp can be specified.
+    Nested deadlines can only shorten, never extend, the current deadline.
+
+    """
+    previous = get_deadline()
+    if at is None and timeout is not None:
+        at = time.time() + timeout
+    if previous is not None:
+        at = previous if at is None else min(at, previous)
+    _local.deadline = at
+    try:
+        yield at
+    finally:
+        _local.deadline = previous
+
+
+def deadline_tween_factory(handler, registry):
+    """Pyramid tween that sets a deadline for every HTTP request."""
+
+    def deadline_tween(request):
+        with deadline(config.REQUEST_DEADLINE):
+            return handler(request)
+
+    return deadline_tween
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a backend after many consecutive failures."""
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False  # a trial request is in progress while half open
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.failures < self.threshold:
+            return 'closed'
+        if time.time() - self.opened_at < self.reset_after:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                if not self.opened_at or self.state != 'open':
+                    log.warning("Circuit breaker opened after %d failures",
+                                self.failures)
+                self.opened_at = time.time()
+
+
+class Backend(object):
+    """Circuit breaker and request stats of a single graphite backend."""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(config.GRAPHITE_BREAKER_THRESHOLD,
+                                      config.GRAPHITE_BREAKER_RESET)
+        self.latencies = deque(maxlen=1000)  # of recent successful requests
+        self.counters = {'requests': 0, 'errors': 0, 'rejected': 0,
+                         'hedged': 0}
+        self.lock = threading.Lock()  # guards latencies and counters
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counters)
+        percentiles = {}
+        for percentile in (50, 90, 99):
+            if latencies:
+                index = int(len(latencies) * percentile / 100.0)
+                percentiles['p%d' % percentile] = \
+                    latencies[min(index, len(latencies) - 1)]
+            else:
+                percentiles['p%d' % percentile] = None
+        percentiles['max'] = latencies[-1] if latencies else None
+        with self.breaker.lock:
+            state, failures = self.breaker.state, self.breaker.failures
+        stats.update({'state': state,
+                      'failures': failures,
+                      'latency': percentiles})
+        return stats
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(url):
+    """Return the Backend instance for the scheme/host/port of url."""
+    key = "%s://%s" % urlparse.urlparse(url)[:2]
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = Backend()
+        return _backends[key]
+
+
+def get_stats():
+    """Return breaker state and latency stats of all known backends."""
+    with _backends_lock:
+        backends = _backends.items()
+    return dict((key, backend.get_stats()) for key, backend in backends)
+
+
+def _hedged_request(backend, method, url, timeout, **kwargs):
+    """Issue a request and a duplicate one if it's too slow, return first."""
+    results = Queue.Queue()
+
+    def _request():
+        try:
+            results.put((True, requests.request(method, url, timeout=timeout,
+                                                **kwargs)))
+        except Exception as exc:
+            results.put((False, exc))
+
+    started_at = time.time()
+    attempts = 1
+    threading.Thread(target=_request).start()
+    try:
+        success, result = results.get(timeout=config.GRAPHITE_HEDGE_AFTER)
+    except Queue.Empty:
+        log.info("Hedging slow request to '%s'", url)
+        backend.count('hedged')
+        attempts += 1
+        threading.Thread(target=_request).start()
+        success, result = results.get()
+    if not success and attempts > 1:
+        # the other request may still succeed
+        left = timeout - (time.time() - started_at)
+        try:
+            success, result = results.get(timeout=max(left, 0))
+        except Queue.Empty:
+            pass
+    if not success:
+        raise result
+    return result
+
+
+def request(method, url, **kwargs):
+    """Issue a request to graphite, applying deadline, breaker and hedging.
+
+    Raises GraphiteUnreachableError if the request couldn't be completed,
+    otherwise returns the response, regardless of its status code.
+
+    """
+    backend = get_backend(url)
+    backend.count('requests')
+    timeout = config.GRAPHITE_TIMEOUT
+    at = get_deadline()
+    if at is not None:
+        timeout = min(timeout, at - time.time())
+        if timeout <= 0:
+            backend.count('rejected')
+            raise GraphiteUnreachableError("Deadline exceeded")
+    if not backend.breaker.allow():
+        backend.count('rejected')
+        raise GraphiteUnreachableError("Circuit breaker open")
+    started_at = time.time()
+    try:
+        if config.GRAPHITE_HEDGE_AFTER:
+            resp = _hedged_request(backend, method, url, timeout, **kwargs)
+        else:
+            resp = requests.request(method, url, timeout=timeout, **kwargs)
+    except Exception as exc:
+        log.error("Error sending request to graphite: %r", exc)
+        backend.count('errors')
+        backend.breaker.failure()
+        raise GraphiteUnreachableError(repr(exc))
+    if resp.status_code in (502, 503, 504):
+        backend.count('errors')
+        backend.breaker.failure()
+    else:
+        backend.breaker.success()
+        backend.add_latency(time.time() - started_at)
+    return resp
@@ -0,0 +1,76 @@
+"""Map machine uuids to graphite backends
+
+When GRAPHITE_BACKENDS is configured, the series of every machine are stored
+in a single backend, picked by a consistent hash ring on the machine's uuid.
+The same ring is used by bucky (see ShardedCarbonClient in
+mist.bucky_extras.clients) to route writes, so reads for a machine can be
+sent directly to the backend that owns it. Adding a backend only moves about
+1/N of the machines. Backends must be fed by ShardedCarbonClient, not by a
+carbon-relay, see HashRing.
+
+"""
+
+import bisect
+import hashlib
+
+from mist.monitor import config
+
+
+class HashRing(object):
+    """Consistent hash ring of backend names, keyed by machine uuid.
+
+    Modelled after carbon's ConsistentHashRing, but it is not compatible with
+    it: carbon keys replicas by (server, instance) and places full metric
+    names, whereas this ring places uuids, so that all series of a machine
+    end up in the same backend. It is therefore only consistent with itself,
+    ie with bucky's ShardedCarbonClient, and can't be used to read from a
+    cluster fed by carbon-relay's consistent hashing.
+
+    """
+
+    def __init__(self, nodes, replica_count=100):
+        self.ring = []
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def compute_ring_position(self, key):
+        return int(hashlib.md5(key).hexdigest()[:4], 16)
+
+    def add_node(self, node):
+        for i in xrange(self.replica_count):
+            position = self.compute_ring_position("%s:%d" % (node, i))
+            bisect.insort(self.ring, (position, node))
+
+    def get_node(self, key):
+        if not self.ring:
+            raise ValueError("Hash ring is empty")
+        position = self.compute_ring_position(key)
+        index = bisect.bisect_left(self.ring, (position, '')) % len(self.ring)
+        return self.ring[index][1]
+
+
+_ring = None
+
+
+def get_ring():
+    """Return the HashRing of configured backend names."""
+    global _ring
+    if _ring is None:
+        _ring = HashRing(sorted(config.GRAPHITE_BACKENDS.keys()))
+    return _ring
+
+
+def get_backend_uri(uuid):
+    """Return the uri of the graphite backend that stores uuid's series."""
+    if not config.GRAPHITE_BACKENDS:
+        return config.GRAPHITE_URI
+    return config.GRAPHITE_BACKENDS[get_ring().get_node(uuid)]
+
+
+def group_by_backend(uuids):
+    """Return a dict mapping backend uris to the given uuids they store."""
+    groups = {}
+    for uuid in uuids:
+        groups.setdefault(get_backend_uri(uuid), []).append(uuid)
+    return groups
@@ -0,0 +1,257 @@
+"""Fixed size hash tables in shared, file backed memory
+
+A SharedTable maps 64bit keys (fingerprints of strings, see fingerprint()) to
+fixed size records, packed with the struct module. The table is a memory
+mapped file, so it is shared by all processes that open the same path (eg
+bucky's workers, mist.alert and the API) and it persists across restarts.
+
+The table is an open addressing hash table with linear probing. A key is
+looked up in at most max_probe consecutive slots and new keys are refused
+once max_load of the slots are taken, so lookups never degrade to scanning
+the table. Stale keys are dropped with expire(), which replaces them with
+tombstones that later inserts reuse, so a key never moves once inserted and
+its position can be cached by each process (cached positions are checked on
+every access, in case the key was dropped in the meantime). Inserting or
+dropping keys takes a file lock, while updating or reading an existing key
+is lock free. Readers may therefore see a record that is being updated,
+which is fine for the kind of data (timestamps, offsets, last values) stored
+in these tables. POSIX record locks are used, so that processes forked after
+opening a table still exclude each other.
+
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+MAGIC = "MISTSHT2"
+HEADER = struct.Struct("<8sII32s")  # magic, slots, record size, value format
+COUNT = struct.Struct("<Q")  # number of keys, follows the header
+KEY = struct.Struct("<Q")
+DATA = HEADER.size + COUNT.size  # offset of the first record
+TOMBSTONE = (1 << 64) - 1  # key of records that have been dropped
+EXPIRE_SLOTS = 4096  # records checked per incremental expire() call
+
+
+def fingerprint(*parts):
+    """Return a 64bit int fingerprint of the given strings.
+
+    Fingerprints are never 0 or TOMBSTONE, which mark unused records.
+
+    """
+    digest = hashlib.md5("\0".join(parts)).digest()
+    key = KEY.unpack(digest[:8])[0]
+    return key if key not in (0, TOMBSTONE) else 1
+
+
+class SharedTable(object):
+
+    def __init__(self, path, value_fmt, slots=1 << 16, create=True,
+                 max_probe=64, max_load=0.7):
+        """Open (or create) the table stored in path.
+
+        value_fmt is a struct format string for the values stored per key.
+        If the file exists but was created with a different value format or
+        number of slots, it is recreated.
+
+        If create is False, the table must already exist with the same value
+        format and its number of slots is used, otherwise IOError is raised.
+        This is meant for processes that only read tables maintained by
+        others.
+
+        New keys are looked up and inserted in at most max_probe consecutive
+        slots, and are refused once max_load of all slots are used.
+
+        """
+        self.path = path
+        self.value = struct.Struct("<" + value_fmt.lstrip("<"))
+        self.record_size = KEY.size + self.value.size
+        self.max_load = max_load
+        self._positions = {}  # key -> offset of its record in self.mmap
+        self._lock = threading.Lock()
+        self._full = False  # whether we've warned that the table is full
+        self._expire_index = 0  # slot where the next expire() resumes
+        self.fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0),
+                          0644)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            current = os.read(self.fd, HEADER.size)
+            if not create:
+                try:
+                    magic, slots, record_size, value_fmt = \
+                        HEADER.unpack(current)
+                except struct.error:
+                    magic = None
+                if magic != MAGIC or record_size != self.record_size or \
+                        value_fmt.rstrip("\0") != self.value.format:
+                    raise IOError("Invalid shared table '%s'" % path)
+            self.slots = slots
+            self.max_probe = min(max_probe, slots)
+            self.size = DATA + slots * self.record_size
+            header = HEADER.pack(MAGIC, slots, self.record_size,
+                                 self.value.format)
+            if current != header:
+                if current:
+                    log.warning("Recreating shared table '%s' with "
+                                "different format", path)
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+            self.mmap = mmap.mmap(self.fd, self.size)
+        except:
+            os.close(self.fd)  # also releases the lock
+            raise
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    @property
+    def count(self):
+        """Number of keys in the table."""
+        return COUNT.unpack_from(self.mmap, HEADER.size)[0]
+
+    def _find(self, key, insert=False):
+        """Return the offset of key's record.
+
+        If key isn't found and insert is True, return the offset of the first
+        reusable record on its probe sequence instead. Returns None if there
+        is no such record.
+
+        """
+        reusable = None
+        index = key % self.slots
+        for _ in xrange(self.max_probe):
+            offset = DATA + index * self.record_size
+            found = KEY.unpack_from(self.mmap, offset)[0]
+            if found == key:
+                return offset
+            if found == TOMBSTONE:
+                if reusable is None:
+                    reusable = offset
+            elif not found:
+                break
+            index = (index + 1) % self.slots
+        else:
+            offset = None
+        if insert:
+            return offset if reusable is None else reusable
+
+    def _position(self, key, insert=False):
+        """Return the offset of key's record, optionally inserting key."""
+        offset = self._positions.get(key)
+        if offset is not None:
+            if KEY.unpack_from(self.mmap, offset)[0] == key:
+                return offset
+            del self._positions[key]  # key was dropped in the meantime
+        offset = self._find(key)
+        if offset is not None:
+            self._positions[key] = offset
+            return offset
+        if not insert:
+            return
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                # key may have been inserted by someone else in the meantime
+                offset = self._find(key, insert=True)
+                if offset is None or (
+                        KEY.unpack_from(self.mmap, offset)[0] != key and
+                        self.count >= self.max_load * self.slots):
+                    if not self._full:
+                        log.warning("Shared table '%s' is full, refusing "
+                                    "new keys", self.path)
+                        self._full = True
+                    return
+                if KEY.unpack_from(self.mmap, offset)[0] != key:
+                    # write empty value before key, so that readers never
+                    # see a key pointing to a value of another key
+                    self.mmap[offset + KEY.size:offset + self.record_size] = \
+                        "\0" * self.value.size
+                    KEY.pack_into(self.mmap, offset, key)
+                    COUNT.pack_into(self.mmap, HEADER.size, self.count + 1)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self._positions[key] = offset
+        return offset
+
+    def get(self, key, default=None):
+        """Return the tuple of values stored for key."""
+        offset = self._position(key)
+        if offset is None:
+            return default
+        return self.value.unpack_from(self.mmap, offset + KEY.size)
+
+    def set(self, key, *values):
+        """Store values for key, return False if it can't be inserted."""
+        offset = self._position(key, insert=True)
+        if offset is None:
+            return False
+        self.value.pack_into(self.mmap, offset + KEY.size, *values)
+        return True
+
+    def expire(self, stale, slots=None):
+        """Drop keys for which stale(key, values) is true, return how many.
+
+        Only the next slots records are checked, resuming where the previous
+        call stopped, so that callers can sweep a large table incrementally.
+        By default the whole table is checked.
+
+        """
+        slots = min(slots or self.slots, self.slots)
+        start, self._expire_index = (self._expire_index,
+                                     (self._expire_index + slots) % self.slots)
+        dropped = []
+        for i in xrange(start, start + slots):
+            offset = DATA + (i % self.slots) * self.record_size
+            key = KEY.unpack_from(self.mmap, offset)[0]
+            if key and key != TOMBSTONE and stale(
+                    key, self.value.unpack_from(self.mmap,
+                                                offset + KEY.size)):
+                dropped.append((key, offset))
+        if not dropped:
+            return 0
+        with self._lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                # keys may have been updated or dropped in the meantime
+                dropped = [(key, offset) for key, offset in dropped
+                           if KEY.unpack_from(self.mmap, offset)[0] == key
+                           and stale(key, self.value.unpack_from(
+                               self.mmap, offset + KEY.size))]
+                for key, offset in dropped:
+                    KEY.pack_into(self.mmap, offset, TOMBSTONE)
+                COUNT.pack_into(self.mmap, HEADER.size,
+                                self.count - len(dropped))
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        if not dropped:
+            return 0
+        for key, offset in dropped:
+            self._positions.pop(key, None)
+        self._full = False
+        log.info("Dropped %d stale keys from shared table '%s'",
+                 len(dropped), self.path)
+        return len(dropped)
+
+    def items(self):
+        """Iterate over (key, values) of all keys in the table."""
+        for index in xrange(self.slots):
+            offset = DATA + index * self.record_size
+            key = KEY.unpack_from(self.mmap, offset)[0]
+            if key and key != TOMBSTONE:
+                yield key, self.value.unpack_from(self.mmap,
+                                                  offset + KEY.size)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
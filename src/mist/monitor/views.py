@@ -1,6 +1,8 @@
 import os
 import re
+import json
 import logging
+import calendar
 import traceback
 from subprocess import call
 from time import time
@@ -10,9 +12,11 @@ from pyramid.response import Response
 
 from mist.monitor import config
 from mist.monitor import methods
+from mist.monitor import policy
 from mist.monitor import graphite
 
-from mist.monitor.model import get_all_machines
+from mist.monitor.model import iter_machine_rules
+from mist.monitor.helpers import to_matrix, pack_matrix
 
 from mist.monitor.exceptions import MistError
 from mist.monitor.exceptions import RequiredParameterMissingError
@@ -49,16 +53,36 @@ def exception_handler_mist(exc, request):
     return Response(str(exc), exc.http_code)
 
 
-@view_config(route_name='machines', request_method='GET', renderer='json')
+@view_config(route_name='machines', request_method='GET')
 def list_machines(request):
     """Lists machines with monitoring.
 
-    Returns a dict with uuid's as keys and machine dicts as values.
+    Returns a dict with uuid's as keys and machine dicts, with the ids of all
+    the machine's rules, as values. The response is streamed as machines are
+    read from the db.
+
+    Machines are sorted by uuid. If limit is passed, at most that many
+    machines are returned, and if there may be more, the X-Next-Cursor header
+    holds the value of the after param that fetches the next page. A limit of
+    0, the default, means no limit.
 
     """
-    return {machine.uuid: {'rules': [rule_id]}
-            for machine in get_all_machines()
-            for rule_id in machine.rules}
+    after = request.params.get('after', '')
+    try:
+        limit = int(request.params.get('limit', 0))
+    except ValueError:
+        raise BadRequestError("limit must be an integer")
+    if limit < 0:
+        raise BadRequestError("limit must not be negative")
+    machines = ((uuid, {'rules': rule_ids})
+                for uuid, rule_ids in iter_machine_rules(after, limit))
+    if not limit:
+        return _stream_json_dict(machines)
+    machines = list(machines)
+    response = _stream_json_dict(machines)
+    if len(machines) == limit:
+        response.headers['X-Next-Cursor'] = str(machines[-1][0])
+    return response
 
 
 @view_config(route_name='machine', request_method='PUT')
@@ -74,6 +98,23 @@ def add_machine(request):
     return OK
 
 
+@view_config(route_name='machines', request_method='POST')
+def add_machines(request):
+    """Adds many machines, along with their rules, to monitored list.
+
+    Expects a json dict of uuids mapping to machine dicts, each with a
+    collectd_password and optionally a dict of rules, like reset does.
+
+    """
+    data = request.json_body
+    if not isinstance(data, dict) or not all(isinstance(machine, dict)
+                                             for machine in data.values()):
+        raise BadRequestError("Expected a dict of uuids to machines.")
+    log.info("Adding %d machines to monitor list" % len(data))
+    methods.add_machines(data)
+    return OK
+
+
 @view_config(route_name='machine', request_method='DELETE')
 def remove_machine(request):
     """Removes machine from monitored list."""
@@ -114,6 +155,22 @@ def add_rule(request):
                      reminder_offset=reminder_offset)
     return OK
 
+
+@view_config(route_name='bulk_rules', request_method='POST')
+def add_rules(request):
+    """Add or update many rules of many machines.
+
+    Expects a json dict of uuids mapping to dicts of rule ids to rules.
+
+    """
+    data = request.json_body
+    if not isinstance(data, dict) or not all(isinstance(rules, dict)
+                                             for rules in data.values()):
+        raise BadRequestError("Expected a dict of uuids to dicts of rules.")
+    methods.add_rules(data)
+    return OK
+
+
 @view_config(route_name='rule', request_method='DELETE')
 def remove_rule(request):
     """Removes rule and corresponding condition."""
@@ -156,33 +213,243 @@ def _parse_get_stats_params(request):
     return uuids, metrics, start, stop, interval_str
 
 
+def _set_cache_headers(response, etag, last_modified):
+    if etag is not None:
+        response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def _not_modified(request, etag, last_modified=None):
+    """Return a 304 response if the client's copy is still fresh.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 7232.
+    Otherwise the caching headers are set on request.response, which is used
+    by renderers, and None is returned.
+
+    """
+    if etag is not None and request.if_none_match:
+        fresh = etag in request.if_none_match
+    elif last_modified is not None and request.if_modified_since:
+        fresh = calendar.timegm(
+            request.if_modified_since.utctimetuple()) >= last_modified
+    else:
+        fresh = False
+    if fresh:
+        return _set_cache_headers(Response(status=304), etag, last_modified)
+    _set_cache_headers(request.response, etag, last_modified)
+
+
+def _wants_ndjson(request):
+    """Check if the client opted in for a streaming ndjson response."""
+    return request.params.get('format') == 'ndjson' or \
+        'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+def _stream_ndjson(items):
+    """Return a response that streams items as newline delimited json.
+
+    As in _stream_json_dict, the first item is fetched before the response is
+    returned. An exception raised while fetching later items ends the stream
+    with a {"error": message} line, so that clients can tell it's incomplete.
+
+    """
+    items = iter(items)
+    try:
+        first = next(items)
+    except StopIteration:
+        return Response('', content_type='application/x-ndjson')
+
+    def _app_iter():
+        yield json.dumps(first) + '\n'
+        try:
+            for item in items:
+                yield json.dumps(item) + '\n'
+        except Exception as exc:
+            log.error("Error while streaming response: %r", exc)
+            yield json.dumps({'error': str(exc)}) + '\n'
+
+    return Response(app_iter=_app_iter(), content_type='application/x-ndjson')
+
+
+def _matrix_response(request, series_list):
+    """Return series in the columnar format of helpers.to_matrix.
+
+    If encoding=binary is passed, the matrix is packed as little endian
+    float64 columns (see helpers.pack_matrix), otherwise it's sent as json.
+
+    """
+    matrix = to_matrix(series_list)
+    if request.params.get('encoding') == 'binary':
+        return Response(pack_matrix(matrix),
+                        content_type='application/octet-stream')
+    return Response(json.dumps(matrix), content_type='application/json')
+
+
 @view_config(route_name='stats', request_method='GET', renderer='json')
 def get_stats(request):
-    """Returns all stats for a machine, the client will draw them."""
+    """Returns all stats for a machine, the client will draw them.
+
+    If the client accepts application/x-ndjson or passes format=ndjson, each
+    series is streamed as a json line as soon as it's fetched from graphite.
+    Streamed series aren't aligned to a common start/stop.
+
+    If format=matrix is passed, the series are returned as a single
+    timestamp axis and a column of values per series (see _matrix_response).
+
+    Responses carry an ETag (see methods.get_stats_etag), so that pollers get
+    a 304 without graphite being queried if nothing changed.
+
+    """
 
     uuid = request.matchdict['machine']
     _, metrics, start, stop, interval_str = _parse_get_stats_params(request)
-    return methods.get_stats(uuid, metrics, start, stop, interval_str)
+    variant = "ndjson" if _wants_ndjson(request) else "%s/%s" % (
+        request.params.get('format', ''), request.params.get('encoding', ''))
+    etag, last_modified = methods.get_stats_etag(
+        uuid, metrics, start, stop, interval_str, variant=variant
+    )
+    not_modified = _not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    if _wants_ndjson(request):
+        return _set_cache_headers(_stream_ndjson(
+            methods.iter_stats(uuid, metrics, start, stop, interval_str)
+        ), etag, last_modified)
+    data = methods.get_stats(uuid, metrics, start, stop, interval_str)
+    if request.params.get('format') == 'matrix':
+        return _set_cache_headers(_matrix_response(request, data),
+                                  etag, last_modified)
+    return data
+
+
+@view_config(route_name='bulk_stats', request_method=('GET', 'POST'),
+             renderer='json')
+def get_bulk_stats(request):
+    """Returns stats of many machines, keyed by uuid
+
+    Each machine's stats are the same as those returned for a single machine.
+    Uuids and metrics can be passed either as query params or in the json
+    body of a POST request. Responses can be streamed as in get_stats, with
+    the uuid of each series in its 'uuid' key.
+
+    """
+    uuids, metrics, start, stop, interval_str = \
+        _parse_get_stats_params(request)
+    if not uuids:
+        raise RequiredParameterMissingError("uuid")
+    if not metrics:
+        raise RequiredParameterMissingError("metric")
+    if _wants_ndjson(request):
+        return _stream_ndjson(
+            dict(item, uuid=uuid) for uuid, item in methods.iter_bulk_stats(
+                uuids, metrics, start, stop, interval_str)
+        )
+    return methods.get_bulk_stats(uuids, metrics, start, stop, interval_str)
+
+
+def _stream_json_dict(items):
+    """Return a response that streams a json object from (key, value) items.
+
+    The first item is fetched before the response is returned, so that errors
+    that affect the entire request are still translated to proper http error
+    responses by the exception view. Since the status has been sent by the
+    time later items are fetched, an exception raised by them ends the object
+    with an '_error' key holding its message, so that it's still valid json.
+
+    """
+    items = iter(items)
+    try:
+        first = next(items)
+    except StopIteration:
+        return Response('{}', content_type='application/json')
+
+    def _app_iter():
+        yield '{%s: %s' % (json.dumps(first[0]), json.dumps(first[1]))
+        try:
+            for key, value in items:
+                yield ', %s: %s' % (json.dumps(key), json.dumps(value))
+        except Exception as exc:
+            log.error("Error while streaming response: %r", exc)
+            yield ', "_error": %s' % json.dumps(str(exc))
+        yield '}'
+
+    return Response(app_iter=_app_iter(), content_type='application/json')
 
 
-@view_config(route_name='load', request_method='GET', renderer='json')
+@view_config(route_name='load', request_method=('GET', 'POST'))
 def get_load(request):
-    """Returns shortterm load for many machines"""
+    """Returns shortterm load for many machines
+
+    Uuids can be passed either as query params or, for large sets of
+    machines, in the json body of a POST request. If format=matrix is passed,
+    series are aligned and returned as in get_stats, named by uuid.
+
+    """
     uuids, _, start, stop, interval_str = _parse_get_stats_params(request)
-    return methods.get_load(uuids, start, stop, interval_str)
+    if request.params.get('format') == 'matrix':
+        data = [item for _, item in methods.iter_load(uuids, start, stop,
+                                                      interval_str)]
+        return _matrix_response(request, graphite.align_datapoints(data))
+    return _stream_json_dict(
+        methods.iter_load(uuids, start, stop, interval_str)
+    )
 
 
-@view_config(route_name='cores', request_method='GET', renderer='json')
+@view_config(route_name='cores', request_method=('GET', 'POST'))
 def get_cores(request):
     """Returns number of cores for many machines"""
     uuids, _, start, stop, interval_str = _parse_get_stats_params(request)
-    return methods.get_cores(uuids, start, stop, interval_str)
+    return _stream_json_dict(
+        methods.iter_cores(uuids, start, stop, interval_str)
+    )
+
+
+@view_config(route_name='last_values', request_method=('GET', 'POST'),
+             renderer='json')
+def get_last_values(request):
+    """Returns latest value and timestamp of metrics for many machines
+
+    Uuids and metrics can be passed either as query params or in the json
+    body of a POST request.
+
+    """
+    uuids, metrics, _, _, _ = _parse_get_stats_params(request)
+    if not uuids:
+        raise RequiredParameterMissingError("uuid")
+    if not metrics:
+        raise RequiredParameterMissingError("metric")
+    return methods.get_last_values(uuids, metrics)
 
 
 @view_config(route_name='find_metrics', request_method='GET', renderer='json')
 def find_metrics(request):
+    """Returns the metrics of a machine
+
+    Responses carry an ETag based on the version of the machine's metric set,
+    which is bumped whenever bucky discovers new metrics, so that pollers get
+    a 304 without graphite being queried if nothing changed.
+
+    """
     uuid = request.matchdict['machine']
-    return methods.find_metrics(uuid)
+    etag, last_modified, meta = methods.get_metrics_etag(uuid)
+    not_modified = _not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    return methods.find_metrics(uuid, meta=meta)
+
+
+@view_config(route_name='graphite_status', request_method='GET',
+             renderer='json')
+def graphite_status(request):
+    """Returns circuit breaker state and latency stats of graphite backends.
+
+    Stats are kept per process, so they refer to the worker that happened to
+    serve the request.
+
+    """
+    return policy.get_stats()
 
 
 @view_config(route_name='reset', request_method='POST')
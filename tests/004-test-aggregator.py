@@ -0,0 +1,91 @@
+import time
+import socket
+
+from mist.bucky_extras.carbon import PlaintextCarbonSink
+from mist.bucky_extras.processors.aggregator import TotalsAggregator
+
+
+class ListSink(object):
+    def __init__(self):
+        self.samples = []
+
+    def send(self, host, name, value, timestamp):
+        self.samples.append((host, name, value, timestamp))
+
+
+def test_totals():
+    sink = ListSink()
+    aggregator = TotalsAggregator(sink, step=10)
+    samples = [
+        ('host', 'cpu.0.idle', 60.0),
+        ('host', 'cpu.0.user', 40.0),
+        ('host', 'cpu.1.idle', 90.0),
+        ('host', 'cpu.1.system', 10.0),
+        ('host', 'memory.used', 300.0),
+        ('host', 'memory.free', 700.0),
+        ('host', 'disk.sda.disk_octets.read', 5.0),
+        ('host', 'disk.sdb.disk_octets.read', 7.0),
+        ('host', 'disk.sda.disk_ops.read', 1.0),
+        ('host', 'interface.eth0.if_octets.tx', 3.0),
+        ('host', 'load.shortterm', 1.0),
+    ]
+    for host, name, val in samples:
+        assert aggregator(host, name, val, 101) == (host, name, val, 101)
+    assert not sink.samples, "bucket emitted before it was complete"
+
+    aggregator('host', 'cpu.0.idle', 50.0, 111)
+    totals = dict((name, (val, ts)) for _, name, val, ts in sink.samples)
+    assert totals == {
+        'cpu.total.nonidle': (25.0, 100),
+        'memory.nonfree_percent': (30.0, 100),
+        'disk.total.disk_octets.read': (12.0, 100),
+        'interface.total.if_octets.tx': (3.0, 100),
+    }, totals
+
+
+def test_totals_cycles():
+    sink = ListSink()
+    aggregator = TotalsAggregator(sink, step=10, grace=20)
+    # a cycle that straddles a step boundary is summed as a whole
+    aggregator('host', 'disk.sda.disk_octets.read', 5.0, 109)
+    aggregator('host', 'disk.sdb.disk_octets.read', 7.0, 110)
+    aggregator('host', 'disk.sda.disk_octets.read', 6.0, 119)
+    assert sink.samples == [('host', 'disk.total.disk_octets.read', 12.0,
+                             100)]
+
+    # buckets of hosts that stopped sending are emitted after grace
+    aggregator.flush_idle(time.time() + 10)
+    assert len(sink.samples) == 1
+    aggregator.flush_idle(time.time() + 30)
+    assert sink.samples[1:] == [('host', 'disk.total.disk_octets.read', 6.0,
+                                 110)]
+    assert not aggregator._buckets
+
+
+def test_carbon_sink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+
+    # nothing listening, data is dropped without blocking
+    sink = PlaintextCarbonSink("127.0.0.1", port, timeout=0.5)
+    sink.send("host", "load.shortterm", 1.0, 100)
+    sink.flush()
+    started = time.time()
+    while not sink.dropped and time.time() - started < 5:
+        sink.write("")
+    assert sink.dropped == len("host.load.shortterm 1.0 100\n")
+    assert time.time() - started < 1
+    server.listen(1)
+    sink.last_connect = 0
+    sink.send("host", "load.shortterm", 1.0, 100)
+    sink.flush()
+    conn, _ = server.accept()
+    deadline = time.time() + 5
+    while sink.pending and time.time() < deadline:
+        sink.write("")
+    conn.settimeout(5)
+    assert conn.recv(1024).endswith(" 1.0 100\n")
+    conn.close()
+    server.close()
+    sink.close()
@@ -0,0 +1,15 @@
+from mist.monitor.sharding import HashRing
+
+
+def test_hash_ring():
+    keys = ["%032x" % (i * 7919) for i in range(2000)]
+    ring = HashRing(["a", "b", "c"])
+    nodes = [ring.get_node(key) for key in keys]
+    assert nodes == [HashRing(["c", "b", "a"]).get_node(key) for key in keys]
+    for node in ("a", "b", "c"):
+        assert nodes.count(node) > 400, "uneven distribution"
+
+    # adding a node only moves keys to the new node
+    bigger = HashRing(["a", "b", "c", "d"])
+    for key, node in zip(keys, nodes):
+        assert bigger.get_node(key) in (node, "d")
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+
+from mist.monitor.shm_table import SharedTable, fingerprint
+
+
+def test_shared_table():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "table.shm")
+        table = SharedTable(path, "id", slots=8, max_load=1)
+        assert table.get(fingerprint("a")) is None
+        for i in range(8):
+            assert table.set(fingerprint("host%d" % i), i, i / 2.0)
+        assert not table.set(fingerprint("one too many"), 0, 0)
+        assert table.set(fingerprint("host3"), -3, 1.5)
+        other = SharedTable(path, "id", slots=8, max_load=1)
+        assert other.get(fingerprint("host3")) == (-3, 1.5)
+        assert len(other) == 8
+        table.close()
+        other.close()
+
+        # values persist, unless the format changes
+        table = SharedTable(path, "id", slots=8)
+        assert table.get(fingerprint("host7")) == (7, 3.5)
+        table.close()
+        table = SharedTable(path, "i", slots=8)
+        assert not len(table)
+        table.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_shared_table_bounds():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "table.shm")
+        table = SharedTable(path, "d", slots=64, max_probe=4)
+        keys = [fingerprint("host%d" % i) for i in range(100)]
+        inserted = [key for key in keys if table.set(key, key % 100)]
+        assert len(table) == len(inserted) <= int(0.7 * 64) + 1
+        assert not table.set(keys[-1], 0) or keys[-1] in inserted
+        # lookups of missing keys are bounded by max_probe
+        assert all(table.get(key) is None for key in keys
+                   if key not in inserted)
+
+        # stale keys are dropped, cached positions of others are checked
+        other = SharedTable(path, "d", slots=64, max_probe=4)
+        assert other.get(inserted[0]) == (inserted[0] % 100, )
+        assert table.expire(lambda key, values: key == inserted[0],
+                            slots=32) + table.expire(
+            lambda key, values: key == inserted[0], slots=32) == 1
+        assert len(other) == len(inserted) - 1
+        assert other.get(inserted[0]) is None
+        assert table.set(keys[-1], -1) and other.get(keys[-1]) == (-1, )
+        assert other.get(inserted[0]) is None
+        table.close()
+        other.close()
+    finally:
+        shutil.rmtree(tmpdir)
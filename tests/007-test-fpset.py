@@ -0,0 +1,13 @@
+from mist.bucky_extras.fpset import FingerprintSet
+
+
+def test_fingerprint_set():
+    seen = FingerprintSet(capacity=4)
+    keys = [("host%d" % (i % 7), "metric%d" % i) for i in range(1000)]
+    for key in keys[:500]:
+        seen.add(key)
+        seen.add(key)
+    assert len(seen) == 500
+    assert all(key in seen for key in keys[:500])
+    assert not any(key in seen for key in keys[500:])
+    assert seen.nbytes() <= 500 / seen.max_load * 2 * 8
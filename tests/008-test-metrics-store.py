@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+
+from mist.bucky_extras.metrics_store import MetricsStore, remove_host
+
+
+def test_metrics_store():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "discovered_metrics.conf")
+        with open(path, "w") as f:
+            f.write("h2 load.shortterm\nh1 cpu.0.idle\nh2 load.shortterm\n"
+                    "h3 df.root.free\n")
+        store = MetricsStore(path)
+        assert ("h2", "load.shortterm") in store
+        assert ("h2", "load.midterm") not in store
+        store.append("h2", ["load.midterm"])
+        remove_host(path, "h3")
+        store.compact()
+        assert os.path.getsize(path) == 0
+        assert store.names("h2") == set(["load.shortterm", "load.midterm"])
+
+        store.append("h1", ["cpu.0.user"])
+        store = MetricsStore(path)
+        for key in (("h1", "cpu.0.idle"), ("h1", "cpu.0.user"),
+                    ("h2", "load.midterm")):
+            assert key in store
+        assert ("h3", "df.root.free") not in store
+        assert store.names("h1") == set(["cpu.0.idle", "cpu.0.user"])
+        assert store.names("h0") == set()
+        assert store.names("h3") == set()
+        store.compact()
+        assert MetricsStore(path).names("h1") == store.names("h1")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_metrics_store_concurrent_compaction():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "discovered_metrics.conf")
+        first, second = MetricsStore(path), MetricsStore(path)
+        first.append("h1", ["cpu.0.idle"])
+        second.append("h2", ["load.shortterm"])
+        first.compact()
+        second.append("h3", ["df.root.free"])
+        second.compact()
+        store = MetricsStore(path)
+        for key in (("h1", "cpu.0.idle"), ("h2", "load.shortterm"),
+                    ("h3", "df.root.free")):
+            assert key in store
+
+        # removed hosts are unknown before the next compaction
+        remove_host(path, "h1")
+        store = MetricsStore(path)
+        assert ("h1", "cpu.0.idle") not in store
+        assert ("h2", "load.shortterm") in store
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,86 @@
+from time import time
+
+from mist.bucky_extras.processors.composite import gen_composite_processor
+from mist.bucky_extras.processors.timeprocessor import TimeDiff
+from mist.bucky_extras.processors.timeprocessor import \
+    TimeConverterSingleThread
+
+
+def drop_swap(host, name, val, timestamp):
+    if not name.startswith("swap."):
+        return host, name, val * 2, timestamp
+
+
+def test_batch_matches_per_sample():
+    now = int(time()) + 0.5  # so that offsets don't depend on rounding
+    samples = [
+        ("h1", "cpu.0.idle", 1.0, now + 100),
+        ("h1", "swap.used", 2.0, now + 100),
+        ("h2", "load.shortterm", 3.0, now - 5),
+        ("h2", "load.midterm", 4.0, now - 10 ** 6),
+        ("h1", "cpu.0.user", 5.0, now + 98),
+    ]
+    processors = [
+        gen_composite_processor(TimeDiff(past=3600), drop_swap,
+                                TimeConverterSingleThread(13))
+        for _ in range(2)
+    ]
+    expected = filter(None, [processors[0](*sample) for sample in samples])
+    columns = processors[1].process_batch(*map(list, zip(*samples)))
+    assert zip(*columns) == expected
+    assert [sample[2] for sample in expected] == [2.0, 6.0, 10.0]
+    assert [sample[3] for sample in expected] == [now, now - 5, now - 2]
+
+
+class ListSink(object):
+    def __init__(self):
+        self.samples = []
+
+    def send(self, host, name, value, timestamp):
+        self.samples.append((name, value))
+
+
+def test_profiled_processor():
+    sink = ListSink()
+    processor = gen_composite_processor(drop_swap, TimeDiff(),
+                                        profile_sink=sink, profile_interval=0)
+    processor.process_batch(["h1", "h1"], ["cpu.0.idle", "swap.used"],
+                            [1.0, 2.0], [0, 0])
+    assert all(name.startswith("processors.bucky.")
+               for name, value in sink.samples)
+    stats = dict((name.split(".", 2)[2], value)
+                 for name, value in sink.samples)
+    assert stats["0_drop_swap.samples"] == 2
+    assert stats["0_drop_swap.dropped"] == 1
+    assert stats["1_TimeDiff.samples"] == 1
+    assert stats["1_TimeDiff.dropped"] == 0
+
+
+class CountSamples(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, host, name, val, timestamp):
+        self.count += 1
+        return host, name, val, timestamp
+
+
+def fail_on_none(host, name, val, timestamp):
+    return host, name, val + 1, timestamp
+
+
+def test_batch_stage_error():
+    counters = CountSamples(), CountSamples()
+    processor = gen_composite_processor(counters[0], fail_on_none,
+                                        counters[1])
+    columns = processor.process_batch(["h1"] * 3, ["a", "b", "c"],
+                                      [1.0, None, 3.0], [0, 0, 0])
+    # only the failing stage is replayed, the bad sample skips it
+    assert [counter.count for counter in counters] == [3, 3]
+    assert columns[2] == [2.0, None, 4.0]
+
+    processor.drop_on_error = True
+    columns = processor.process_batch(["h1"] * 3, ["a", "b", "c"],
+                                      [1.0, None, 3.0], [0, 0, 0])
+    assert [counter.count for counter in counters] == [6, 5]
+    assert columns[1] == ["a", "c"]
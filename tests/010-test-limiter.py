@@ -0,0 +1,41 @@
+from mist.bucky_extras.processors.limiter import HostLimiter
+
+
+def test_host_limiter():
+    limiter = HostLimiter(max_metrics=3, max_rate=10, burst=1, window=100)
+    now = 1000.0
+    names = ["m%d" % i for i in range(5)]
+    allowed = [limiter.allow("h1", name, now) for name in names]
+    assert allowed == [True, True, True, False, False]
+    assert limiter.allow("h2", "m4", now)
+    # known names are still allowed, until the rate limit is hit
+    allowed = [limiter.allow("h1", "m0", now) for _ in range(10)]
+    assert allowed == [True] * 7 + [False] * 3
+    assert limiter.allow("h1", "m1", now + 0.1)
+    assert limiter.get_stats() == {
+        "h1": {"rejected_metrics": 2, "rejected_rate": 3},
+    }
+
+    # names not seen for a whole window no longer count
+    limiter.rotate(now + 100)
+    assert limiter.allow("h1", "m0", now + 101)
+    limiter.rotate(now + 200)
+    assert [limiter.allow("h1", name, now + 201) for name in names] == \
+        [True, True, True, False, False]
+
+
+def test_host_limiter_prune():
+    limiter = HostLimiter(max_rate=1, burst=10, report_interval=60)
+    now = limiter.reported_at
+    for i in range(100):
+        limiter.allow("h%d" % i, "m0", now)
+    for _ in range(10):
+        limiter.allow("h0", "m0", now + 59)
+    assert len(limiter.buckets) == 100
+
+    # buckets refilled to full are dropped, the rest are kept
+    limiter.maintain(now + 61)
+    assert limiter.buckets.keys() == ["h0"]
+    assert not limiter.rejected
+    limiter.rotate(now + 120)
+    assert not limiter.buckets
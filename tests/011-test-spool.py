@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from mist.bucky_extras.spool import Spool
+from mist.bucky_extras.clients.spool_client import SpoolingCarbonClient
+
+
+def test_spool():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        spool = Spool(tmpdir, segment_bytes=100, max_bytes=1000)
+        lines = ["a.b %d %d\n" % (i, 1000 + i) for i in range(30)]
+        for line in lines:
+            spool.append(line)
+        assert spool.depth() == len("".join(lines))
+        assert len(spool.segments) > 1
+
+        data = spool.read(50)
+        assert data == "".join(lines[:4])
+        spool.commit(len(data))
+
+        # read position survives restarts
+        spool = Spool(tmpdir, segment_bytes=100, max_bytes=1000)
+        replayed = ""
+        while spool.depth():
+            data = spool.read(64)
+            replayed += data
+            spool.commit(len(data))
+        assert replayed == "".join(lines[4:])
+        assert os.listdir(tmpdir) == ["position"]
+
+        # oldest segments are dropped when over max_bytes
+        for i in range(100):
+            spool.append("a.b %d %d\n" % (i, 2000 + i))
+        assert 900 < spool.depth() <= 1000
+        assert not spool.read(1000).startswith("a.b 0 ")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class Cfg(object):
+    graphite_ip = "127.0.0.1"
+    graphite_port = 2003
+
+
+class FakeSink(object):
+
+    def __init__(self):
+        self.up = False
+        self.data = ""
+
+    def write(self, data):
+        if self.up:
+            self.data += data
+        return self.up
+
+
+def test_spool_client():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg = Cfg()
+        cfg.spool_dir = tmpdir
+        # bucky's carbon client would write every sample again
+        with pytest.raises(ValueError):
+            SpoolingCarbonClient(cfg, None)
+
+        cfg.spool_graphite_port = 2004
+        client = SpoolingCarbonClient(cfg, None)
+        client.sink = FakeSink()
+        client.send("h1", "load.shortterm", 1.0, 1000)
+        client.flushed_at = 0
+        client.tick()
+        assert not client.healthy and client.spool.depth()
+
+        # recovers and replays while idle
+        client.sink.up = True
+        client.flushed_at = 0
+        client.tick()
+        assert client.healthy and not client.spool.depth()
+        assert client.sink.data == "h1.load.shortterm 1.0 1000\n"
+    finally:
+        shutil.rmtree(tmpdir)
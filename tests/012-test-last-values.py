@@ -0,0 +1,54 @@
+import os
+import time
+import shutil
+import tempfile
+
+from mist.monitor import config
+from mist.monitor import methods
+from mist.bucky_extras.processors.last_values import LastValueRecorder
+
+
+def test_last_values():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "last_values.shm")
+    old_path, config.LAST_VALUES_PATH = config.LAST_VALUES_PATH, path
+    methods._last_values.clear()
+    try:
+        recorder = LastValueRecorder(path, slots=64, prefixes=("load.", ),
+                                     max_age=None)
+        recorder("h1", "load.shortterm", 0.5, 1000)
+        recorder.process_batch(["h1", "h2", "h1"],
+                               ["load.shortterm", "load.shortterm", "cpu.0"],
+                               [0.7, 1.5, 99.0], [1010, 1005, 1010])
+        assert methods.get_last_values(["h1", "h2", "h3"],
+                                       ["load.shortterm", "cpu.0"]) == {
+            "h1": {"load.shortterm": [0.7, 1010], "cpu.0": None},
+            "h2": {"load.shortterm": [1.5, 1005], "cpu.0": None},
+            "h3": {"load.shortterm": None, "cpu.0": None},
+        }
+    finally:
+        config.LAST_VALUES_PATH = old_path
+        methods._last_values.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_last_values_full():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        recorder = LastValueRecorder(os.path.join(tmpdir, "last_values.shm"),
+                                     slots=16)
+        now = time.time()
+        recorder.process_batch(["h%d" % i for i in range(16)],
+                               ["load.shortterm"] * 16, [1.0] * 16,
+                               [now - 3600] * 8 + [now - 2 * 86400] * 8)
+        assert len(recorder.table) <= 12 and recorder._refused
+        assert len(recorder._refused) + len(recorder.table) == 16
+
+        # old metrics are dropped and refused ones may be retried
+        recorder._expired_at = 0
+        recorder.process_batch([], [], [], [])
+        assert len(recorder.table) == 8 and not recorder._refused
+        recorder("h8", "load.shortterm", 2.0, now)
+        assert len(recorder.table) == 9
+    finally:
+        shutil.rmtree(tmpdir)
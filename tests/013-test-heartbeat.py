@@ -0,0 +1,62 @@
+import os
+import time
+import shutil
+import tempfile
+
+from mist.monitor import config
+from mist.monitor import heartbeat
+from mist.monitor.graphite import NoDataHandler
+from mist.bucky_extras.processors.heartbeat import HeartbeatRecorder
+
+
+def test_heartbeat():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "heartbeat.shm")
+    old_path, config.HEARTBEAT_PATH = config.HEARTBEAT_PATH, path
+    heartbeat._tables.clear()
+    try:
+        assert not heartbeat.is_available(90)
+        now = time.time()
+        recorder = HeartbeatRecorder(path, slots=64)
+        recorder.process_batch(["h1", "h2", "h1"], ["a", "a", "b"],
+                               [1, 2, 3], [0, 0, 0])
+        # just started, hosts may have been sending before
+        assert not heartbeat.is_available(90)
+        recorder.table.set(heartbeat.STARTED_KEY, now - 1000)
+        recorder.table.set(heartbeat.fingerprint("h2"), now - 100)
+        assert heartbeat.is_available(90)
+        assert heartbeat.get_last_seen("h1") >= now
+        assert heartbeat.get_last_seen("h3") is None
+
+        index = heartbeat.HeartbeatIndex()
+        index.update(["h1", "h2", "h3"])
+        assert sorted(index.silent(90)) == ["h2", "h3"]
+        recorder._written.clear()  # allow writing again within the second
+        recorder("h2", "a", 1, 0)
+        assert index.silent(90) == ["h3"]
+        assert sorted(index.silent(90, now=now + 1000)) == ["h1", "h2", "h3"]
+
+        # nodata of silent hosts and those that just recovered is checked
+        assert index.changed(90) == set(["h1", "h2", "h3"])
+        assert index.changed(90) == set(["h3"])
+        recorder.table.set(heartbeat.fingerprint("h3"), now)
+        assert index.changed(90) == set(["h3"])
+        assert index.changed(90) == set()
+        index.reset()
+        assert index.changed(90) == set(["h1", "h2", "h3"])
+        recorder.table.set(heartbeat.fingerprint("h3"), 0)
+
+        data = NoDataHandler("h1").get_data_from_heartbeat("-90sec")
+        assert [value for value, _ in data[0]['datapoints']] == [0]
+        assert data[0]['_requested_target'] == "nodata"
+        recorder.table.set(heartbeat.fingerprint("h1"), now - 200)
+        data = NoDataHandler("h1").get_data_from_heartbeat("-2min")
+        assert [value for value, _ in data[0]['datapoints']] == [1]
+        assert NoDataHandler("h3").get_data_from_heartbeat("-90sec") == []
+        # histories can't be answered from heartbeats
+        assert NoDataHandler("h1").get_data_from_heartbeat("-1h") is None
+        assert NoDataHandler("h1").get_data_from_heartbeat("1000") is None
+    finally:
+        config.HEARTBEAT_PATH = old_path
+        heartbeat._tables.clear()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,43 @@
+import re
+
+from mist.monitor import methods
+
+
+def test_bulk_stats(monkeypatch):
+    requests = []
+
+    def get_multi(target, start="", stop="", interval_str="",
+                  graphite_uri=""):
+        requests.append(target)
+        match = re.match(r'^bucky\.\{(.*)\}\.(.*)$', target)
+        uuids, path = match.group(1).split(','), match.group(2)
+        return [{'target': 'bucky.%s.%s' % (uuid, path),
+                 'datapoints': [[1.0, 10], [2.0, 20]]}
+                for uuid in uuids if uuid != 'c']
+
+    def get_stats(uuid, metrics, start="", stop="", interval_str=""):
+        return [{'_requested_target': metric, 'alias': metric,
+                 'datapoints': [[0, 10], [0, 20]]} for metric in metrics]
+
+    monkeypatch.setattr(methods, 'get_multi', get_multi)
+    monkeypatch.setattr(methods, 'get_stats', get_stats)
+    monkeypatch.setattr(methods.config, 'GRAPHITE_CHUNK_SIZE', 2)
+
+    uuids = ['a', 'b', 'c']
+    result = methods.get_bulk_stats(uuids, ['load.shortterm', 'nodata'])
+    # load is fetched for all machines with a request per chunk of uuids,
+    # while nodata can't be combined so it's fetched per machine
+    assert sorted(requests) == ['bucky.{a,b}.load.shortterm',
+                                'bucky.{c}.load.shortterm']
+    assert sorted(result) == uuids
+    for uuid in uuids:
+        series = dict((item['_requested_target'], item)
+                      for item in result[uuid])
+        assert series['nodata']['datapoints'] == [[0, 10], [0, 20]]
+        if uuid == 'c':
+            assert 'load.shortterm' not in series
+        else:
+            load = series['load.shortterm']
+            assert load['alias'] == 'load.shortterm'
+            assert load['name'] == 'Load'
+            assert load['datapoints'] == [[1.0, 10], [2.0, 20]]
@@ -0,0 +1,48 @@
+import json
+
+from webob import Request
+
+from mist.monitor import views
+from mist.monitor import methods
+from mist.monitor import graphite
+
+
+def test_ndjson_stats(monkeypatch):
+    def get_data(self, targets, start="", stop="", interval_str=""):
+        if 'cpu.0.idle' in targets:
+            raise graphite.GraphiteError("bad target")
+        return [{'target': '%(head)s.' + target, 'alias': '%(head)s.' + target,
+                 '_requested_target': target, 'datapoints': [[1, 10]]}
+                for target in targets]
+
+    monkeypatch.setattr(graphite.GenericHandler, 'get_data', get_data)
+    items = list(methods.iter_stats('a', ['load.shortterm', 'cpu.0.idle']))
+    assert items == [
+        {'target': '%(head)s.load.shortterm', 'alias': 'load.shortterm',
+         '_requested_target': 'load.shortterm', 'datapoints': [[1, 10]]},
+        {'_requested_target': 'cpu.0.idle', 'alias': 'cpu.0.idle',
+         'datapoints': [],
+         'error': str(graphite.GraphiteError("bad target"))},
+    ]
+
+    assert views._wants_ndjson(Request.blank('/?format=ndjson'))
+    assert views._wants_ndjson(
+        Request.blank('/', accept='application/x-ndjson'))
+    assert not views._wants_ndjson(Request.blank('/', accept='*/*'))
+    assert not views._wants_ndjson(Request.blank('/'))
+
+    resp = views._stream_ndjson(iter(items))
+    assert resp.content_type == 'application/x-ndjson'
+    assert [json.loads(line) for line in resp.body.splitlines()] == items
+
+
+def test_ndjson_stream_error():
+    def items():
+        yield {'alias': 'load.shortterm', 'datapoints': []}
+        raise graphite.GraphiteError("failed")
+
+    resp = views._stream_ndjson(items())
+    assert [json.loads(line) for line in resp.body.splitlines()] == [
+        {'alias': 'load.shortterm', 'datapoints': []},
+        {'error': str(graphite.GraphiteError("failed"))},
+    ]
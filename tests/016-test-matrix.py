@@ -0,0 +1,36 @@
+import json
+import math
+import struct
+
+from mist.monitor.helpers import to_matrix, pack_matrix
+
+
+def test_matrix():
+    series = [
+        {'alias': 'load.shortterm', 'name': 'Load',
+         'datapoints': [[0.5, 100], [None, 110], [0.7, 120]]},
+        {'alias': 'cpu.0.idle', 'name': 'Cpu 0 idle',
+         'datapoints': [[90.0, 100], [80.0, 120]]},
+    ]
+    matrix = to_matrix(series)
+    assert matrix == {
+        'start': 100, 'step': 10, 'count': 3,
+        'series': [
+            {'alias': 'load.shortterm', 'name': 'Load',
+             'values': [0.5, None, 0.7]},
+            {'alias': 'cpu.0.idle', 'name': 'Cpu 0 idle',
+             'values': [90.0, None, 80.0]},
+        ],
+    }
+    assert to_matrix([]) == {'start': 0, 'step': 0, 'count': 0,
+                             'series': []}
+
+    data = pack_matrix(matrix)
+    length, = struct.unpack_from("<I", data)
+    header = json.loads(data[4:4 + length])
+    assert header['count'] == 3
+    assert [item['alias'] for item in header['series']] == [
+        'load.shortterm', 'cpu.0.idle']
+    values = struct.unpack_from("<6d", data, 4 + length)
+    assert len(data) == 4 + length + 6 * 8
+    assert values[0] == 0.5 and math.isnan(values[1]) and values[5] == 80.0
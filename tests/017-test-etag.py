@@ -0,0 +1,72 @@
+import os
+import time
+import shutil
+import tempfile
+
+from pyramid import testing
+from pyramid.request import Request
+
+from mist.monitor import views
+from mist.monitor import config
+from mist.monitor import methods
+from mist.monitor import heartbeat
+from mist.bucky_extras.processors.heartbeat import HeartbeatRecorder
+
+
+def test_stats_etag():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "heartbeat.shm")
+    old_path, config.HEARTBEAT_PATH = config.HEARTBEAT_PATH, path
+    heartbeat._tables.clear()
+    try:
+        assert methods.get_stats_etag("h1", ["load.shortterm"]) == (None,
+                                                                    None)
+        recorder = HeartbeatRecorder(path, slots=64)
+        now = time.time()
+        recorder.table.set(heartbeat.fingerprint("h1"), now - 3600)
+        etag, last_modified = methods.get_stats_etag(
+            "h1", ["load.shortterm", "cpu.0.idle"], "-1h", "")
+        assert etag and last_modified is None
+        assert etag == methods.get_stats_etag(
+            "h1", ["cpu.0.idle", "load.shortterm"], "-1h", "")[0]
+        assert etag != methods.get_stats_etag(
+            "h1", ["load.shortterm", "cpu.0.idle"], "-1h", "",
+            variant="matrix")[0]
+
+        # past ranges don't change once data newer than them has arrived
+        stop = int(now - 7200)
+        etag, last_modified = methods.get_stats_etag(
+            "h1", ["load.shortterm"], str(stop - 600), str(stop))
+        assert last_modified == stop
+        recorder.table.set(heartbeat.fingerprint("h1"), now)
+        assert methods.get_stats_etag("h1", ["load.shortterm"],
+                                      str(stop - 600), str(stop)) == (
+            etag, last_modified)
+    finally:
+        config.HEARTBEAT_PATH = old_path
+        heartbeat._tables.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_not_modified():
+    registry = testing.setUp().registry
+
+    def blank(**headers):
+        request = Request.blank('/', headers=headers)
+        request.registry = registry
+        return request
+
+    try:
+        request = blank(**{'If-None-Match': '"abc"'})
+        assert views._not_modified(request, "abc").status_int == 304
+        request = blank(**{'If-None-Match': '"abc"'})
+        assert views._not_modified(request, "def") is None
+        assert request.response.etag == "def"
+
+        request = blank(**{'If-Modified-Since':
+                           'Thu, 01 Jan 1970 00:16:40 GMT'})
+        assert views._not_modified(request, None, 1000).status_int == 304
+        assert views._not_modified(request, None, 1001) is None
+        assert views._not_modified(blank(), "abc", 1000) is None
+    finally:
+        testing.tearDown()
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+from pyramid import testing
+from pyramid.request import Request
+
+from mist.monitor import views
+from mist.monitor.exceptions import BadRequestError
+
+
+def test_list_machines(monkeypatch):
+    machines = [("a", ["r1", "r2"]), ("b", []), ("c", ["r.3"])]
+
+    def iter_machine_rules(after="", limit=0):
+        page = [item for item in machines if item[0] > after]
+        return iter(page[:limit] if limit else page)
+
+    monkeypatch.setattr(views, 'iter_machine_rules', iter_machine_rules)
+    testing.setUp()
+    try:
+        resp = views.list_machines(Request.blank('/machines'))
+        assert json.loads(resp.body) == {
+            "a": {"rules": ["r1", "r2"]},
+            "b": {"rules": []},
+            "c": {"rules": ["r.3"]},
+        }
+        assert 'X-Next-Cursor' not in resp.headers
+
+        resp = views.list_machines(Request.blank('/machines?limit=2'))
+        assert sorted(json.loads(resp.body)) == ["a", "b"]
+        assert resp.headers['X-Next-Cursor'] == "b"
+        resp = views.list_machines(
+            Request.blank('/machines?limit=2&after=b'))
+        assert json.loads(resp.body) == {"c": {"rules": ["r.3"]}}
+        assert 'X-Next-Cursor' not in resp.headers
+
+        # 0 means no limit
+        resp = views.list_machines(Request.blank('/machines?limit=0'))
+        assert len(json.loads(resp.body)) == 3
+        assert 'X-Next-Cursor' not in resp.headers
+        with pytest.raises(BadRequestError) as exc:
+            views.list_machines(Request.blank('/machines?limit=-1'))
+        assert "not be negative" in str(exc.value)
+    finally:
+        testing.tearDown()
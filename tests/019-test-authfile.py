@@ -0,0 +1,54 @@
+import os
+import time
+import shutil
+import tempfile
+
+from mist.monitor import authfile
+
+
+def test_auth_file_writer():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "collectd.passwd")
+    try:
+        authfile.write_entries(path, {"a": "pa", "b": "pb"})
+        writer = authfile.AuthFileWriter(path, interval=0.2)
+        for i in range(100):
+            writer.set("m%d" % i, "p%d" % i)
+        writer.remove("a")
+        writer.set("b", "pb2")
+        deadline = time.time() + 5
+        while writer.pending or authfile.read_entries(path).get("b") != "pb2":
+            assert time.time() < deadline, "changes not applied in time"
+            time.sleep(0.05)
+        entries = authfile.read_entries(path)
+        assert len(entries) == 101 and "a" not in entries
+        assert entries["m42"] == "p42"
+
+        # changes are applied to the current file, not replacing it
+        authfile.write_entries(path, dict(entries, c="pc"))
+        writer.remove("b")
+        writer.flush()
+        entries = authfile.read_entries(path)
+        assert entries["c"] == "pc" and "b" not in entries
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_auth_file_read_error():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # a missing file has no entries, other errors are raised
+        assert authfile.read_entries(os.path.join(tmpdir, "missing")) == {}
+        path = os.path.join(tmpdir, "collectd.passwd")
+        os.mkdir(path)
+        writer = authfile.AuthFileWriter(path, interval=60)
+        writer.pending["m1"] = "p1"
+        try:
+            writer.flush()
+        except IOError:
+            pass
+        else:
+            assert False, "unreadable auth file was overwritten"
+        assert writer.pending == {"m1": "p1"}
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,113 @@
+import pytest
+
+from mist.monitor import methods
+from mist.monitor import authfile
+from mist.monitor.exceptions import BadRequestError
+from mist.monitor.exceptions import MachineNotFoundError
+
+from tests.fakes import patch_clients
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.entries = []
+
+    def update(self, entries):
+        self.entries.append(dict(entries))
+
+
+def test_bulk_provisioning(monkeypatch):
+    db = patch_clients(monkeypatch)
+    writer = FakeWriter()
+    monkeypatch.setattr(authfile, 'get_writer', lambda: writer)
+
+    cpu = {'metric': 'cpu.total.nonidle', 'operator': 'gt', 'value': 90}
+    methods.add_machines(dict(
+        ("m%d" % i, {'collectd_password': "p%d" % i,
+                     'rules': {'cpu.high': cpu}})
+        for i in range(10)
+    ))
+    assert writer.entries == [dict(("m%d" % i, "p%d" % i)
+                                   for i in range(10))]
+    assert db['machines'].writes == 1 and db['conditions'].writes == 1
+    assert len(db['conditions'].docs) == 20
+    machine = methods.get_machine_from_uuid("m3")
+    assert machine.collectd_password == "p3"
+    assert sorted(machine.rules) == ['cpu.high', 'nodata']
+    condition = machine.get_condition('cpu.high')
+    assert (condition.metric, condition.value, condition.aggregate) == (
+        'cpu.total.nonidle', 90, 'all')
+
+    # replaced conditions are removed, other rules are kept
+    old_cond_id = machine.rules['cpu.high'].warning
+    methods.add_rules({
+        "m3": {'cpu.high': dict(cpu, value=80), 'load': {
+            'metric': 'load.shortterm', 'operator': 'gt', 'value': "4"}},
+        "m4": {'cpu.high': cpu},
+    })
+    assert len(db['conditions'].docs) == 21
+    assert not db['conditions'].find({'cond_id': old_cond_id})
+    machine = methods.get_machine_from_uuid("m3")
+    assert sorted(machine.rules) == ['cpu.high', 'load', 'nodata']
+    assert machine.get_condition('cpu.high').value == 80
+    assert machine.get_condition('load').value == 4.0
+
+    # nothing is written if any machine or rule is invalid
+    with pytest.raises(MachineNotFoundError):
+        methods.add_rules({"m1": {'cpu.high': cpu}, "x": {'cpu.high': cpu}})
+    with pytest.raises(BadRequestError):
+        methods.add_rules({"m1": {'cpu.high': dict(cpu, value="high")}})
+    assert len(db['conditions'].docs) == 21
+
+    # existing machines get their password updated
+    methods.add_machines({"m1": {'collectd_password': "new"},
+                          "m10": {'collectd_password': "p10"}})
+    assert writer.entries[-1] == {"m1": "new", "m10": "p10"}
+    assert methods.get_machine_from_uuid("m1").collectd_password == "new"
+    assert len(db['machines'].docs) == 11
+    assert len(db['conditions'].docs) == 22
+
+
+def referenced_conditions(db):
+    return sorted(rule['warning'] for machine in db['machines'].docs
+                  for rule in machine['rules'].values())
+
+
+def test_bulk_provisioning_conflicts(monkeypatch):
+    db = patch_clients(monkeypatch)
+    monkeypatch.setattr(methods, '_indexed', set())
+    monkeypatch.setattr(authfile, 'get_writer', lambda: FakeWriter())
+    machines = db['machines']
+    methods.add_machines({"m1": {'collectd_password': "p1"}})
+    assert machines.indexes == [('uuid', True)]
+
+    # m1 gets added concurrently, after checking which machines exist
+    find = machines.find
+    calls = []
+
+    def racy_find(query=None, fields=None):
+        calls.append(query)
+        return [] if len(calls) == 1 else find(query, fields)
+
+    monkeypatch.setattr(machines, 'find', racy_find)
+    methods.add_machines({"m1": {'collectd_password': "new"},
+                          "m2": {'collectd_password': "p2"}})
+    monkeypatch.setattr(machines, 'find', find)
+    assert sorted(doc['uuid'] for doc in machines.docs) == ["m1", "m2"]
+    assert methods.get_machine_from_uuid("m1").collectd_password == "new"
+    assert sorted(doc['cond_id'] for doc in db['conditions'].docs) == \
+        referenced_conditions(db)
+
+    # new conditions are removed again if updating machines fails
+    def broken_save(doc):
+        raise IOError("mongo went away")
+
+    monkeypatch.setattr(machines, 'save', broken_save)
+    with pytest.raises(IOError):
+        methods.add_machines({"m2": {'collectd_password': "p2"},
+                              "m3": {'collectd_password': "p3"}})
+    assert sorted(doc['uuid'] for doc in machines.docs) == \
+        ["m1", "m2", "m3"]
+    assert sorted(doc['cond_id'] for doc in db['conditions'].docs) == \
+        referenced_conditions(db)
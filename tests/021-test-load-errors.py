@@ -0,0 +1,55 @@
+import json
+
+import pytest
+from pyramid import testing
+
+from mist.monitor import views
+from mist.monitor import config
+from mist.monitor import methods
+from mist.monitor.exceptions import GraphiteError
+from mist.monitor.exceptions import GraphiteUnreachableError
+
+
+def test_load_chunk_errors(monkeypatch):
+    queried = []
+
+    def get_multi(target, start="", stop="", interval_str="",
+                  graphite_uri=""):
+        uuids = target.split('{')[1].split('}')[0].split(',')
+        queried.append(uuids)
+        if "bad" in uuids:
+            raise GraphiteError("bad series")
+        return [{'target': 'bucky.%s.load.shortterm' % uuid,
+                 'datapoints': [[1.0, 10]]} for uuid in uuids]
+
+    monkeypatch.setattr(config, 'GRAPHITE_CHUNK_SIZE', 4)
+    monkeypatch.setattr(methods, 'get_multi', get_multi)
+    uuids = ["a", "b", "bad", "c", "d", "e"]
+    load = methods.get_load(uuids)
+    assert sorted(load) == sorted(uuids)
+    assert load["bad"]['datapoints'] == [] and 'bad series' in \
+        load["bad"]['error']
+    assert load["a"]['datapoints'] == [[1.0, 10]]
+    assert ["bad"] in queried
+
+    # graphite being unreachable is still an error for the whole request
+    def unreachable(*args, **kwargs):
+        raise GraphiteUnreachableError("down")
+
+    monkeypatch.setattr(methods, 'get_multi', unreachable)
+    with pytest.raises(GraphiteUnreachableError):
+        methods.get_load(uuids)
+
+
+def test_stream_json_dict_error():
+    def items():
+        yield "a", 1
+        raise GraphiteError("failed")
+
+    testing.setUp()
+    try:
+        resp = views._stream_json_dict(items())
+        assert json.loads(resp.body) == {
+            "a": 1, "_error": str(GraphiteError("failed"))}
+    finally:
+        testing.tearDown()
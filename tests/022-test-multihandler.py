@@ -0,0 +1,41 @@
+import pytest
+
+from mist.monitor import config
+from mist.monitor import graphite
+from mist.monitor.exceptions import GraphiteError
+
+
+class BadTargetError(GraphiteError):
+    pass
+
+
+def test_multihandler_bisection(monkeypatch):
+    calls = []
+
+    def get_data(self, targets, start="", stop="", interval_str=""):
+        calls.append(list(targets))
+        bad = [target for target in targets if target.startswith("bad")]
+        if bad:
+            raise BadTargetError(bad[0])
+        return [{'target': '%(head)s.' + target, 'alias': '%(head)s.' + target,
+                 '_requested_target': target, 'datapoints': [[1, 10]]}
+                for target in targets]
+
+    monkeypatch.setattr(graphite.GenericHandler, 'get_data', get_data)
+    targets = ["t%d" % i for i in range(6)] + ["bad.a", "bad.b"]
+    handler = graphite.MultiHandler('a')
+    data = handler.get_data(targets)
+    assert sorted(item['_requested_target'] for item in data) == \
+        sorted(targets[:6])
+    assert sorted(handler.errors) == ["bad.a", "bad.b"]
+    assert handler.errors["bad.a"] == str(BadTargetError("bad.a"))
+    assert ["bad.a"] in calls and ["bad.b"] in calls
+    assert len(calls) < 2 * len(targets)
+
+    # nodata re-raises the original exception if nothing could be fetched
+    monkeypatch.setattr(config, 'NODATA_FROM_HEARTBEAT', False)
+    monkeypatch.setattr(graphite.GenericHandler, 'get_data',
+                        lambda self, targets, **kwargs: get_data(
+                            self, ["bad." + target for target in targets]))
+    with pytest.raises(BadTargetError):
+        graphite.NoDataHandler('a').get_data(["nodata"])
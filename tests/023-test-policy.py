@@ -0,0 +1,103 @@
+import time
+import threading
+
+import pytest
+import requests
+
+from mist.monitor import config
+from mist.monitor import policy
+from mist.monitor.exceptions import GraphiteUnreachableError
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+
+def test_deadline(monkeypatch):
+    monkeypatch.setattr(policy, '_backends', {})
+    timeouts = []
+
+    def request(method, url, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        return FakeResponse()
+
+    monkeypatch.setattr(requests, 'request', request)
+    assert policy.get_deadline() is None
+    with policy.deadline(10) as at:
+        # nested deadlines only shorten the current one
+        with policy.deadline(100) as nested:
+            assert nested == at
+        with policy.deadline(1) as nested:
+            assert nested < at
+            policy.request('GET', 'http://graphite/render')
+            assert timeouts[-1] <= 1
+        assert policy.get_deadline() == at
+    assert policy.get_deadline() is None
+
+    with policy.deadline(at=time.time() - 1):
+        with pytest.raises(GraphiteUnreachableError):
+            policy.request('GET', 'http://graphite/render')
+    stats = policy.get_stats()['http://graphite']
+    assert stats['requests'] == 2 and stats['rejected'] == 1
+
+
+def test_circuit_breaker(monkeypatch):
+    monkeypatch.setattr(policy, '_backends', {})
+    monkeypatch.setattr(config, 'GRAPHITE_BREAKER_THRESHOLD', 3)
+    monkeypatch.setattr(config, 'GRAPHITE_BREAKER_RESET', 30)
+    monkeypatch.setattr(config, 'GRAPHITE_HEDGE_AFTER', None)
+    sent = []
+
+    def request(method, url, timeout=None, **kwargs):
+        sent.append(url)
+        return FakeResponse(503)
+
+    monkeypatch.setattr(requests, 'request', request)
+    for i in range(3):
+        assert policy.request('GET', 'http://graphite/render').status_code \
+            == 503
+    with pytest.raises(GraphiteUnreachableError):
+        policy.request('GET', 'http://graphite/render')
+    assert len(sent) == 3
+    assert GraphiteUnreachableError.http_code == 503
+
+    # a single trial request is let through once reset_after has passed
+    breaker = policy.get_backend('http://graphite').breaker
+    breaker.opened_at -= 31
+    assert breaker.state == 'half-open'
+    assert breaker.allow() and not breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+
+    # counters are consistent when updated from many threads
+    breaker.failures = -10 ** 6
+    threads = [threading.Thread(target=policy.request,
+                                args=('GET', 'http://graphite/render'))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = policy.get_stats()['http://graphite']
+    assert stats['requests'] == 24 and stats['errors'] == 23
+
+
+def test_hedging(monkeypatch):
+    monkeypatch.setattr(policy, '_backends', {})
+    monkeypatch.setattr(config, 'GRAPHITE_HEDGE_AFTER', 0.05)
+    calls = []
+
+    def request(method, url, timeout=None, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return FakeResponse(500)
+        return FakeResponse(200)
+
+    monkeypatch.setattr(requests, 'request', request)
+    started = time.time()
+    assert policy.request('GET', 'http://graphite/render').status_code == 200
+    assert time.time() - started < 0.4
+    assert len(calls) == 2
+    assert policy.get_stats()['http://graphite']['hedged'] == 1
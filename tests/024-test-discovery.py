@@ -0,0 +1,68 @@
+import os
+import shutil
+import socket
+import tempfile
+
+import pytest
+
+from mist.bucky_extras.processors.core_observer import DiscoveryClient
+from mist.bucky_extras.processors.core_observer import DiscoveryService
+from mist.bucky_extras.processors.core_observer import NewMetricsObserver
+
+
+def test_discovery():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "discovery.sock")
+        metrics_path = os.path.join(tmpdir, "discovered_metrics.conf")
+        service = DiscoveryService(path, metrics_path)
+        observers = [NewMetricsObserver(discovery=path) for i in range(2)]
+        assert isinstance(observers[0].queue, DiscoveryClient)
+
+        # both observers send the metric, the service queues it once
+        for observer in observers:
+            observer.process_batch(["h1", "h1"], ["load.shortterm", "cpu.0"],
+                                   [1.0, 2.0], [10, 10])
+            observer("h2", "df.root.free", 3.0, 10)
+        for i in range(6):
+            service.handle(service.sock.recv(4096))
+        assert service.queue.qsize() == 3
+        assert sorted(service.queue.get() for i in range(3)) == [
+            ("h1", "cpu.0"), ("h1", "load.shortterm"), ("h2", "df.root.free")]
+
+        # metrics seen by an observer are not sent again
+        observers[0]("h2", "df.root.free", 3.0, 20)
+        service.sock.setblocking(0)
+        with pytest.raises(socket.error):
+            service.sock.recv(4096)
+
+        service.handle("invalid")
+        assert service.queue.empty()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_discovery_down(caplog):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "discovery.sock")
+        observer = NewMetricsObserver(discovery=path)
+        observer("h1", "load.shortterm", 1.0, 10)
+        observer.process_batch(["h1"] * 3, ["load.shortterm"] * 3,
+                               [1.0] * 3, [10] * 3)
+        assert ("h1", "load.shortterm") not in observer.metrics
+        # a single error is logged for all failed sends
+        messages = [record.getMessage() for record in caplog.records
+                    if "persist" not in record.getMessage()]
+        assert len(messages) == 1
+        assert "discovery service" in messages[0]
+        assert observer.queue.dropped == 3
+
+        # retried the next time the metric is seen
+        service = DiscoveryService(path)
+        observer("h1", "load.shortterm", 1.0, 20)
+        assert ("h1", "load.shortterm") in observer.metrics
+        service.handle(service.sock.recv(4096))
+        assert service.queue.get(block=False) == ("h1", "load.shortterm")
+    finally:
+        shutil.rmtree(tmpdir)
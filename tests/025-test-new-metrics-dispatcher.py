@@ -0,0 +1,138 @@
+import json
+import Queue
+
+from mist.monitor import config
+from mist.monitor import metadata
+from mist.bucky_extras.processors import core_observer
+from mist.bucky_extras.processors.core_observer import NewMetricsDispatcher
+
+from tests.fakes import patch_clients
+
+
+class FakeMachine(object):
+
+    def __init__(self, uuid):
+        self.collectd_password = "p-%s" % uuid if uuid != "nopass" else ""
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = ""
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.status = {}  # uuid -> status code of responses
+        self.posts = []
+
+    def post(self, url, data, verify):
+        payload = json.loads(data)
+        self.posts.append((url, payload))
+        return FakeResponse(self.status.get(payload['uuid'], 200))
+
+
+class FakeStore(object):
+
+    def __init__(self):
+        self.names = {}
+
+    def append(self, host, names):
+        self.names.setdefault(host, []).extend(names)
+
+
+def get_dispatcher(monkeypatch, metadata=False):
+    monkeypatch.setattr(config, 'NEW_METRICS_BATCH_SIZE', 2)
+    monkeypatch.setattr(config, 'NEW_METRICS_BULK', False)
+    if not metadata:
+        monkeypatch.setattr(core_observer, 'update_from_names',
+                            lambda *a: None)
+    monkeypatch.setattr(core_observer, 'get_machine_from_uuid',
+                        lambda uuid: FakeMachine(uuid))
+    dispatcher = NewMetricsDispatcher(Queue.Queue(), store=FakeStore())
+    dispatcher.session = FakeSession()
+    return dispatcher
+
+
+def test_dispatcher_batches(monkeypatch):
+    dispatcher = get_dispatcher(monkeypatch)
+    for host in ("h1", "h2", "h3", "nopass"):
+        dispatcher.queue.put((host, "nginx.requests"))
+        dispatcher.queue.put((host, "nginx.connections"))
+    dispatcher.session.status["h3"] = 400
+    dispatcher.run_once()
+
+    posted = sorted(payload['uuid']
+                    for url, payload in dispatcher.session.posts)
+    assert posted == ["h1", "h2", "h3"]
+    for url, payload in dispatcher.session.posts:
+        assert url.endswith("/new_metrics")
+        assert payload['collectd_password'] == "p-%s" % payload['uuid']
+        assert len(payload['metrics']) == 2
+    assert sorted(dispatcher.store.names) == ["h1", "h2"]
+    assert not dispatcher.pending
+    stats = dispatcher.get_stats()
+    assert stats['received'] == 8
+    assert stats['dispatched'] == 4
+    # rejected by core or without password
+    assert stats['dropped'] == 4
+    assert stats['batches'] == 2 and stats['failed_batches'] == 0
+
+
+def test_dispatcher_retry(monkeypatch):
+    dispatcher = get_dispatcher(monkeypatch)
+    dispatcher.queue.put(("h1", "nginx.requests"))
+    dispatcher.queue.put(("h2", "nginx.requests"))
+    dispatcher.session.status["h1"] = 503
+    dispatcher.run_once()
+    assert dispatcher.pending.keys() == ["h1"]
+    assert dispatcher.store.names.keys() == ["h2"]
+    assert dispatcher.failures == 1 and dispatcher.retry_at > 0
+
+    # nothing is sent before backoff expires
+    dispatcher.session.status["h1"] = 200
+    dispatcher.run_once()
+    assert len(dispatcher.session.posts) == 2
+    dispatcher.retry_at = 0
+    dispatcher.run_once()
+    assert len(dispatcher.session.posts) == 3
+    assert dispatcher.store.names["h1"] == ["nginx.requests"]
+    assert not dispatcher.pending and dispatcher.failures == 0
+    assert dispatcher.get_stats()['failed_batches'] == 1
+
+
+def test_dispatcher_unauthorized(monkeypatch):
+    dispatcher = get_dispatcher(monkeypatch)
+    dispatcher.queue.put(("h1", "nginx.requests"))
+    dispatcher.session.status["h1"] = 401
+    dispatcher.run_once()
+    assert not dispatcher.pending and not dispatcher.store.names
+    assert dispatcher.failures == 0
+    assert "h1" not in dispatcher.passwords
+    assert dispatcher.get_stats()['dropped'] == 1
+
+
+def test_dispatcher_retry_metadata(monkeypatch):
+    db = patch_clients(monkeypatch)
+    monkeypatch.setattr(metadata, '_indexed', set())
+    dispatcher = get_dispatcher(monkeypatch, metadata=True)
+    dispatcher.queue.put(("h1", "nginx.requests"))
+    dispatcher.queue.put(("h1", "nginx.connections"))
+    dispatcher.session.status["h1"] = 503
+    dispatcher.run_once()
+    doc = db['machine_metadata'].find_one({'uuid': "h1"})
+    assert doc['metrics_version'] == 1 and doc['plugins'] == ["nginx"]
+
+    # retries don't record the same names again
+    writes = db['machine_metadata'].writes
+    dispatcher.retry_at = 0
+    dispatcher.run_once()
+    dispatcher.session.status["h1"] = 200
+    dispatcher.retry_at = 0
+    dispatcher.run_once()
+    assert len(dispatcher.session.posts) == 3 and not dispatcher.pending
+    assert db['machine_metadata'].writes == writes
+    assert db['machine_metadata'].find_one({'uuid': "h1"}) == doc
@@ -0,0 +1,113 @@
+import re
+
+from mist.monitor import graphite
+from mist.monitor import metadata
+from mist.monitor.metadata import get_cached_metadata
+from mist.monitor.metadata import get_metadata_many
+from mist.monitor.metadata import update_from_names
+
+from tests.fakes import patch_clients
+
+
+class FakeIndex(object):
+    """Graphite's metric index, answering find queries."""
+
+    def __init__(self, paths):
+        self.nodes = set()
+        for path in paths:
+            parts = path.split('.')
+            for i in range(1, len(parts) + 1):
+                self.nodes.add('.'.join(parts[:i]))
+        self.queries = []
+
+    def find(self, handler, query):
+        self.queries.append(query)
+        regex = re.escape(query).replace(r'\*', '[^.]*')
+        regex = re.sub(r'\\\{(.*?)\\\}',
+                       lambda m: '(%s)' % m.group(1).replace(r'\,', '|'),
+                       regex)
+        return [{'id': node} for node in sorted(self.nodes)
+                if re.match(regex + '$', node)]
+
+
+def patch_db(monkeypatch, paths):
+    db = patch_clients(monkeypatch)
+    monkeypatch.setattr(metadata, '_indexed', set())
+    index = FakeIndex(paths)
+    monkeypatch.setattr(graphite.GenericHandler, '_find_metrics',
+                        lambda self, query: index.find(self, query))
+    return db['machine_metadata'], index
+
+
+def test_metadata(monkeypatch):
+    coll, index = patch_db(monkeypatch, [
+        "bucky.m1.cpu.0.idle", "bucky.m1.cpu.1.idle",
+        "bucky.m1.cpu.total.nonidle", "bucky.m1.load.shortterm",
+        "bucky.m1.disk.sda.disk_octets.read",
+        "bucky.m1.disk.total.disk_octets.read",
+        "bucky.m2.interface.eth0.if_octets.rx",
+    ])
+
+    # records created from ingestion are partial
+    update_from_names("m1", ["cpu.0.idle", "load.shortterm"])
+    assert coll.indexes == [('uuid', True)]
+    assert len(coll.docs) == 1 and coll.docs[0]['cpus'] == ["0"]
+    assert get_cached_metadata("m1") is None
+
+    # a single find per field for the chunk, new records inserted at once
+    coll.writes = 0
+    found = get_metadata_many(["m1", "m2"])
+    assert sorted(index.queries) == ["bucky.{m1,m2}.*",
+                                     "bucky.{m1,m2}.cpu.*",
+                                     "bucky.{m1,m2}.disk.*",
+                                     "bucky.{m1,m2}.interface.*"]
+    assert coll.writes == 2
+    m1, m2 = found["m1"], found["m2"]
+    assert list(m1.cpus) == ["0", "1"] and list(m1.disks) == ["sda"]
+    assert list(m1.plugins) == ["cpu", "disk", "load"]
+    assert list(m2.interfaces) == ["eth0"]
+    assert len(coll.docs) == 2
+    assert coll.find_one({'uuid': "m1"})['version'] == 2
+    assert list(get_cached_metadata("m1").disks) == ["sda"]
+
+    # unchanged records are marked as refreshed with a single write
+    coll.writes = 0
+    found = get_metadata_many(["m1", "m2"], max_age=0)
+    assert coll.writes == 1
+    assert found["m1"].version == 2 and found["m2"].version == 1
+
+    # ingestion only adds, with an atomic update
+    update_from_names("m1", ["disk.sdb.disk_octets.read", "load.midterm"])
+    doc = coll.find_one({'uuid': "m1"})
+    assert doc['disks'] == ["sda", "sdb"] and doc['version'] == 3
+    assert doc['metrics_version'] == 2
+    assert len(coll.docs) == 2
+
+
+def test_total_targets(monkeypatch):
+    patch_db(monkeypatch, [])
+    meta = metadata.MachineMetadata()
+    meta.cpus, meta.disks, meta.interfaces = ["0", "1"], ["sda"], []
+    for handler in (graphite.MultiHandler("m1"),
+                    graphite.MultiHandler("m1", meta)):
+        disk = handler.get_handler("%(head)s.disk.total.disk_ops.read")
+        cpu = handler.get_handler("%(head)s.cpu.total.nonidle")
+        iface = handler.get_handler("%(head)s.interface.total.if_errors.rx")
+        targets = [
+            disk.target_alias("%(head)s.disk.total.disk_ops.read")[0],
+            cpu.target_alias("%(head)s.cpu.total.user")[0],
+            cpu.target_alias("%(head)s.cpu.total.nonidle")[0],
+            iface.target_alias("%(head)s.interface.total.if_errors.rx")[0],
+        ]
+        if handler.metadata is None:
+            assert all("exclude" in target for target in targets)
+    # known disks and cores are listed instead of wildcards
+    assert targets[:3] == [
+        "sumSeries(%(head)s.disk.sda.disk_ops.read)",
+        "asPercent(sumSeries(%(head)s.cpu.{0,1}.user),"
+        "sumSeries(%(head)s.cpu.{0,1}.*))",
+        "asPercent(sumSeries(exclude(%(head)s.cpu.{0,1}.*,'idle')),"
+        "sumSeries(%(head)s.cpu.{0,1}.*))",
+    ]
+    # no interfaces known
+    assert "interface.*.if_errors.rx" in targets[3]
@@ -0,0 +1,163 @@
+"""In memory stand-ins for mongo and memcache clients used by tests
+
+FakeCollection models the parts of a pymongo 2.5 collection that mist.monitor
+uses: find/find_one with equality and $in queries, insert (optionally with
+continue_on_error), update with $set, $inc and $addToSet ($each), upserts and
+multi updates, save and remove. Unique indexes created with ensure_index are
+enforced, raising DuplicateKeyError like mongo would.
+
+Patch them in with patch_clients(monkeypatch), which returns the FakeDB of
+the 'mist' database.
+
+"""
+
+import copy
+import itertools
+
+from pymongo.errors import DuplicateKeyError
+
+import mist.core.dal
+
+
+_ids = itertools.count(1)
+
+
+class FakeCollection(object):
+
+    def __init__(self):
+        self.docs = []
+        self.writes = 0
+        self.indexes = []  # (key, unique)
+
+    def ensure_index(self, key, unique=False):
+        if (key, unique) not in self.indexes:
+            self.indexes.append((key, unique))
+
+    def _match(self, doc, query):
+        for key, value in query.iteritems():
+            if isinstance(value, dict):
+                if doc.get(key) not in value['$in']:
+                    return False
+            elif doc.get(key) != value:
+                return False
+        return True
+
+    def _check_unique(self, doc):
+        for key, unique in self.indexes:
+            if unique and key in doc and any(
+                    other.get(key) == doc[key] and other is not doc and
+                    other['_id'] != doc.get('_id') for other in self.docs):
+                raise DuplicateKeyError("E11000 duplicate key %s: %r" % (
+                    key, doc[key]))
+
+    def find(self, query=None, fields=None):
+        return [copy.deepcopy(doc) for doc in self.docs
+                if self._match(doc, query or {})]
+
+    def find_one(self, query=None):
+        found = self.find(query)
+        return found[0] if found else None
+
+    def insert(self, docs, continue_on_error=False):
+        self.writes += 1
+        single = isinstance(docs, dict)
+        error = None
+        for doc in [docs] if single else docs:
+            doc.setdefault('_id', next(_ids))
+            try:
+                self._check_unique(doc)
+            except DuplicateKeyError as exc:
+                if not continue_on_error:
+                    raise
+                error = error or exc
+                continue
+            self.docs.append(copy.deepcopy(doc))
+        if error:
+            raise error
+
+    def update(self, spec, document, upsert=False, multi=False):
+        self.writes += 1
+        docs = [doc for doc in self.docs if self._match(doc, spec)]
+        if not docs and upsert:
+            doc = dict((key, value) for key, value in spec.iteritems()
+                       if not isinstance(value, dict))
+            doc['_id'] = next(_ids)
+            self._check_unique(doc)
+            self.docs.append(doc)
+            docs = [doc]
+        for doc in docs[:None if multi else 1]:
+            new = copy.deepcopy(doc)
+            new.update(copy.deepcopy(document.get('$set', {})))
+            for key, value in document.get('$inc', {}).iteritems():
+                new[key] = new.get(key, 0) + value
+            for key, value in document.get('$addToSet', {}).iteritems():
+                items = new.setdefault(key, [])
+                items += [item for item in value['$each']
+                          if item not in items]
+            self._check_unique(new)
+            doc.clear()
+            doc.update(new)
+
+    def save(self, doc):
+        if '_id' not in doc:
+            return self.insert(doc)
+        self.writes += 1
+        self._check_unique(doc)
+        self.docs = [item for item in self.docs if item['_id'] != doc['_id']]
+        self.docs.append(copy.deepcopy(doc))
+
+    def remove(self, spec):
+        self.writes += 1
+        self.docs = [doc for doc in self.docs if not self._match(doc, spec)]
+
+
+class FakeDB(dict):
+
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+
+class FakeMongoClient(object):
+
+    dbs = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        return self.dbs.setdefault(name, FakeDB())
+
+    def close(self):
+        pass
+
+
+class FakeMemcacheClient(object):
+
+    data = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get(self, key):
+        return copy.deepcopy(self.data.get(key))
+
+    def set(self, key, value):
+        self.data[key] = copy.deepcopy(value)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+
+def patch_clients(monkeypatch):
+    """Make mist.core.dal use fresh fakes, return the 'mist' FakeDB."""
+    db = FakeDB()
+    monkeypatch.setattr(FakeMongoClient, 'dbs', {'mist': db})
+    monkeypatch.setattr(FakeMemcacheClient, 'data', {})
+    monkeypatch.setattr(mist.core.dal, 'MongoClient', FakeMongoClient)
+    monkeypatch.setattr(mist.core.dal, 'MemcacheClient', FakeMemcacheClient)
+    return db